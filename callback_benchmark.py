@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+"""
+Compares the throughput of the callback backends on CPU-bound and IO-bound
+completion callbacks
+
+Usage: python callback_benchmark.py [num_tasks] [worker_count]
+"""
+
+import imsearchtools as ist
+from imsearchtools.process.callback_backends import get_callback_backend, get_callback_backend_list
+from imsearchtools.process.worker_pool import get_process_pool
+import time
+import sys
+
+TASK_DURATION = 0.02
+
+def cpu_bound_callback(out_dict):
+    start = time.time()
+    count = 0
+    while time.time() - start < TASK_DURATION:
+        count += 1
+    return count
+
+def io_bound_callback(out_dict):
+    time.sleep(TASK_DURATION)
+
+def run_benchmark(backend, callback, num_tasks, worker_count):
+    handler = get_callback_backend(backend)(callback, num_tasks, worker_count)
+    start = time.time()
+    for task_num in range(num_tasks):
+        handler.run_callback({'image_id': str(task_num)})
+    handler.join()
+    return num_tasks / (time.time() - start)
+
+if __name__ == '__main__':
+    num_tasks = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    worker_count = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    # start the shared worker processes up front, so they aren't timed
+    get_process_pool(worker_count)
+
+    print('%d tasks of %.0f ms, %d workers (tasks/sec):' % (num_tasks, TASK_DURATION*1000,
+                                                           worker_count))
+    print('%-10s %10s %10s' % ('backend', 'cpu-bound', 'io-bound'))
+    for backend in get_callback_backend_list():
+        try:
+            rates = [run_benchmark(backend, callback, num_tasks, worker_count)
+                     for callback in [cpu_bound_callback, io_bound_callback]]
+        except ImportError as e:
+            print('%-10s (unavailable: %s)' % (backend, str(e)))
+            continue
+        print('%-10s %10.1f %10.1f' % (backend, rates[0], rates[1]))
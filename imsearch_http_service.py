@@ -2,8 +2,8 @@
 
 import sys
 
-from flask import Flask, request, Response, url_for
-from gevent.wsgi import WSGIServer
+from flask import Flask, request, Response, url_for, stream_with_context
+from gevent.pywsgi import WSGIServer
 from flask import json
 
 from imsearchtools import http_service_helper
@@ -12,7 +12,7 @@ import logging
 logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s', level=logging.DEBUG)
 
 DEFAULT_SERVER_PORT = 8157
-SUPPORTED_ENGINES = ['bing_api', 'google_old_api', 'google_api', 'google_web', 'flickr_api']
+SUPPORTED_ENGINES = ['bing_api', 'google_old_api', 'google_api', 'google_web', 'flickr_api', 'multi']
 
 zmq_context = None # used to store zmq context created by init_zmq_context function
 
@@ -59,6 +59,22 @@ def download():
 
     return Response(json.dumps(url_dfiles_list), mimetype='application/json')
 
+@app.route('/download_stream', methods=['POST'])
+def download_stream():
+    # parse POST data
+    query_res_list = request.json
+    if not query_res_list:
+        raise ValueError("Input must be 'application/json' encoded list of urls")
+    # download images, returning each as a line of JSON as soon as it is ready
+    dfiles_iter = http_service_helper.imsearch_iter_download_to_static(query_res_list)
+
+    def generate():
+        for dfile_ifo in dfiles_iter:
+            # convert pathnames to URL paths
+            yield json.dumps(http_service_helper.make_url_dfile(dfile_ifo)) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 @app.route('/get_postproc_module_list')
 def get_postproc_module_list():
     return json.dumps(http_service_helper.get_postproc_modules())
@@ -98,19 +114,42 @@ def exec_pipeline():
             query_params[param_nm] = request.form[param_nm]
     if 'num_results' in request.form:
         query_params['num_results'] = int(request.form['num_results'])
-    # execute query
-    query_res_list = http_service_helper.imsearch_query(query, engine,
-                                                        query_params, query_timeout)
-    print('Query for %s completed: %d results retrieved' % (query, len(query_res_list)))
-    #query_res_list = query_res_list[:5] # DEBUG CODE
     # prepare download params
     imgetter_params = dict()
-    for param_nm in ['improc_timeout', 'per_image_timeout']:
+    for param_nm in ['improc_timeout', 'per_image_timeout',
+                     'postproc_timeout', 'postproc_idle_timeout']:
         if param_nm in request.form:
             imgetter_params[param_nm] = float(request.form[param_nm])
     for param_nm in ['resize_width', 'resize_height']:
         if param_nm in request.form:
             imgetter_params[param_nm] = int(request.form[param_nm])
+    if 'postproc_backend' in request.form:
+        if request.form['postproc_backend'] not in http_service_helper.get_postproc_backends():
+            return Response(json.dumps(dict(error='Unknown postproc_backend: %s' %
+                                            request.form['postproc_backend'])),
+                            status=400, mimetype='application/json')
+        imgetter_params['postproc_backend'] = request.form['postproc_backend']
+
+    # if requested, run the pipeline in the background and return its job ID
+    if int(request.form.get('async', 0)) == 1:
+        job = http_service_helper.start_pipeline_job(query, engine, query_params,
+                                                     query_timeout,
+                                                     postproc_module,
+                                                     postproc_extra_prms,
+                                                     custom_local_path,
+                                                     imgetter_params,
+                                                     zmq_context,
+                                                     return_dfiles_list)
+        print('Started job %s for %s' % (job.job_id, query))
+        return Response(json.dumps(dict(job_id=job.job_id,
+                                        status_url=url_for('job_status', job_id=job.job_id))),
+                        status=202, mimetype='application/json')
+
+    # execute query
+    query_res_list = http_service_helper.imsearch_query(query, engine,
+                                                        query_params, query_timeout)
+    print('Query for %s completed: %d results retrieved' % (query, len(query_res_list)))
+    #query_res_list = query_res_list[:5] # DEBUG CODE
     # download images
     print('Downloading for %s started: %d sec improc_timeout, %d sec per_image_timeout' % (query,
                                                                                            imgetter_params['improc_timeout'] if imgetter_params['improc_timeout'] else -1,
@@ -132,12 +171,24 @@ def exec_pipeline():
     else:
         return 'DONE'
 
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = http_service_helper.get_job(job_id)
+    if job is None:
+        return Response(json.dumps(dict(error='Unknown job: %s' % job_id)),
+                        status=404, mimetype='application/json')
+    return Response(json.dumps(job.to_dict()), mimetype='application/json')
+
 
 if __name__ == '__main__':
     if len(sys.argv)>1:
         SERVER_PORT = int(sys.argv[1])
     else:
         SERVER_PORT = DEFAULT_SERVER_PORT
+    if len(sys.argv)>2:
+        http_service_helper.HASH_BLACKLIST_FN = sys.argv[2]
+    http_service_helper.load_hash_blacklist()
+    http_service_helper.setup_result_cache()
     print("Starting imsearch_http_service on port", SERVER_PORT)
     http_server = WSGIServer(('', SERVER_PORT), app)
     http_server.serve_forever()
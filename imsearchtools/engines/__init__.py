@@ -3,3 +3,8 @@ from .google_old_api import *
 from .google_api import *
 from .google_web import *
 from .flickr_api import *
+from .multi_engine import *
+from .search_client import set_result_cache
+from .result_cache import ResultCache, SqliteCacheStore
+from .throttle import EngineThrottle, get_engine_throttle, set_engine_throttle
+from .latency import LatencyTracker, get_latency_tracker
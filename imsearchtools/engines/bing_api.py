@@ -47,7 +47,7 @@ class BingAPISearch(requests.Session, SearchClient):
 
     def _fetch_results_from_offset(self, query, result_offset,
                                    aux_params={}, headers={},
-                                   num_results=-1):
+                                   num_results=-1, timeout=None):
         if num_results == -1:
             num_results = self._results_per_req
 
@@ -68,7 +68,7 @@ class BingAPISearch(requests.Session, SearchClient):
                 print(aux_params)
 
             resp = self.get(BING_API_ENTRY + BING_API_FUNC, params=aux_params,
-                            headers=headers)
+                            headers=headers, timeout=timeout)
             resp.raise_for_status()
 
             # extract list of results from response
@@ -86,7 +86,7 @@ class BingAPISearch(requests.Session, SearchClient):
                  'image_id': md5(item['ID']).hexdigest(),
                  'title': item['Title']} for item in results]
 
-    def query(self, query, size='medium', style='photo', num_results=100):
+    def query(self, query, size='medium', style='photo', num_results=100, timeout=None):
         # prepare query parameters
         size = self._size_to_native_size(size)
         style = self._style_to_native_style(style)
@@ -112,6 +112,7 @@ class BingAPISearch(requests.Session, SearchClient):
         # do request
         results = self._fetch_results(query,
                                       num_results,
-                                      aux_params=aux_params)
+                                      aux_params=aux_params,
+                                      timeout=timeout)
 
         return self.__bing_results_to_results(results)
@@ -39,7 +39,7 @@ class FlickrAPISearch(requests.Session, SearchClient):
 
     def _fetch_results_from_offset(self, query, result_offset,
                                    aux_params={}, headers={},
-                                   num_results=-1):
+                                   num_results=-1, timeout=None):
         if num_results == -1:
             num_results = self._results_per_req
         try:
@@ -58,7 +58,7 @@ class FlickrAPISearch(requests.Session, SearchClient):
 
             resp = self.get(FLICKR_API_ENTRY,
                             params=aux_params,
-                            headers=headers)
+                            headers=headers, timeout=timeout)
             resp.raise_for_status()
 
             # extract list of results from response
@@ -81,7 +81,7 @@ class FlickrAPISearch(requests.Session, SearchClient):
                  'image_id': md5(item['id']).hexdigest(),
                  'title': item['title']} for item in results]
 
-    def query(self, query, size='medium', num_results=100):
+    def query(self, query, size='medium', num_results=100, timeout=None):
         # prepare query parameters
         size = self._size_to_native_size(size)
 
@@ -96,6 +96,7 @@ class FlickrAPISearch(requests.Session, SearchClient):
         # do request
         results = self._fetch_results(query,
                                       num_results,
-                                      aux_params=aux_params)
+                                      aux_params=aux_params,
+                                      timeout=timeout)
 
         return self.__flickr_results_to_results(results, size)
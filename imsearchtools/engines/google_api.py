@@ -48,7 +48,7 @@ class GoogleAPISearch(requests.Session, SearchClient):
 
     def _fetch_results_from_offset(self, query, result_offset,
                                    aux_params={}, headers={},
-                                   num_results=-1):
+                                   num_results=-1, timeout=None):
         if num_results == -1:
             num_results = self._results_per_req
         try:
@@ -60,7 +60,7 @@ class GoogleAPISearch(requests.Session, SearchClient):
             aux_params['num'] = req_result_count
 
             resp = self.get(GOOGLE_API_ENTRY + GOOGLE_API_FUNC,
-                            params=aux_params, headers=headers)
+                            params=aux_params, headers=headers, timeout=timeout)
             resp.raise_for_status()
 
             # extract list of results from response
@@ -76,7 +76,7 @@ class GoogleAPISearch(requests.Session, SearchClient):
                  'image_id': md5(item['link']).hexdigest(),
                  'title': item['title']} for item in results]
 
-    def query(self, query, size='medium', style='photo', num_results=100):
+    def query(self, query, size='medium', style='photo', num_results=100, timeout=None):
         # check input
         if num_results > 100:
             raise ValueError('Google API currently allows for a maximum of 100 results to be returend')
@@ -97,6 +97,7 @@ class GoogleAPISearch(requests.Session, SearchClient):
         # do request
         results = self._fetch_results(query,
                                       num_results,
-                                      aux_params=aux_params)
+                                      aux_params=aux_params,
+                                      timeout=timeout)
 
         return self.__google_results_to_results(results)
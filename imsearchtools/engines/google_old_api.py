@@ -44,7 +44,7 @@ class GoogleOldAPISearch(requests.Session, SearchClient):
 
     def _fetch_results_from_offset(self, query, result_offset,
                                    aux_params={}, headers={},
-                                   num_results=-1):
+                                   num_results=-1, timeout=None):
         if num_results == -1:
             num_results = self._results_per_req
         try:
@@ -56,7 +56,7 @@ class GoogleOldAPISearch(requests.Session, SearchClient):
             aux_params['rsz'] = req_result_count
 
             resp = self.get(GOOGLE_OLD_API_ENTRY + GOOGLE_OLD_API_FUNC,
-                            params=aux_params, headers=headers)
+                            params=aux_params, headers=headers, timeout=timeout)
 
             # extract list of results from response
             result_dict = resp.json()
@@ -71,7 +71,7 @@ class GoogleOldAPISearch(requests.Session, SearchClient):
                  'image_id': md5(item['imageId']).hexdigest(),
                  'title': item['titleNoFormatting']} for item in results]
 
-    def query(self, query, size='medium', style='photo', num_results=64):
+    def query(self, query, size='medium', style='photo', num_results=64, timeout=None):
         # check input
         if num_results > 64:
             raise ValueError('Google API currently allows for a maximum of 64 results to be returend')
@@ -94,6 +94,7 @@ class GoogleOldAPISearch(requests.Session, SearchClient):
         # do request
         results = self._fetch_results(query,
                                       num_results,
-                                      aux_params=aux_params)
+                                      aux_params=aux_params,
+                                      timeout=timeout)
 
         return self.__google_results_to_results(results)
@@ -46,7 +46,7 @@ class GoogleOldWebSearch(requests.Session, SearchClient):
 
     def _fetch_results_from_offset(self, query, result_offset,
                                    aux_params={}, headers={},
-                                   num_results=-1):
+                                   num_results=-1, timeout=None):
         if num_results == -1:
             num_results = self._results_per_req
         image_url_pattern = re.compile(r'/imgres\?imgurl=(.*?)&')
@@ -58,7 +58,7 @@ class GoogleOldWebSearch(requests.Session, SearchClient):
             aux_params['start'] = result_offset
 
             resp = self.get(GOOGLE_WEB_ENTRY + GOOGLE_WEB_FUNC,
-                            params=aux_params, headers=headers)
+                            params=aux_params, headers=headers, timeout=timeout)
 
             resp_str = resp.text
             image_urls = image_url_pattern.findall(resp_str)[:(num_results-result_offset)]
@@ -71,7 +71,7 @@ class GoogleOldWebSearch(requests.Session, SearchClient):
         except requests.exceptions.RequestException:
             return []
         
-    def query(self, query, size='medium', style='photo', num_results=100):
+    def query(self, query, size='medium', style='photo', num_results=100, timeout=None):
         # prepare query parameters
         size = self._size_to_native_size(size)
         style = self._style_to_native_style(style)
@@ -95,7 +95,8 @@ class GoogleOldWebSearch(requests.Session, SearchClient):
         results = self._fetch_results(query,
                                       num_results,
                                       aux_params=aux_params,
-                                      headers=headers)
+                                      headers=headers,
+                                      timeout=timeout)
         
         return results
     
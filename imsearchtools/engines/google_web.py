@@ -45,7 +45,7 @@ class GoogleWebSearch(requests.Session, SearchClient):
 
     def _fetch_results_from_offset(self, query, result_offset,
                                    aux_params={}, headers={},
-                                   num_results=-1):
+                                   num_results=-1, timeout=None):
         #if num_results == -1:
         #    num_results = self._results_per_req
         image_div_pattern = re.compile(r'<div class="rg_meta(.*?)</div>')
@@ -64,7 +64,7 @@ class GoogleWebSearch(requests.Session, SearchClient):
             #aux_params['start'] = page_idx*self._results_per_req # apparently not necessary
 
             resp = self.get(GOOGLE_WEB_ENTRY + GOOGLE_WEB_FUNC,
-                            params=aux_params, headers=headers)
+                            params=aux_params, headers=headers, timeout=timeout)
             resp_str = resp.text
 
             image_divs = image_div_pattern.findall(resp_str)
@@ -94,7 +94,7 @@ class GoogleWebSearch(requests.Session, SearchClient):
         except requests.exceptions.RequestException:
             return []
 
-    def query(self, query, size='medium', style='photo', num_results=100):
+    def query(self, query, size='medium', style='photo', num_results=100, timeout=None):
         # prepare query parameters
         size = self._size_to_native_size(size)
         style = self._style_to_native_style(style)
@@ -121,6 +121,7 @@ class GoogleWebSearch(requests.Session, SearchClient):
         results = self._fetch_results(query,
                                       num_results,
                                       aux_params=aux_params,
-                                      headers=headers)
+                                      headers=headers,
+                                      timeout=timeout)
 
         return results
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+"""
+Module: latency
+Created on: 18 Oct 2026
+
+Per-engine tracking of the time taken to fetch each page of results, shared
+by all search clients of the same engine within a process
+"""
+
+from collections import deque
+
+DEFAULT_WINDOW = 100
+DEFAULT_MIN_SAMPLES = 10
+
+class LatencyTracker(object):
+    """Records the most recent request latencies of an engine
+
+    Initializer Args:
+        [window]: number of recent latencies kept
+        [min_samples]: number of latencies which must have been recorded
+            before percentiles are reported
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW, min_samples=DEFAULT_MIN_SAMPLES):
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+
+    def record(self, latency):
+        self._latencies.append(latency)
+
+    def percentile(self, pct):
+        """Returns the latency below which pct percent of recent requests
+        completed, or None if too few requests have been recorded"""
+        if len(self._latencies) < max(self.min_samples, 1):
+            return None
+        latencies = sorted(self._latencies)
+        idx = int(round(pct/100.0*(len(latencies) - 1)))
+        return latencies[min(max(idx, 0), len(latencies) - 1)]
+
+
+_latency_trackers = dict()
+
+def get_latency_tracker(engine_cls):
+    """Returns the latency tracker shared by all search clients of class
+    engine_cls"""
+    if engine_cls.__name__ not in _latency_trackers:
+        _latency_trackers[engine_cls.__name__] = LatencyTracker()
+    return _latency_trackers[engine_cls.__name__]
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+"""
+Module: multi_engine
+Created on: 18 Oct 2026
+
+Federated search, querying several engines concurrently and merging their
+rankings
+"""
+
+import time
+import inspect
+import logging
+from collections import OrderedDict
+import gevent
+
+from .search_client import *
+
+log = logging.getLogger(__name__)
+
+# constant used in reciprocal-rank fusion to damp the influence of top ranks
+DEFAULT_RRF_K = 60
+
+## Search Class
+#  --------------------------------------------
+
+class MultiEngineSearch(SearchClient):
+    """Search client querying several engines concurrently, with the results of
+    each merged into a single ranking using reciprocal-rank fusion
+
+    Initializer Args:
+        searchers: dictionary mapping engine names to their search clients
+            (any order given is used to break ties in the merged ranking)
+        [quorum]: number of engines which must return results before the
+            merged results are returned (-1 = all engines)
+        [timeout]: maximum time in seconds to wait for the engines - the
+            results of any engines still running are then discarded (can be
+            overridden for each query)
+
+    The results returned by each engine are de-duplicated by URL and by
+    'image_id', with each image scored by the sum of 1/(`rrf_k` + rank) over
+    the engines returning it. Each result also lists the 'engines' which
+    returned it.
+
+    An engine which does not support the requested size or style is skipped.
+    """
+
+    def __init__(self, searchers, quorum=-1, timeout=5.0, rrf_k=DEFAULT_RRF_K):
+        if not searchers:
+            raise ValueError('At least one engine must be specified')
+        self.searchers = OrderedDict(searchers)
+        self.quorum = quorum
+        self.timeout = timeout
+        self.rrf_k = rrf_k
+
+    @property
+    def supported_sizes(self):
+        return self._union(searcher.supported_sizes
+                           for searcher in self.searchers.values())
+
+    @property
+    def supported_styles(self):
+        return self._union(searcher.supported_styles
+                           for searcher in self.searchers.values())
+
+    def query(self, query, size='medium', style='photo', num_results=100, timeout=None):
+        if size and size not in self.supported_sizes:
+            raise ValueError("Unsupported size '%s'" % size)
+        if style and style not in self.supported_styles:
+            raise ValueError("Unsupported style '%s'" % style)
+
+        jobs = OrderedDict()
+        for engine, searcher in self.searchers.items():
+            query_params = self._engine_query_params(searcher, size, style, timeout)
+            if query_params is None:
+                log.info('Skipping engine %s (size or style not supported)', engine)
+                continue
+            jobs[engine] = gevent.spawn(searcher.query, query,
+                                        num_results=num_results, **query_params)
+        if not jobs:
+            raise QueryException("No engine supports the requested size and style")
+
+        engine_results = self._wait_for_engines(jobs, timeout)
+        if not engine_results:
+            raise QueryException("No image URLs could be retrieved")
+
+        return self._fuse_rankings(engine_results)[:num_results]
+
+    def _engine_query_params(self, searcher, size, style, timeout=None):
+        # returns None if the engine can't honour the size or style
+        query_params = dict()
+        query_args = inspect.signature(searcher.query).parameters
+        if size:
+            if size not in searcher.supported_sizes:
+                return None
+            query_params['size'] = size
+        if style:
+            if style not in searcher.supported_styles:
+                return None
+            # some engines return only a single style, so take no style argument
+            if 'style' in query_args:
+                query_params['style'] = style
+        if timeout is not None and 'timeout' in query_args:
+            query_params['timeout'] = timeout
+        return query_params
+
+    def _wait_for_engines(self, jobs, timeout=None):
+        """Wait for the quorum of engines to return results or the timeout to
+        expire, returning a dict of {engine: results} in the order of
+        `self.searchers`"""
+        quorum = self.quorum
+        if quorum <= 0 or quorum > len(jobs):
+            quorum = len(jobs)
+        if timeout is None:
+            timeout = self.timeout
+        deadline = None
+        if timeout > 0:
+            deadline = time.time() + timeout
+
+        engine_results = dict()
+        job_engines = dict((job, engine) for engine, job in jobs.items())
+        pending = set(jobs.values())
+        while pending and len(engine_results) < quorum:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0.0:
+                    break
+            done = gevent.wait(list(pending), timeout=remaining, count=1)
+            if not done:
+                break
+            for job in done:
+                pending.discard(job)
+                engine = job_engines[job]
+                if job.successful() and job.value:
+                    engine_results[engine] = job.value
+                else:
+                    log.info('No results from engine %s (%s)', engine, job.exception)
+
+        if pending:
+            log.info('Discarding results of %d engines not yet returned', len(pending))
+            # stop them from holding on to request slots needed by other queries
+            gevent.killall(list(pending), block=False)
+
+        return OrderedDict((engine, engine_results[engine]) for engine in jobs
+                           if engine in engine_results)
+
+    def _fuse_rankings(self, engine_results):
+        # merged results in order of first appearance, for tie-breaking
+        fused = []
+        by_url = dict()
+        by_image_id = dict()
+        for engine, results in engine_results.items():
+            for rank, result in enumerate(results, 1):
+                entry = by_url.get(result['url'])
+                if entry is None and result.get('image_id'):
+                    entry = by_image_id.get(result['image_id'])
+                if entry is None:
+                    entry = dict(result=dict(result, engines=[]), score=0.0)
+                    fused.append(entry)
+                    by_url[result['url']] = entry
+                    if result.get('image_id'):
+                        by_image_id[result['image_id']] = entry
+                by_url.setdefault(result['url'], entry)
+                if engine in entry['result']['engines']:
+                    # the same image returned more than once by an engine
+                    continue
+                entry['result']['engines'].append(engine)
+                entry['score'] += 1.0/(self.rrf_k + rank)
+
+        fused.sort(key=lambda entry: entry['score'], reverse=True)
+        results = [entry['result'] for entry in fused]
+        for rank, result in enumerate(results, 1):
+            # replace the rank given by an engine with the merged rank
+            if 'rank' in result:
+                result['rank'] = rank
+        return results
+
+    @staticmethod
+    def _union(key_lists):
+        union = []
+        for keys in key_lists:
+            union.extend(key for key in keys if key not in union)
+        return union
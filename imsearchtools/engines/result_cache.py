@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+"""
+Module: result_cache
+Created on: 18 Oct 2026
+
+Caching of raw search engine results, used by SearchClient to avoid
+re-issuing identical queries to the remote engine
+"""
+
+import time
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from hashlib import sha1
+
+## Storage Backends
+#  --------------------------------------------
+
+class SqliteCacheStore(object):
+    """Persistent on-disk store for ResultCache, backed by an sqlite database
+
+    Entries are stored as JSON along with the time at which they were added.
+    Keys are hashed before storage, so no query parameters (including API keys)
+    are written to disk in plaintext.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS results '
+                               '(key TEXT PRIMARY KEY, stored REAL, value TEXT)')
+
+    def get(self, key):
+        """Returns a (stored_time, value) tuple or None if key not present"""
+        with self._lock:
+            row = self._conn.execute('SELECT stored, value FROM results WHERE key = ?',
+                                     (self._hash_key(key),)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def set(self, key, stored, value):
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                               (self._hash_key(key), stored, json.dumps(value)))
+
+    def delete(self, key):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM results WHERE key = ?',
+                               (self._hash_key(key),))
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM results')
+
+    def _hash_key(self, key):
+        return sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+## Cache Class
+#  --------------------------------------------
+
+class ResultCache(object):
+    """In-memory LRU cache of search results with expiry, optionally backed by
+    a persistent store (e.g. SqliteCacheStore)
+
+    Initializer Args:
+        [max_entries]: maximum number of entries kept in memory before the least
+            recently used entry is evicted
+        [ttl]: time in seconds after which an entry expires (-1 = never)
+        [store]: optional persistent store consulted on a memory miss and
+            written through on every `set()`
+
+    Keys must be hashable and values JSON-serializable if a persistent store is
+    used. Values are returned as shallow copies of each result dict, so callers
+    are free to annotate the results they receive.
+    """
+
+    def __init__(self, max_entries=1024, ttl=3600.0, store=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.store = store
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def stats(self):
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions,
+                    expirations=self.expirations,
+                    entries=len(self._entries))
+
+    def get(self, key):
+        """Returns the cached value for key, or None if missing or expired"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._expired(entry[0], now):
+                    del self._entries[key]
+                    self.expirations += 1
+                    entry = None
+                else:
+                    self._entries.move_to_end(key)
+
+        if entry is None and self.store is not None:
+            entry = self.store.get(key)
+            if entry is not None:
+                if self._expired(entry[0], now):
+                    self.store.delete(key)
+                    with self._lock:
+                        self.expirations += 1
+                    entry = None
+                else:
+                    self._insert(key, entry)
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return self._copy_value(entry[1])
+
+    def set(self, key, value):
+        entry = (time.time(), self._copy_value(value))
+        self._insert(key, entry)
+        if self.store is not None:
+            self.store.set(key, entry[0], entry[1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.store is not None:
+            self.store.clear()
+
+    def _insert(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _expired(self, stored, now):
+        return self.ttl >= 0 and now - stored > self.ttl
+
+    def _copy_value(self, value):
+        return [dict(item) for item in value]
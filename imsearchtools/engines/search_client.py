@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 
+import time
 import gevent
 
+from .throttle import get_engine_throttle
+from .latency import get_latency_tracker
+
 class QueryException(Exception):
     pass
 
@@ -27,15 +31,27 @@ class SearchClient(object):
      + async_query (Bool)
           make queries asynchronously or not
      + timeout (Float)
-          timeout in seconds for HTTP requests
+          timeout in seconds for fetching all pages of results for a query
+    OPTIONAL PROPERTIES:
+     + result_cache (ResultCache)
+          cache used to serve repeated queries without contacting the engine
+          (defaults to the process-wide cache set using `set_result_cache()`)
+     + hedge_percentile (Float)
+          if a page of results has not been returned within this percentile
+          of the engine's recent page latencies, a duplicate request is made
+          and whichever returns first is used (-1 = never)
     METHODS:
      + def _fetch_results_from_offset(self, query, result_offset,
                                       aux_params={}, headers={},
-                                      num_results=-1)
+                                      num_results=-1, timeout=None)
           this method should return a set of results given an offset from the
-          first result and a count of results to return
+          first result and a count of results to return, giving up on the
+          request after timeout seconds (None = no timeout)
     """
 
+    result_cache = None
+    hedge_percentile = 95.0
+
     @property
     def supported_sizes(self):
         return self._supported_sizes_map.keys()
@@ -62,7 +78,8 @@ class SearchClient(object):
 
     def _fetch_results(self, query, num_results,
                        aux_params={},
-                       headers={}):
+                       headers={},
+                       timeout=None):
         """Routine for fetching results from server using multiple requests.
 
         Parameters:
@@ -76,33 +93,153 @@ class SearchClient(object):
                 func(self, query, result_offset[, num_results, aux_params, headers])
         - [aux_params, headers]
             optional parameter/header arguments
+        - [timeout]
+            timeout in seconds for this query, overriding self.timeout
         """
+        offsets = list(range(0, num_results, self._results_per_req))
+
+        # results are cached per page, so that a request for more results than
+        # previously can reuse the pages already fetched (and a request for
+        # fewer can be served by slicing them)
+        # (take key before aux_params are modified by the per-offset fetches)
+        page_key = self._result_cache_key(query, aux_params)
+        pages = dict()
+        if self.result_cache is not None:
+            for result_offset in offsets:
+                page = self.result_cache.get(page_key + (result_offset,))
+                if page is not None:
+                    pages[result_offset] = page[:(num_results-result_offset)]
+
+        missing_offsets = [result_offset for result_offset in offsets
+                           if result_offset not in pages]
+        if missing_offsets:
+            fetched_pages = self._fetch_pages(query, missing_offsets, num_results,
+                                              aux_params, headers, timeout)
+            for result_offset, page in fetched_pages.items():
+                if self.result_cache is not None and page:
+                    self.result_cache.set(page_key + (result_offset,), page)
+                pages[result_offset] = page[:(num_results-result_offset)]
+
+        results = []
+
+        for result_offset in offsets:
+            if pages.get(result_offset):
+                results.extend(pages[result_offset])
+
+        if not results:
+            raise QueryException("No image URLs could be retrieved")
+
+        return results
+
+    def _fetch_pages(self, query, offsets, num_results, aux_params, headers,
+                     timeout=None):
+        """Fetch the pages of results starting at each of offsets, returning
+        a dict of {result_offset: results}"""
+        # when caching, always retrieve complete pages so they can be reused
+        # by later queries for a larger number of results
+        def page_num_results(result_offset):
+            if self.result_cache is not None:
+                return result_offset + self._results_per_req
+            return num_results
+
+        # each page request is given the time remaining until the deadline
+        if timeout is None:
+            timeout = self.timeout
+        deadline = None
+        if timeout > 0:
+            deadline = time.time() + timeout
+
+        pages = dict()
+
         if self.async_query:
-            jobs = [gevent.spawn(self._fetch_results_from_offset,
-                                 query, result_offset,
+            jobs = [gevent.spawn(self._fetch_hedged_page,
+                                 query, result_offset, deadline,
                                  aux_params=aux_params,
                                  headers=headers,
-                                 num_results=num_results)
-                    for result_offset in range(0, num_results, self._results_per_req)]
+                                 num_results=page_num_results(result_offset))
+                    for result_offset in offsets]
 
-            gevent.joinall(jobs, timeout=self.timeout)
+            gevent.joinall(jobs, timeout=(None if deadline is None else
+                                          max(deadline - time.time(), 0.0)))
+            # results from timed out pages are discarded, so stop them from
+            # holding on to request slots needed by other queries
+            gevent.killall([job for job in jobs if not job.ready()], block=False)
 
-            results = []
-
-            for job in jobs:
+            for result_offset, job in zip(offsets, jobs):
                 if job.value:
-                    results.extend(job.value)
+                    pages[result_offset] = job.value
         else:
-            results = []
-
-            for result_offset in range(0, num_results, self._results_per_req):
-                results.extend(self._fetch_results_from_offset(query,
+            for result_offset in offsets:
+                pages[result_offset] = self._fetch_hedged_page(query,
                                                                result_offset,
+                                                               deadline,
                                                                aux_params=aux_params,
                                                                headers=headers,
-                                                               num_results=num_results))
+                                                               num_results=page_num_results(result_offset))
+
+        return pages
+
+    def _fetch_hedged_page(self, query, result_offset, deadline, **kwargs):
+        """Fetch a page of results, making a second (hedged) request for the
+        page if the first is slower than most recent requests to the engine"""
+        hedge_delay = None
+        if self.hedge_percentile > 0:
+            hedge_delay = get_latency_tracker(self.__class__).percentile(self.hedge_percentile)
+        if hedge_delay is None:
+            return self._fetch_page(query, result_offset, deadline, **kwargs)
+
+        attempts = [gevent.spawn(self._fetch_page, query, result_offset, deadline, **kwargs)]
+        try:
+            attempts[0].join(timeout=hedge_delay)
+            if not attempts[0].ready():
+                attempts.append(gevent.spawn(self._fetch_page, query, result_offset,
+                                             deadline, **kwargs))
+            # use whichever request returns results first
+            pending = list(attempts)
+            while pending:
+                done = gevent.wait(pending, count=1)
+                for attempt in done:
+                    pending.remove(attempt)
+                    if attempt.successful() and attempt.value:
+                        return attempt.value
+            # neither returned any results
+            return attempts[0].get()
+        finally:
+            gevent.killall([attempt for attempt in attempts if not attempt.ready()],
+                           block=False)
+
+    def _fetch_page(self, query, result_offset, deadline=None, **kwargs):
+        # requests are throttled per engine across all clients in the process
+        throttle = get_engine_throttle(self.__class__)
+        if throttle is None:
+            return self._fetch_page_by_deadline(query, result_offset, deadline, **kwargs)
+        with throttle:
+            return self._fetch_page_by_deadline(query, result_offset, deadline, **kwargs)
+
+    def _fetch_page_by_deadline(self, query, result_offset, deadline, **kwargs):
+        # time spent waiting for the throttle counts against the deadline
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - time.time()
+            if timeout <= 0.0:
+                return []
+        start_time = time.time()
+        results = self._fetch_results_from_offset(query, result_offset,
+                                                  timeout=timeout, **kwargs)
+        if results:
+            get_latency_tracker(self.__class__).record(time.time() - start_time)
+        return results
 
-        if not results:
-            raise QueryException("No image URLs could be retrieved")
+    def _result_cache_key(self, query, aux_params):
+        # native size and style are encoded within the engine-specific aux_params
+        return (self.__class__.__name__, query,
+                tuple(sorted(aux_params.items())))
 
-        return results
+
+def set_result_cache(cache):
+    """Set the result cache shared by all search clients in the process
+
+    Args:
+        cache: a ResultCache instance, or None to disable caching
+    """
+    SearchClient.result_cache = cache
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""
+Module: throttle
+Created on: 18 Oct 2026
+
+Per-engine request throttling, shared by all search clients of the same
+engine within a process
+"""
+
+import time
+import gevent
+from gevent.lock import BoundedSemaphore
+
+DEFAULT_REQUESTS_PER_SEC = 5.0
+DEFAULT_BURST = 10
+DEFAULT_MAX_IN_FLIGHT = 8
+
+class TokenBucket(object):
+    """Token bucket rate limiter for use from greenlets
+
+    Initializer Args:
+        rate: rate at which tokens are added to the bucket (per second)
+        burst: maximum number of tokens which can be held by the bucket
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._last_update = time.time()
+
+    def acquire(self):
+        """Take a token from the bucket, sleeping until one is available"""
+        while True:
+            now = time.time()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last_update)*self.rate)
+            self._last_update = now
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return
+            gevent.sleep((1.0 - self._tokens)/self.rate)
+
+
+class EngineThrottle(object):
+    """Limits the rate and concurrency of requests made to a single engine
+
+    Initializer Args:
+        [requests_per_sec]: sustained rate of requests (-1 = unlimited)
+        [burst]: number of requests which can be made in a burst before the
+            rate limit applies
+        [max_in_flight]: maximum number of requests in progress at once
+            (-1 = unlimited)
+
+    Use as a context manager around each request:
+
+        with throttle:
+            resp = session.get(...)
+    """
+
+    def __init__(self, requests_per_sec=DEFAULT_REQUESTS_PER_SEC,
+                 burst=DEFAULT_BURST, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        self.max_in_flight = max_in_flight
+        self._bucket = None
+        if requests_per_sec > 0:
+            self._bucket = TokenBucket(requests_per_sec, burst)
+        self._in_flight = None
+        if max_in_flight > 0:
+            self._in_flight = BoundedSemaphore(max_in_flight)
+
+    def acquire(self):
+        # wait for a free request slot before waiting for the rate limit, so
+        # that requests are released at the sustained rate rather than in bursts
+        if self._in_flight is not None:
+            self._in_flight.acquire()
+        if self._bucket is not None:
+            try:
+                self._bucket.acquire()
+            except BaseException:
+                self.release()
+                raise
+
+    def release(self):
+        if self._in_flight is not None:
+            self._in_flight.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+_engine_throttles = dict()
+
+def get_engine_throttle(engine_cls):
+    """Returns the throttle shared by all search clients of class engine_cls,
+    creating one with default settings if none has been set"""
+    if engine_cls.__name__ not in _engine_throttles:
+        _engine_throttles[engine_cls.__name__] = EngineThrottle()
+    return _engine_throttles[engine_cls.__name__]
+
+def set_engine_throttle(engine_cls, throttle):
+    """Set the throttle shared by all search clients of class engine_cls
+
+    Args:
+        engine_cls: the search client class e.g. GoogleWebSearch
+        throttle: an EngineThrottle instance, or None to disable throttling
+    """
+    _engine_throttles[engine_cls.__name__] = throttle
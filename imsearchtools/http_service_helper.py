@@ -1,32 +1,121 @@
 #!/usr/bin/env python
 
 import os
+import time
+import uuid
+import logging
+from collections import OrderedDict
+from multiprocessing import cpu_count
 
+import gevent
 from flask import request
+from requests.adapters import HTTPAdapter
 
 from imsearchtools import query as image_query
 from imsearchtools import process as image_process
 from imsearchtools import postproc_modules
+from imsearchtools.process.callback_backends import get_callback_backend_list
 
 
+SEARCH_ENGINES = {'bing_api': image_query.BingAPISearch,
+                  'google_old_api': image_query.GoogleOldAPISearch,
+                  'google_api': image_query.GoogleAPISearch,
+                  'google_web': image_query.GoogleWebSearch,
+                  'flickr_api': image_query.FlickrAPISearch}
+
+# engines queried by the 'multi' engine (those without API credentials are
+# skipped), and the number of them which must return before merging results
+MULTI_ENGINES = ['google_web', 'bing_api', 'flickr_api']
+MULTI_ENGINE_QUORUM = -1
+
+# number of keep-alive connections retained per engine host
+# (used when throttling of the engine has been disabled)
+SEARCHER_POOL_MAXSIZE = 10
+
+_searchers = dict()
+
+# results of the engine queries made by the service are cached in memory (see
+# `ResultCache`) and, if RESULT_CACHE_DB_FN is set, in an sqlite database on
+# disk. The cache is set up once by `setup_result_cache` when the service starts
+RESULT_CACHE_ENABLED = True
+RESULT_CACHE_MAX_ENTRIES = 1024
+RESULT_CACHE_TTL = 3600.0
+RESULT_CACHE_DB_FN = None
+
+# downloaded images are deduplicated using a content store within each output
+# directory, shared by all requests downloading to that directory
+CONTENT_STORE_SUBDIR = '.store'
+
+_content_stores = dict()
+
+# file listing the SHA-256 digests of images rejected for every request (see
+# `ImageProcessorSettings.load_hash_blacklist`), read once by
+# `load_hash_blacklist` when the service starts (None = no blacklist)
+HASH_BLACKLIST_FN = None
+
+_hash_blacklist = set()
+
+# jobs started by `start_pipeline_job` are retained (once finished) for at most
+# this many seconds, and only the most recent of them are kept
+JOB_RETENTION = 3600.0
+MAX_RETAINED_JOBS = 100
+
+log = logging.getLogger(__name__)
+
+def get_searcher(engine):
+    """Returns a long-lived search client for engine, shared between requests
+    so that keep-alive connections to the engine are reused (the timeout of
+    each query is passed to the client's `query` method)"""
+    if engine == 'multi':
+        return get_multi_searcher(MULTI_ENGINES)
+    if engine not in SEARCH_ENGINES:
+        raise ValueError('Unkown query engine')
+    if engine not in _searchers:
+        searcher_cls = SEARCH_ENGINES[engine]
+        searcher = searcher_cls()
+        # size the connection pool to match the number of requests which can
+        # be in flight to the engine at once
+        pool_maxsize = SEARCHER_POOL_MAXSIZE
+        throttle = image_query.get_engine_throttle(searcher_cls)
+        if throttle is not None and throttle.max_in_flight > 0:
+            pool_maxsize = throttle.max_in_flight
+        adapter = HTTPAdapter(pool_maxsize=pool_maxsize)
+        searcher.mount('http://', adapter)
+        searcher.mount('https://', adapter)
+        _searchers[engine] = searcher
+    return _searchers[engine]
+
+def setup_result_cache():
+    """Set the result cache shared by all search clients of the service from
+    the RESULT_CACHE_* settings, returning it (None if caching is disabled)"""
+    cache = None
+    if RESULT_CACHE_ENABLED:
+        store = None
+        if RESULT_CACHE_DB_FN is not None:
+            store = image_query.SqliteCacheStore(RESULT_CACHE_DB_FN)
+        cache = image_query.ResultCache(max_entries=RESULT_CACHE_MAX_ENTRIES,
+                                        ttl=RESULT_CACHE_TTL, store=store)
+    image_query.set_result_cache(cache)
+    return cache
+
+def get_multi_searcher(engines, quorum=MULTI_ENGINE_QUORUM):
+    """Returns a long-lived search client querying each of engines concurrently
+    and merging their results (see `MultiEngineSearch`)"""
+    searcher_key = ('multi', tuple(engines), quorum)
+    if searcher_key not in _searchers:
+        searchers = []
+        for engine in engines:
+            try:
+                searchers.append((engine, get_searcher(engine)))
+            except image_query.NoAPICredentials:
+                log.info('Not querying %s in multi-engine search (no API credentials)', engine)
+        _searchers[searcher_key] = image_query.MultiEngineSearch(searchers, quorum=quorum)
+    return _searchers[searcher_key]
+
 def imsearch_query(query, engine, query_params, query_timeout=-1.0):
-    # prepare input arguments for searcher initialization if non-default
-    searcher_args = dict()
+    searcher = get_searcher(engine)
     if query_timeout > 0.0:
-        searcher_args['timeout'] = query_timeout
-    # initialize searcher
-    if engine == 'bing_api':
-        searcher = image_query.BingAPISearch(**searcher_args)
-    elif engine == 'google_old_api':
-        searcher = image_query.GoogleOldAPISearch(**searcher_args)
-    elif engine == 'google_api':
-        searcher = image_query.GoogleAPISearch(**searcher_args)
-    elif engine == 'google_web':
-        searcher = image_query.GoogleWebSearch(**searcher_args)
-    elif engine == 'flickr_api':
-        searcher = image_query.FlickrAPISearch(**searcher_args)
-    else:
-        raise ValueError('Unkown query engine')
+        query_params = dict(query_params, timeout=query_timeout)
     # execute the query
     return searcher.query(query, **query_params)
 
@@ -35,24 +124,49 @@ def imsearch_download_to_static(query_res_list, postproc_module=None,
                                 custom_local_path=None,
                                 imgetter_params=None,
                                 zmq_context=None):
+    imgetter, outdir, process_args = _prepare_download(postproc_module,
+                                                       postproc_extra_prms,
+                                                       custom_local_path,
+                                                       imgetter_params,
+                                                       zmq_context)
+    return imgetter.process_urls(query_res_list, outdir, **process_args)
+
+def imsearch_iter_download_to_static(query_res_list, postproc_module=None,
+                                     postproc_extra_prms=None,
+                                     custom_local_path=None,
+                                     imgetter_params=None,
+                                     zmq_context=None):
+    """As `imsearch_download_to_static`, but returns a generator yielding each
+    downloaded image as soon as it is ready"""
+    imgetter, outdir, process_args = _prepare_download(postproc_module,
+                                                       postproc_extra_prms,
+                                                       custom_local_path,
+                                                       imgetter_params,
+                                                       zmq_context)
+    return imgetter.iter_process_urls(query_res_list, outdir, **process_args)
+
+def _prepare_download(postproc_module, postproc_extra_prms, custom_local_path,
+                      imgetter_params, zmq_context):
     # prepare extra parameters if required
-    ig_params = dict()
+    improc_settings = image_process.ImageProcessorSettings()
+    # the blacklist is shared by all requests rather than copied for each
+    improc_settings.filter['blacklist_hashes'] = _hash_blacklist
+    ig_params = dict(opts=improc_settings)
     if imgetter_params:
         if 'improc_timeout' in imgetter_params and imgetter_params['improc_timeout'] > 0.0:
             ig_params['timeout'] = imgetter_params['improc_timeout']
         if 'per_image_timeout' in imgetter_params and imgetter_params['per_image_timeout'] > 0.0:
             ig_params['image_timeout'] = imgetter_params['per_image_timeout']
+        if 'postproc_timeout' in imgetter_params:
+            ig_params['completion_timeout'] = imgetter_params['postproc_timeout']
+        if 'postproc_idle_timeout' in imgetter_params:
+            ig_params['completion_idle_timeout'] = imgetter_params['postproc_idle_timeout']
         do_width_resize = ('resize_width' in imgetter_params and imgetter_params['resize_width'] > 0)
         do_height_resize = ('resize_height' in imgetter_params and imgetter_params['resize_height'] > 0)
-        if do_width_resize or do_height_resize:
-            improc_settings = image_process.ImageProcessorSettings()
-            if do_width_resize:
-                improc_settings.conversion['max_width'] = imgetter_params['resize_width']
-            if do_height_resize:
-                improc_settings.conversion['max_height'] = imgetter_params['resize_height']
-            ig_params['opts'] = improc_settings
-
-    imgetter = image_process.ImageGetter(**ig_params)
+        if do_width_resize:
+            improc_settings.conversion['max_width'] = imgetter_params['resize_width']
+        if do_height_resize:
+            improc_settings.conversion['max_height'] = imgetter_params['resize_height']
 
     if not custom_local_path:
         outdir = os.path.join(os.getcwd(), 'static')
@@ -61,10 +175,22 @@ def imsearch_download_to_static(query_res_list, postproc_module=None,
     if not os.path.isdir(outdir):
         os.makedirs(outdir)
 
+    ig_params['content_store'] = get_content_store(outdir)
+    imgetter = image_process.ImageGetter(**ig_params)
+
+    completion_backend = imgetter.completion_backend
+    if imgetter_params and 'postproc_backend' in imgetter_params:
+        completion_backend = imgetter_params['postproc_backend']
+
     # add zmq context and socket as extra parameter if required
     if type(postproc_extra_prms) is not dict: postproc_extra_prms = {}
     if zmq_context:
-        postproc_extra_prms['zmq_context'] = zmq_context
+        if completion_backend == 'process':
+            # extra parameters are pickled to send them to the worker processes,
+            # which a zmq context can't be (the workers use their own context)
+            log.info('Not passing zmq context to postproc module run by process backend')
+        else:
+            postproc_extra_prms['zmq_context'] = zmq_context
     # *** pre-creating a connection seems to cause the gevent threads to hang on joining so disable for now ***
     #if 'zmq_impath_return_ch' in postproc_extra_prms and 'zmq_context' in postproc_extra_prms
     #    import zmq
@@ -74,28 +200,218 @@ def imsearch_download_to_static(query_res_list, postproc_module=None,
 
     # if a postprocessing module is defined, find the callback function
     # of the module
+    process_args = dict()
     if postproc_module:
-        callback_func = postproc_modules.get_module_callback(postproc_module)
+        process_args['completion_func'] = postproc_modules.get_module_callback(postproc_module)
         if postproc_extra_prms:
-            return imgetter.process_urls(query_res_list, outdir, callback_func,
-                                         completion_extra_prms=postproc_extra_prms)
-        else:
-            return imgetter.process_urls(query_res_list, outdir, callback_func)
-    else:
-        return imgetter.process_urls(query_res_list, outdir)
+            process_args['completion_extra_prms'] = postproc_extra_prms
+        process_args['completion_backend'] = completion_backend
+        # a callback whose request is batched by the postproc module (see
+        # postproc_modules._visor_backend) holds its worker until the batch is
+        # sent, so there must be enough workers for a batch to fill while the
+        # previous one is in flight (the fabric of the 'zmq' backend grows to
+        # match, but batches are never shared between the worker processes of
+        # the 'process' backend, so it is left as is)
+        batch_size = int(postproc_extra_prms.get('batch_size', 1))
+        if batch_size > 1 and completion_backend != 'process':
+            process_args['completion_worker_count'] = max(cpu_count(), 2*batch_size)
 
-def make_url_dfiles_list(dfiles_list):
-    cwd = os.getcwd()
+    return imgetter, outdir, process_args
+
+def get_content_store(outdir):
+    if outdir not in _content_stores:
+        _content_stores[outdir] = image_process.ContentStore(os.path.join(outdir,
+                                                                          CONTENT_STORE_SUBDIR))
+    return _content_stores[outdir]
+
+def load_hash_blacklist(fn=None):
+    """Load the digests listed in file fn (by default HASH_BLACKLIST_FN) into
+    the blacklist applied to the images downloaded for every request"""
+    if fn is None:
+        fn = HASH_BLACKLIST_FN
+    if fn is None:
+        return
+    settings = image_process.ImageProcessorSettings()
+    settings.load_hash_blacklist(fn)
+    _hash_blacklist.clear()
+    _hash_blacklist.update(settings.filter['blacklist_hashes'])
+    log.info('Loaded %d blacklisted image digests from %s', len(_hash_blacklist), fn)
+
+def make_url_dfiles_list(dfiles_list, host=None):
     # recast local fs image paths as server paths using hostname from request
     for dfile_ifo in dfiles_list:
-        dfile_ifo['orig_fn'] = 'http://' + request.host + dfile_ifo['orig_fn'].replace(cwd, '')
-        dfile_ifo['thumb_fn'] = 'http://' + request.host + dfile_ifo['thumb_fn'].replace(cwd, '')
-        dfile_ifo['clean_fn'] = 'http://' + request.host + dfile_ifo['clean_fn'].replace(cwd, '')
+        make_url_dfile(dfile_ifo, host)
     return dfiles_list
 
+def make_url_dfile(dfile_ifo, host=None):
+    # host must be given if called outside of a request
+    if host is None:
+        host = request.host
+    cwd = os.getcwd()
+    if dfile_ifo['orig_fn'] is not None:
+        dfile_ifo['orig_fn'] = 'http://' + host + dfile_ifo['orig_fn'].replace(cwd, '')
+    dfile_ifo['thumb_fn'] = 'http://' + host + dfile_ifo['thumb_fn'].replace(cwd, '')
+    dfile_ifo['thumb_fns'] = ['http://' + host + thumb_fn.replace(cwd, '')
+                              for thumb_fn in dfile_ifo['thumb_fns']]
+    dfile_ifo['clean_fn'] = 'http://' + host + dfile_ifo['clean_fn'].replace(cwd, '')
+    return dfile_ifo
+
+
+class PipelineJob(object):
+    """Progress and results of a query + download job run in the background
+
+    Initializer Args:
+        query: the query text
+        [return_dfiles_list]: whether to report the downloaded images
+
+    `status` moves from 'queued' to 'querying', 'downloading' and finally
+    either 'done' or 'failed' (in which case `error` describes the failure).
+    """
+
+    def __init__(self, query, return_dfiles_list=True):
+        self.job_id = uuid.uuid4().hex
+        self.query = query
+        self.return_dfiles_list = return_dfiles_list
+        self.status = 'queued'
+        self.error = None
+        self.queried = 0
+        self.dfiles_list = []
+        self.finish_time = None
+        # image counts are read from the ImageGetter while the job runs, and
+        # copied once it finishes so that the ImageGetter can be released
+        self.counts = dict(downloaded=0, processed=0, failed=0)
+        self._imgetter = None
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    def to_dict(self):
+        counts = self.counts
+        if self._imgetter is not None:
+            counts = self._imgetter.stats
+        job_dict = dict(job_id=self.job_id,
+                        query=self.query,
+                        status=self.status,
+                        queried=self.queried,
+                        **counts)
+        if self.error is not None:
+            job_dict['error'] = self.error
+        if self.return_dfiles_list:
+            # a copy, as the list grows while the job is running
+            job_dict['dfiles_list'] = list(self.dfiles_list)
+        return job_dict
+
+
+class JobTable(object):
+    """Table of background jobs, retaining finished jobs for a limited time
+
+    Initializer Args:
+        [retention]: time in seconds for which finished jobs are kept
+            (-1 = unlimited)
+        [max_jobs]: maximum number of finished jobs kept (-1 = unlimited)
+
+    Running jobs are always kept. Once finished jobs exceed either limit, the
+    jobs which finished earliest are dropped.
+    """
+
+    def __init__(self, retention=JOB_RETENTION, max_jobs=MAX_RETAINED_JOBS):
+        self.retention = retention
+        self.max_jobs = max_jobs
+        self._jobs = dict()
+        # job_id -> job, in order of finishing
+        self._finished = OrderedDict()
+
+    def add(self, job):
+        self._prune()
+        self._jobs[job.job_id] = job
+
+    def get(self, job_id):
+        """Returns the job with job_id, or None if it is unknown or has been
+        dropped"""
+        self._prune()
+        return self._jobs.get(job_id)
+
+    def finish(self, job):
+        job.finish_time = time.time()
+        self._finished[job.job_id] = job
+        self._prune()
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def _prune(self):
+        now = time.time()
+        while self._finished:
+            job_id, job = next(iter(self._finished.items()))
+            expired = self.retention > 0 and now - job.finish_time > self.retention
+            overflow = self.max_jobs > 0 and len(self._finished) > self.max_jobs
+            if not (expired or overflow):
+                break
+            del self._finished[job_id]
+            del self._jobs[job_id]
+
+
+_job_table = JobTable()
+
+def start_pipeline_job(query, engine, query_params, query_timeout=-1.0,
+                       postproc_module=None, postproc_extra_prms=None,
+                       custom_local_path=None, imgetter_params=None,
+                       zmq_context=None, return_dfiles_list=True):
+    """Run the query and download stages of `exec_pipeline` in the background,
+    returning the PipelineJob used to track their progress (which can later be
+    retrieved by its ID using `get_job`)"""
+    job = PipelineJob(query, return_dfiles_list)
+    # paths are converted to URLs using the host of the starting request, as
+    # the job outlives it
+    host = None if custom_local_path else request.host
+    _job_table.add(job)
+    gevent.spawn(_run_pipeline_job, job, host, engine, query_params, query_timeout,
+                 postproc_module, postproc_extra_prms, custom_local_path,
+                 imgetter_params, zmq_context)
+    return job
+
+def get_job(job_id):
+    return _job_table.get(job_id)
+
+def _run_pipeline_job(job, host, engine, query_params, query_timeout,
+                      postproc_module, postproc_extra_prms, custom_local_path,
+                      imgetter_params, zmq_context):
+    try:
+        job.status = 'querying'
+        query_res_list = imsearch_query(job.query, engine, query_params, query_timeout)
+        job.queried = len(query_res_list)
+        job.status = 'downloading'
+        if query_res_list:
+            imgetter, outdir, process_args = _prepare_download(postproc_module,
+                                                               postproc_extra_prms,
+                                                               custom_local_path,
+                                                               imgetter_params,
+                                                               zmq_context)
+            job._imgetter = imgetter
+            for dfile_ifo in imgetter.iter_process_urls(query_res_list, outdir,
+                                                        **process_args):
+                if host is not None:
+                    dfile_ifo = make_url_dfile(dfile_ifo, host)
+                job.dfiles_list.append(dfile_ifo)
+        job.status = 'done'
+    except Exception as e:
+        log.exception('Error running job %s', job.job_id)
+        job.status = 'failed'
+        job.error = str(e)
+    finally:
+        # release the ImageGetter (and its connections) while the job is retained
+        if job._imgetter is not None:
+            job.counts = job._imgetter.stats
+            job._imgetter = None
+        _job_table.finish(job)
+
 def get_postproc_modules():
     return postproc_modules.get_module_list()
 
+def get_postproc_backends():
+    return get_callback_backend_list()
+
 def test_callback():
     cbhandler = image_process.CallbackHandler(test_func, 100, 50)
     for i in range(0,100):
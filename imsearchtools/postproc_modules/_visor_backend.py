@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+
+"""
+Module: _visor_backend
+Created on: 18 Oct 2026
+
+Connections to the VISOR backend and ZMQ return channels shared by the
+postproc modules (not itself a postproc module)
+"""
+
+import time
+import struct
+import socket
+import select
+from flask import json
+import zmq.green as zmq
+import gevent
+from gevent.event import AsyncResult
+
+import logging
+log = logging.getLogger(__name__)
+
+TCP_TERMINATOR = b"$$$"
+TCP_TIMEOUT = 86400.00
+# framing of messages to and from the backend (see FramedSocketReader)
+FRAMING_TERMINATOR = 'terminator'
+FRAMING_LENGTH = 'length'
+LENGTH_PREFIX = struct.Struct('>I')
+RECV_SIZE = 65536
+# maximum number of idle connections kept open to each backend
+MAX_IDLE_CONNECTIONS = 8
+# maximum time to wait for a batch of requests to fill before sending it
+DEFAULT_BATCH_DELAY_MS = 50
+
+class BackendConnectionPool(object):
+    """Pool of persistent TCP connections to a single VISOR backend
+
+    Initializer Args:
+        host: the hostname of the backend
+        port: the port of the backend
+        [max_idle]: maximum number of idle connections kept open
+        [framing]: the framing of messages sent to and received from the
+            backend (FRAMING_TERMINATOR or FRAMING_LENGTH)
+
+    Connections are checked before reuse, and closed rather than returned to
+    the pool if a request on them fails. A request which fails on a reused
+    connection before the backend could have replied to it (the request could
+    not be sent, or the connection was closed before any reply was received -
+    e.g. as the backend has since closed it) is retried once on a new
+    connection. Requests are never retried after a timeout or part of a
+    reply, as the backend may already be processing them.
+    """
+
+    def __init__(self, host, port, max_idle=MAX_IDLE_CONNECTIONS,
+                 framing=FRAMING_TERMINATOR):
+        self.host = host
+        self.port = port
+        self.max_idle = max_idle
+        self.framing = framing
+        # FramedSocketReader for each idle connection
+        self._idle = []
+
+    def request(self, func_in, timeout=TCP_TIMEOUT):
+        """Send the JSON-serializable request func_in to the backend, returning
+        the response (without framing)"""
+        request = frame_message(json.dumps(func_in).encode('utf-8'), self.framing)
+        conn = self._checkout()
+        if conn is not None:
+            try:
+                return self._request_on(conn, request, timeout, reused=True)
+            except _StaleConnection:
+                log.info('Reused connection to %s:%d was closed - reconnecting',
+                         self.host, self.port)
+        log.debug('Connecting to backend %s:%d...', self.host, self.port)
+        sock = socket.create_connection((self.host, self.port))
+        return self._request_on(FramedSocketReader(sock, self.framing), request, timeout)
+
+    def close(self):
+        while self._idle:
+            self._idle.pop().sock.close()
+
+    def _request_on(self, conn, request, timeout, reused=False):
+        try:
+            conn.sock.settimeout(timeout)
+            try:
+                conn.sock.sendall(request)
+            except socket.timeout:
+                raise
+            except socket.error as e:
+                # the backend can't act on a request it didn't fully receive
+                if reused:
+                    raise _StaleConnection(e)
+                raise
+            try:
+                response = conn.read_message(timeout)
+            except EOFError as e:
+                if reused and not conn.buffered:
+                    raise _StaleConnection(e)
+                raise
+        except BaseException:
+            conn.sock.close()
+            raise
+        self._checkin(conn)
+        return response
+
+    def _checkout(self):
+        while self._idle:
+            conn = self._idle.pop()
+            if _is_healthy(conn):
+                return conn
+            log.debug('Dropping closed connection to %s:%d', self.host, self.port)
+            conn.sock.close()
+        return None
+
+    def _checkin(self, conn):
+        if len(self._idle) < self.max_idle:
+            self._idle.append(conn)
+        else:
+            conn.sock.close()
+
+
+class _StaleConnection(Exception):
+    """Raised when a reused connection fails before a request could have been
+    received by the backend"""
+    pass
+
+
+def _is_healthy(conn):
+    # an idle connection should have nothing to read - if it is readable, the
+    # backend has either closed it or sent unexpected data, so don't reuse it
+    if conn.buffered:
+        return False
+    try:
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (socket.error, ValueError):
+        return False
+    return not readable
+
+
+class FramedSocketReader(object):
+    """Reads framed messages from a socket into a reusable buffer
+
+    Initializer Args:
+        sock: the socket to read from
+        [framing]: FRAMING_TERMINATOR if each message is followed by
+            `terminator`, or FRAMING_LENGTH if each message is preceded by its
+            length as a 4-byte big-endian integer
+        [terminator]: the terminator of each message
+        [recv_size]: minimum number of bytes requested from each recv call
+
+    Data is received directly into a bytearray which grows as needed, and only
+    newly received data is searched for the terminator, so reading a message
+    takes time linear in its length. Any data received after the end of a
+    message is kept for the next call to `read_message()`.
+    """
+
+    def __init__(self, sock, framing=FRAMING_TERMINATOR, terminator=TCP_TERMINATOR,
+                 recv_size=RECV_SIZE):
+        if framing not in (FRAMING_TERMINATOR, FRAMING_LENGTH):
+            raise ValueError('Unknown framing: %s' % framing)
+        self.sock = sock
+        self.framing = framing
+        self.terminator = terminator
+        self.recv_size = recv_size
+        self._buf = bytearray(recv_size)
+        # received data not yet returned is held in self._buf[_start:_end]
+        self._start = 0
+        self._end = 0
+
+    @property
+    def buffered(self):
+        """Number of bytes received but not yet returned"""
+        return self._end - self._start
+
+    def read_message(self, timeout=None):
+        """Returns the next message (without framing), waiting at most timeout
+        seconds in total for it to be received"""
+        deadline = None if timeout is None else time.time() + timeout
+        if self.framing == FRAMING_LENGTH:
+            while self.buffered < LENGTH_PREFIX.size:
+                self._recv(deadline)
+            (msg_len,) = LENGTH_PREFIX.unpack_from(self._buf, self._start)
+            msg_start = self._start + LENGTH_PREFIX.size
+            while self._end - msg_start < msg_len:
+                self._recv(deadline)
+                msg_start = self._start + LENGTH_PREFIX.size
+            return self._consume(msg_start, msg_start + msg_len, msg_start + msg_len)
+
+        search_from = self._start
+        term_idx = self._buf.find(self.terminator, search_from, self._end)
+        while term_idx < 0:
+            # a terminator may straddle the old and newly received data
+            search_from = max(self._start, self._end - len(self.terminator) + 1)
+            moved = self._recv(deadline)
+            search_from -= moved
+            term_idx = self._buf.find(self.terminator, search_from, self._end)
+        return self._consume(self._start, term_idx, term_idx + len(self.terminator))
+
+    def _recv(self, deadline):
+        """Receive more data into the buffer, returning the number of bytes by
+        which buffered data was moved towards the start of the buffer"""
+        moved = self._make_space()
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout('Timed out waiting for response from backend')
+            self.sock.settimeout(remaining)
+        nbytes = self.sock.recv_into(memoryview(self._buf)[self._end:])
+        if not nbytes:
+            raise EOFError('Connection closed by backend')
+        self._end += nbytes
+        return moved
+
+    def _make_space(self):
+        if len(self._buf) - self._end >= self.recv_size:
+            return 0
+        moved = self._start
+        if moved:
+            # move buffered data to the start of the buffer
+            self._buf[:self.buffered] = self._buf[self._start:self._end]
+            self._start, self._end = 0, self._end - moved
+        if len(self._buf) - self._end < self.recv_size:
+            self._buf.extend(bytes(max(len(self._buf), self.recv_size)))
+        return moved
+
+    def _consume(self, msg_start, msg_end, frame_end):
+        msg = bytes(self._buf[msg_start:msg_end])
+        self._start = frame_end
+        if self._start == self._end:
+            self._start = self._end = 0
+        return msg
+
+
+def frame_message(msg, framing=FRAMING_TERMINATOR, terminator=TCP_TERMINATOR):
+    """Returns msg framed for sending to the backend"""
+    if framing == FRAMING_LENGTH:
+        return LENGTH_PREFIX.pack(len(msg)) + msg
+    return msg + terminator
+
+
+_backend_pools = dict()
+
+def get_backend_pool(host, port, framing=FRAMING_TERMINATOR):
+    """Returns the connection pool shared by all callbacks for the backend at
+    host:port"""
+    pool_key = (host, port, framing)
+    if pool_key not in _backend_pools:
+        _backend_pools[pool_key] = BackendConnectionPool(host, port, framing=framing)
+    return _backend_pools[pool_key]
+
+
+class RequestBatcher(object):
+    """Combines requests for single images to a VISOR backend into batches
+
+    Initializer Args:
+        backend: the BackendConnectionPool to send batches with
+        batch_size: maximum number of images in each batch
+        [batch_delay_ms]: maximum time to wait for a batch to fill
+
+    `request()` blocks until the batch containing the image has been sent and
+    its response received. A batch is sent as soon as it holds `batch_size`
+    images, or `batch_delay_ms` after its first image was added. Each batch is
+    sent as a single request of the form:
+
+        {"func": <>, "query_id": <>, "batch": [<image request>, ...]}
+
+    and the backend should reply with a JSON list holding the response for each
+    image in the batch, in order.
+    """
+
+    def __init__(self, backend, batch_size, batch_delay_ms=DEFAULT_BATCH_DELAY_MS):
+        self.backend = backend
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay_ms/1000.0
+        # (func, query_id) -> list of (image request, AsyncResult)
+        self._batches = dict()
+
+    def request(self, func, query_id, image_request, timeout=TCP_TIMEOUT):
+        """Add image_request to the next batch for (func, query_id), returning
+        the backend's response for the image"""
+        batch_key = (func, query_id)
+        result = AsyncResult()
+        if batch_key not in self._batches:
+            self._batches[batch_key] = []
+            gevent.spawn_later(self.batch_delay, self._send_batch, batch_key,
+                               self._batches[batch_key], timeout)
+        batch = self._batches[batch_key]
+        batch.append((image_request, result))
+        if len(batch) >= self.batch_size:
+            self._send_batch(batch_key, batch, timeout)
+        return result.get()
+
+    def _send_batch(self, batch_key, batch, timeout):
+        # the batch may already have been sent when full, before its delay expired
+        if self._batches.get(batch_key) is not batch:
+            return
+        del self._batches[batch_key]
+        gevent.spawn(self._request_batch, batch_key, batch, timeout)
+
+    def _request_batch(self, batch_key, batch, timeout):
+        func, query_id = batch_key
+        log.debug('Sending batch of %d requests to VISOR backend', len(batch))
+        try:
+            response = self.backend.request(dict(func=func,
+                                                 query_id=query_id,
+                                                 batch=[image_request for image_request, _ in batch]),
+                                            timeout)
+            responses = json.loads(response)
+            if not isinstance(responses, list) or len(responses) != len(batch):
+                raise ValueError('Expected a list of %d responses from backend' % len(batch))
+        except Exception as e:
+            for _, result in batch:
+                result.set_exception(e)
+            return
+        for (_, result), image_response in zip(batch, responses):
+            result.set(image_response)
+
+
+_request_batchers = dict()
+
+def get_request_batcher(host, port, batch_size, batch_delay_ms=DEFAULT_BATCH_DELAY_MS,
+                        framing=FRAMING_TERMINATOR):
+    """Returns the RequestBatcher shared by all callbacks using the backend at
+    host:port with the given batch settings"""
+    batcher_key = (host, port, batch_size, batch_delay_ms, framing)
+    if batcher_key not in _request_batchers:
+        _request_batchers[batcher_key] = RequestBatcher(get_backend_pool(host, port, framing),
+                                                        batch_size, batch_delay_ms)
+    return _request_batchers[batcher_key]
+
+
+class ReturnChannel(object):
+    """Cached ZMQ REQ sockets used to return image paths on a channel
+
+    Initializer Args:
+        channel: the ZMQ address of the channel
+        [context]: the ZMQ context used to create the sockets (a context which
+            is not a zmq.green context is shadowed by one, so that waiting for
+            a reply does not block other greenlets)
+
+    A REQ socket must alternate between sending and receiving, so concurrent
+    requests each use their own socket, taken from a pool of idle sockets. If
+    a request fails the socket is left in an unusable state, so it is closed
+    rather than returned to the pool.
+    """
+
+    def __init__(self, channel, context=None):
+        self.channel = channel
+        if context is None:
+            context = zmq.Context.instance()
+        elif not isinstance(context, zmq.Context):
+            context = zmq.Context.shadow(context.underlying)
+        self.context = context
+        self._idle = []
+
+    def send(self, msg):
+        if self._idle:
+            sock = self._idle.pop()
+        else:
+            sock = self.context.socket(zmq.REQ)
+            sock.connect(self.channel)
+        try:
+            sock.send(msg)
+            reply = sock.recv()
+        except BaseException:
+            sock.close(linger=0)
+            raise
+        self._idle.append(sock)
+        return reply
+
+
+_return_channels = dict()
+
+def get_return_channel(channel, context=None):
+    """Returns the ReturnChannel shared by all callbacks for channel using
+    context"""
+    channel_key = (channel, context)
+    if channel_key not in _return_channels:
+        _return_channels[channel_key] = ReturnChannel(channel, context)
+    return _return_channels[channel_key]
+
+def send_image_request(extra_prms, image_request):
+    """Send the request for a single image to the VISOR backend given by
+    extra_prms, returning its (JSON-decoded) response
+
+    If extra_prms sets 'batch_size' above 1, the request is sent as part of a
+    batch (see RequestBatcher), waiting at most 'batch_delay_ms' for the batch
+    to fill. Otherwise it is sent on its own, with image_request merged into
+    the {func, query_id} request.
+
+    Messages are terminated by TCP_TERMINATOR unless extra_prms sets
+    'backend_framing' to FRAMING_LENGTH.
+    """
+    host, port = extra_prms['backend_host'], extra_prms['backend_port']
+    framing = extra_prms.get('backend_framing', FRAMING_TERMINATOR)
+    batch_size = int(extra_prms.get('batch_size', 1))
+    if batch_size > 1:
+        batcher = get_request_batcher(host, port, batch_size,
+                                      float(extra_prms.get('batch_delay_ms',
+                                                           DEFAULT_BATCH_DELAY_MS)),
+                                      framing)
+        return batcher.request(extra_prms['func'], extra_prms['query_id'], image_request)
+    func_in = dict(func=extra_prms['func'],
+                   query_id=extra_prms['query_id'],
+                   **image_request)
+    return json.loads(get_backend_pool(host, port, framing).request(func_in))
+
+def return_impath(extra_prms, impath):
+    """Send impath on the ZMQ channel specified in extra_prms (if any)"""
+    if 'zmq_impath_return_ch' not in extra_prms:
+        log.info('Not returning image URL over ZMQ channel (not specified)')
+        return
+    log.info('Returning image URL on ZMQ channel: %s', extra_prms['zmq_impath_return_ch'])
+    channel = get_return_channel(extra_prms['zmq_impath_return_ch'],
+                                 extra_prms.get('zmq_context'))
+    channel.send(impath.encode('utf-8'))
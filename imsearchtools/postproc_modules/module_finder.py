@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 
 import os
+import importlib
 
 def get_module_callback(module_name):
     try:
-        module = __import__(module_name, globals=globals())
+        if module_name.startswith('_'):
+            raise ImportError('not a postproc module')
+        module = importlib.import_module('.' + module_name, __package__)
         callback_func = module.callback_func
     except ImportError as err:
         avail_modules = get_module_list()
@@ -16,10 +19,11 @@ def get_module_callback(module_name):
 
 def get_module_list():
     # return a list of all py files in current directory which aren't this file
-    # these are assumed to be the supported modules
+    # or private helpers (starting with '_') - these are assumed to be the
+    # supported modules
     modnames = [os.path.splitext(modname)[0]
                 for modname in os.listdir(os.path.dirname(os.path.realpath(__file__)))
                 if modname.endswith(('.py','.pyc','.pyo'))
                 and os.path.splitext(modname)[0] != os.path.splitext(os.path.basename(__file__))[0]
-                and os.path.splitext(modname)[0] != '__init__']
+                and not modname.startswith('_')]
     return list(set(modnames))
@@ -1,2 +1,4 @@
 from .image_getter import *
 from .image_processor import ImageProcessorSettings
+from .content_store import ContentStore
+from .callback_handler import CallbackHandler
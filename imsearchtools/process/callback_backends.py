@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+"""
+Module: callback_backends
+Created on: 18 Oct 2026
+
+Registry of the CallbackHandler classes which can be used to run completion
+callbacks, selected by name
+"""
+
+import importlib
+
+DEFAULT_CALLBACK_BACKEND = 'gevent'
+
+# backend name -> (module, class name), imported on first use so that backends
+# with optional dependencies (e.g. zmq) are only required when selected
+_callback_backends = {
+    'gevent': ('.callback_handler', 'CallbackHandler'),
+    'thread': ('.callback_handler_thread', 'CallbackHandler'),
+    'process': ('.callback_handler_multiprocessing', 'CallbackHandler'),
+    'zmq': ('.callback_handler_zmq', 'CallbackHandler'),
+}
+
+def register_callback_backend(name, handler_cls):
+    """Register a CallbackHandler class under name
+
+    Args:
+        name: the name used to select the backend
+        handler_cls: a class with the interface of callback_handler.CallbackHandler
+    """
+    _callback_backends[name] = handler_cls
+
+def get_callback_backend(name):
+    """Returns the CallbackHandler class registered under name"""
+    if name not in _callback_backends:
+        raise ValueError("Unknown callback backend: '%s' (available backends are %s)"
+                         % (name, get_callback_backend_list()))
+    handler_cls = _callback_backends[name]
+    if isinstance(handler_cls, tuple):
+        module_name, cls_name = handler_cls
+        module = importlib.import_module(module_name, __package__)
+        handler_cls = _callback_backends[name] = getattr(module, cls_name)
+    return handler_cls
+
+def get_callback_backend_list():
+    return sorted(_callback_backends.keys())
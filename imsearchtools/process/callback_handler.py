@@ -9,12 +9,16 @@ Created on: 29 Jan 2013
 import logging
 import gevent
 from gevent import pool
+from gevent.event import Event, AsyncResult
 import time
 from multiprocessing import cpu_count
 
 log = logging.getLogger(__name__)
 #log.setLevel(logging.DEBUG)
 
+# time to wait in join() for the next task to complete before giving up
+DEFAULT_IDLE_TIMEOUT = 1.5
+
 class CallbackHandler(object):
     """Class for wrapping callbacks
 
@@ -22,17 +26,26 @@ class CallbackHandler(object):
         worker_func: the callback to run when calling `run_callback()`
         task_count: the number of times `run_callback()` will be called
         [worker_count]: the number of workers to use (default: # CPUs)
+        [timeout]: maximum time to wait in `join()` for all tasks to complete
+            (-1 = unlimited)
+        [idle_timeout]: maximum time to wait in `join()` for the next task to
+            complete (-1 = unlimited)
 
 
     On launch a pool of `worker_count` workers is started, which will then
     process any tasks added to the task queue by calling `run_callback()`
     (the parameters of the callback function can be passed directly as
-    parameters to `run_callback()`).
+    parameters to `run_callback()`). `run_callback()` returns an AsyncResult,
+    whose `get()` returns the value returned by the callback or re-raises any
+    exception it raised.
 
     Once `task_count` tasks have been run and completed, the workers will
-    shut down. Wait for this condition by calling `join()`.
+    shut down. Wait for this condition by calling `join()`, which returns as
+    soon as the last task completes, or once either timeout expires (in which
+    case any remaining tasks are killed).
     """
-    def __init__(self, worker_func, task_count, worker_count=-1):
+    def __init__(self, worker_func, task_count, worker_count=-1,
+                 timeout=-1, idle_timeout=DEFAULT_IDLE_TIMEOUT):
         # initialize completion task worker pool
         # if number of workers is not specified, set it to the number of CPUs
         if worker_count == -1:
@@ -42,6 +55,10 @@ class CallbackHandler(object):
         # store requested task count and callback function
         self.task_count = task_count
         self.worker_func = worker_func
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        # set each time a task is completed or skipped
+        self._task_done = Event()
 
     def run_callback(self, *args, **kwargs):
         # pop off keyword parameters from kwargs
@@ -50,8 +67,10 @@ class CallbackHandler(object):
         #log.debug('Starting task for file: %s', out_dict['clean_fn'])
         if not self.worker_pool_closed:
             log.debug('Starting task')
+            result = AsyncResult()
             worker_params = dict(args=args,
-                                 kwargs=kwargs)
+                                 kwargs=kwargs,
+                                 result=result)
             # spawn worker through greenlet, so function does not block when pool is full
             #spawn_func = lambda self, worker_params: self.worker_pool.spawn(self._callback_func, worker_params)
             callback_launch_greenlet = gevent.spawn(self._spawn_callback,
@@ -60,7 +79,7 @@ class CallbackHandler(object):
 
             if blocking:
                 callback_launch_greenlet.join()
-
+            return result
 
     def skip(self):
         log.debug('Skipping task')
@@ -70,19 +89,7 @@ class CallbackHandler(object):
         # waiting for all tasks to complete
         log.debug('Waiting all tasks to be completed...')
 
-        last_task_count = self.task_count
-        last_task_elapsed = 0.0
-        task_wait_timed_out = False
-
-        while self.task_count > 0:
-            if last_task_count > self.task_count:
-                last_task_count = self.task_count
-                last_task_elapsed = 0.0
-            time.sleep(0.05)
-            last_task_elapsed = last_task_elapsed + 0.05
-            if last_task_elapsed > 1.5:
-                task_wait_timed_out = True
-                break
+        task_wait_timed_out = not self._wait_for_tasks()
 
         self.worker_pool_closed = True
         if task_wait_timed_out:
@@ -100,6 +107,24 @@ class CallbackHandler(object):
         self.worker_pool.join()
         log.debug('Done terminating!')
 
+    def _wait_for_tasks(self):
+        # wait for the task count to reach zero, returning False on timeout
+        deadline = None
+        if self.timeout > 0:
+            deadline = time.time() + self.timeout
+        while self.task_count > 0:
+            wait_time = self.idle_timeout if self.idle_timeout > 0 else None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0.0:
+                    return False
+                if wait_time is None or remaining < wait_time:
+                    wait_time = remaining
+            self._task_done.clear()
+            if not self._task_done.wait(wait_time):
+                return False
+        return True
+
     def _spawn_callback(self, worker_params, blocking=False):
         # spawn also waits, but want to check worker_pool_closed immediately
         # before launch, so do this manually
@@ -110,13 +135,29 @@ class CallbackHandler(object):
                 callback_greenlet.join()
 
     def _callback_func(self, worker_params):
-        self.worker_func(*worker_params['args'], **worker_params['kwargs'])
-        self._dec_task_count_completed()
+        try:
+            value = self._run_worker_func(worker_params['args'], worker_params['kwargs'])
+        except Exception as e:
+            log.exception('Error in post-computation')
+            worker_params['result'].set_exception(e)
+        except BaseException as e:
+            # killed on timeout or termination
+            worker_params['result'].set_exception(e)
+            raise
+        else:
+            worker_params['result'].set(value)
+        finally:
+            self._dec_task_count_completed()
+
+    def _run_worker_func(self, args, kwargs):
+        return self.worker_func(*args, **kwargs)
 
     def _dec_task_count_completed(self):
         self.task_count = self.task_count - 1
+        self._task_done.set()
         log.debug('Completed post-computation, remaining tasks: %d', self.task_count)
 
     def _dec_task_count_skipped(self):
         self.task_count = self.task_count - 1
+        self._task_done.set()
         log.debug('Skipped post-computation, remaining tasks: %d', self.task_count)
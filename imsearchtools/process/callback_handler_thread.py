@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+"""
+Module: callback_handler_thread
+Created on: 18 Oct 2026
+"""
+
+import logging
+from gevent.threadpool import ThreadPool
+
+from . import callback_handler
+
+log = logging.getLogger(__name__)
+
+class CallbackHandler(callback_handler.CallbackHandler):
+    """Class for wrapping callbacks run in a pool of native threads
+
+    Initializer Args:
+        worker_func: the callback to run when calling `run_callback()`
+        task_count: the number of times `run_callback()` will be called
+        [worker_count]: the number of threads to use (default: # CPUs)
+        [timeout]: maximum time to wait in `join()` for all tasks to complete
+            (-1 = unlimited)
+        [idle_timeout]: maximum time to wait in `join()` for the next task to
+            complete (-1 = unlimited)
+
+    Has the same interface as the gevent-based `callback_handler.CallbackHandler`,
+    but each callback is run in a native thread, so callbacks making blocking
+    calls (e.g. to libraries which gevent cannot make cooperative) don't hold
+    up the downloading greenlets.
+    """
+    def __init__(self, worker_func, task_count, worker_count=-1, **kwargs):
+        super(CallbackHandler, self).__init__(worker_func, task_count,
+                                              worker_count, **kwargs)
+        self.thread_pool = ThreadPool(self.worker_pool.size)
+
+    def terminate(self):
+        super(CallbackHandler, self).terminate()
+        self.thread_pool.kill()
+
+    def join(self):
+        super(CallbackHandler, self).join()
+        self.thread_pool.kill()
+
+    def _run_worker_func(self, args, kwargs):
+        return self.thread_pool.apply(self.worker_func, args, kwargs)
@@ -7,280 +7,194 @@ Created on: 20 Oct 2012
 """
 
 import logging
-from gevent_zeromq import zmq
-import random
+import zmq.green as zmq
+import gevent
+from gevent.event import AsyncResult
+import itertools
+import pickle
+import uuid
+from multiprocessing import cpu_count
 
-class ProcType:
-    multiprocessing = 1
-    gipc = 2
-    greenlet = 3
-
-PROC_TYPE = ProcType.greenlet
-DEBUG_CB = True
-
-if PROC_TYPE == ProcType.gipc:
-    import gipc
-elif PROC_TYPE == ProcType.multiprocessing:
-    from multiprocessing import Process
-elif PROC_TYPE == ProcType.greenlet:
-    import gevent
+from . import callback_handler
 
 log = logging.getLogger(__name__)
-if DEBUG_CB:
-    log.setLevel(logging.DEBUG)
-
-random.seed()
-pipe_name_hash = str(int(round(random.random()*1000000.0)))
-ZMQ_TASK_LAUNCH_CH = 'ipc:///tmp/zmq_imsearchtools_task_ch_' + pipe_name_hash
-ZMQ_TASK_COUNT_DEC_CH = 'ipc:///tmp/zmq_imsearchtools_tcdec_ch_' + pipe_name_hash
-ZMQ_TASK_RESULT_CH = 'ipc:///tmp/zmq_imsearchtools_result_ch_' + pipe_name_hash
-ZMQ_WORKER_CONTROL_CH = 'ipc:///tmp/zmq_imsearchtools_control_ch_' + pipe_name_hash
-ZMQ_WORKER_SYNC_CH = 'ipc:///tmp/zmq_imsearchtools_sync_ch_' + pipe_name_hash
 
-ZMQ_RESULT_SKIPPING = 'SKIPPING'
-ZMQ_RESULT_DONE = 'DONE'
-ZMQ_CONTROL_DONE = 'FINISHED'
-ZMQ_CONTROL_SYNC = 'INITIALIZED'
+DEFAULT_FABRIC_WORKER_COUNT = 8
 
-class CallbackHandler(object):
-    """Class for wrapping callbacks using ZMQ
+class CallbackHandler(callback_handler.CallbackHandler):
+    """Class for wrapping callbacks run by ZMQ workers
 
     Initializer Args:
         worker_func: the callback to run when calling `run_callback()`
         task_count: the number of times `run_callback()` will be called
-        [worker_count]: the number of workers to use (default: # CPUs)
-
-
-    On launch a pool of `worker_count` workers is started, which will then
-    process any tasks added to the task queue by calling `run_callback()`
-    (the parameters of the callback function can be passed directly as
-    parameters to `run_callback()`).
+        [worker_count]: the maximum number of tasks from this handler run at
+            once (default: # CPUs)
+        [timeout]: maximum time to wait in `join()` for all tasks to complete
+            (-1 = unlimited)
+        [idle_timeout]: maximum time to wait in `join()` for the next task to
+            complete (-1 = unlimited)
+
+    Has the same interface as the gevent-based `callback_handler.CallbackHandler`,
+    but tasks are dispatched to the workers of the process-wide CallbackFabric,
+    which is started on first use and shared by all handlers. The fabric is
+    grown to at least `worker_count` workers, so the handler can run as many
+    tasks at once as the gevent handler would. Each handler tags its tasks
+    with its own batch ID, so many batches can use the workers at once. The
+    workers are greenlets in this process, so as for the gevent
+    backend, callbacks must not block the event loop.
+    """
+    def __init__(self, worker_func, task_count, worker_count=-1, **kwargs):
+        super(CallbackHandler, self).__init__(worker_func, task_count,
+                                              worker_count, **kwargs)
+        self.fabric = get_callback_fabric()
+        self.fabric.ensure_workers(self.worker_pool.size)
+        self.batch_id = uuid.uuid4().hex.encode('ascii')
+
+    def _run_worker_func(self, args, kwargs):
+        task_key, result = self.fabric.submit(self.batch_id, self.worker_func,
+                                              args, kwargs)
+        try:
+            return result.get()
+        except BaseException:
+            # killed on timeout or termination
+            self.fabric.discard(task_key)
+            raise
+
+
+class CallbackFabric(object):
+    """Long-lived pool of greenlet workers in this process, scheduled over ZMQ
 
-    Once `task_count` tasks have been run and completed, the workers will
-    shut down. Wait for this condition by calling `join()`.
+    Initializer Args:
+        [worker_count]: the number of workers (-1 = # CPUs)
+
+    Only the (batch ID, task ID) key of each task is sent over the in-process
+    task channel - the callback and its arguments stay in a table in this
+    process, so they needn't be picklable. Workers pull keys from the shared
+    channel, run the callback for each and push its pickled return value (or
+    exception) back to the fabric, which routes it to the AsyncResult returned
+    by `submit()`.
     """
-    def __init__(self, worker_func, task_count, worker_count=-1):
-        # initialize completion task workers
-        # if number of workers is not specified, set it to the number of CPUs
+    def __init__(self, worker_count=DEFAULT_FABRIC_WORKER_COUNT):
+        self.worker_count = 0
+        self._context = zmq.Context()
+        fabric_id = uuid.uuid4().hex
+        self._task_ch = 'inproc://imsearchtools_task_ch_' + fabric_id
+        self._result_ch = 'inproc://imsearchtools_result_ch_' + fabric_id
+        # channel -> workers
+        self._task_sender = self._context.socket(zmq.PUSH)
+        self._task_sender.bind(self._task_ch)
+        # channel <- workers
+        self._result_receiver = self._context.socket(zmq.PULL)
+        self._result_receiver.bind(self._result_ch)
+
+        self._task_ids = itertools.count()
+        # (batch ID, task ID) -> (worker_func, args, kwargs, AsyncResult)
+        self._tasks = dict()
+        # (batch ID, task ID) -> greenlet running the callback
+        self._running = dict()
+
+        self._workers = []
+        self.ensure_workers(worker_count)
+        self._result_dispatcher = gevent.spawn(self._dispatch_results)
+
+    def submit(self, batch_id, worker_func, args, kwargs):
+        """Queue a task, returning a tuple (task_key, result) where result is
+        an AsyncResult set to the return value of the task"""
+        task_key = (batch_id, str(next(self._task_ids)).encode('ascii'))
+        result = AsyncResult()
+        self._tasks[task_key] = (worker_func, args, kwargs, result)
+        self._task_sender.send_multipart(list(task_key))
+        return task_key, result
+
+    def ensure_workers(self, worker_count):
+        """Start more workers if there are fewer than worker_count (-1 = # CPUs)"""
         if worker_count == -1:
-            worker_count = 8
-        self.workers = CallbackTaskWorkers(worker_func, worker_count)
-
-        # start result manager
-        if PROC_TYPE == ProcType.gipc:
-            self.result_manager = gipc.start_process(target=result_manager,
-                                                     args=(task_count,))
-        elif PROC_TYPE == ProcType.multiprocessing:
-            self.result_manager = Process(target=result_manager,
-                                          args=(task_count,))
-            self.result_manager.start()
-        elif PROC_TYPE == ProcType.greenlet:
-            self.result_manager = gevent.spawn(result_manager, task_count)
-
-        # initialize completion task runner
-        self.runner = CallbackTaskRunner()
-
-        # wait for all workers to subscribe to control channel
-        # MUST be placed above all other commands in __init__ to work
-        log.debug('Waiting for %d workers to initialize...', worker_count)
-        context = zmq.Context()
-        syncservice = context.socket(zmq.REP)
-        syncservice.bind(ZMQ_WORKER_SYNC_CH)
-        subscribers = 0
-        while subscribers < worker_count:
-            msg = syncservice.recv()
-            syncservice.send(msg) # send synchronization reply
-            subscribers = subscribers + 1
-        log.debug('%d workers initialized', worker_count)
-
-
-    def run_callback(self, *args, **kwargs):
-        self.runner.run(*args, **kwargs)
-
-    def skip(self):
-        self.runner.skip()
-
-    def join(self):
-        # wait first for the result manager to terminate
-        log.debug('Waiting for result manager to return...')
-        self.result_manager.join()
-        log.debug('Result manager returned!')
-        # this should cause the workers to also terminate,
-        #  but wait for them to explicitly say they're done too
-        log.debug('Waiting for workers to return...')
-        self.workers.join()
-        log.debug('Workers returned!')
-
-    def terminate(self):
-        log.debug('Forcefully terminating result manager')
-        self.result_manager.terminate()
-        log.debug('Forcefully terminating workers')
-        if PROC_TYPE == ProcType.greenlet:
-            self.workers.kill()
-        else:
-            self.workers.terminate()
-        log.debug('Done terminating!')
-
-class CallbackTaskRunner(object):
-    """Class used internally by CallbackHandler to launch tasks"""
-    def __init__(self):
-        context = zmq.Context()
-        # channel -> worker
-        self.task_sender = context.socket(zmq.PUSH)
-        self.task_sender.bind(ZMQ_TASK_LAUNCH_CH)
-        # channel -> result_manager
-        self.tcdec_sender = context.socket(zmq.PUB)
-        self.tcdec_sender.bind(ZMQ_TASK_COUNT_DEC_CH)
-
-        if DEBUG_CB:
-            self.launched_tasks = 0
-
-    def run(self, *args, **kwargs):
-        #log.debug('Starting task for file: %s', out_dict['clean_fn'])
-        params = dict(args=args,
-                      kwargs=kwargs)
-        if DEBUG_CB:
-            self.launched_tasks += 1
-            log.debug('Starting task %d', self.launched_tasks)
-            params['kwargs']['launched_tasks'] = self.launched_tasks
-        else:
-            log.debug('Starting task')
-        self.task_sender.send_json(params)
-
-    def skip(self):
-        if DEBUG_CB:
-            self.launched_tasks += 1
-            log.debug('Skipping task %d', self.launched_tasks)
-        else:
-            log.debug('Skipping task')
-        self.tcdec_sender.send(ZMQ_RESULT_SKIPPING)
-
-class CallbackTaskWorkers(object):
-    """Class used internally by CallbackHandler to launch a pool of workers"""
-    def __init__(self, worker_func, worker_count):
-
-        self.workers = [None]*worker_count
-        for wrk_num in range(worker_count):
-            if PROC_TYPE == ProcType.gipc:
-                self.workers[wrk_num] = gipc.start_process(target=self._callback_worker,
-                                                           args=(wrk_num, worker_func))
-            elif PROC_TYPE == ProcType.multiprocessing:
-                self.workers[wrk_num] = Process(target=self._callback_worker,
-                                                args=(wrk_num, worker_func))
-                self.workers[wrk_num].start()
-            elif PROC_TYPE == ProcType.greenlet:
-                self.workers[wrk_num] = gevent.spawn(self._callback_worker, wrk_num, worker_func)
-
-    def join(self):
-        if PROC_TYPE == ProcType.greenlet:
-            gevent.joinall(self.workers)
-        else:
-            for worker in self.workers:
-                worker.join()
+            worker_count = cpu_count()
+        for wrk_num in range(self.worker_count, worker_count):
+            self._workers.append(gevent.spawn(self._callback_worker, wrk_num))
+        self.worker_count = max(self.worker_count, worker_count)
+
+    def discard(self, task_key):
+        """Forget a task, so that it isn't run if it hasn't started yet, or
+        kill its callback if it is running"""
+        self._tasks.pop(task_key, None)
+        callback_greenlet = self._running.pop(task_key, None)
+        if callback_greenlet is not None:
+            callback_greenlet.kill(block=False)
 
     def terminate(self):
-        if PROC_TYPE == ProcType.greenlet:
-            gevent.killall(self.workers)
-        else:
-            for worker in self.workers:
-                worker.terminate()
+        log.debug('Terminating callback fabric...')
+        gevent.killall(self._workers + [self._result_dispatcher])
+        self._task_sender.close(linger=0)
+        self._result_receiver.close(linger=0)
+        self._context.term()
 
-    def _callback_worker(self, wrk_num, worker_func):
+    def _callback_worker(self, wrk_num):
         log.debug('Initializing worker number %d', wrk_num)
-
-        context = zmq.Context()
-        # channel <- run_completion_task
-        task_receiver = context.socket(zmq.PULL)
-        task_receiver.connect(ZMQ_TASK_LAUNCH_CH)
-        # channel -> result_manager
-        result_sender = context.socket(zmq.PUSH)
-        result_sender.connect(ZMQ_TASK_RESULT_CH)
-        # channel <- result_manager (CONTROL)
-        control_receiver = context.socket(zmq.SUB)
-        control_receiver.connect(ZMQ_WORKER_CONTROL_CH)
-        control_receiver.setsockopt(zmq.SUBSCRIBE, "")
-
-        poller = zmq.Poller()
-        poller.register(task_receiver, zmq.POLLIN)
-        poller.register(control_receiver, zmq.POLLIN)
-
-        # tell callback handler that worker has initialized
-        syncservice = context.socket(zmq.REQ)
-        syncservice.connect(ZMQ_WORKER_SYNC_CH)
-        syncservice.send(ZMQ_CONTROL_SYNC)
-        syncservice.recv()
-
-        # loop and accept messages from both task and control channels
-        while True:
-            socks = dict(poller.poll())
-
-            # handle callback launch requests
-            if socks.get(task_receiver) == zmq.POLLIN:
-                worker_params = task_receiver.recv_json()
-                #log.debug('Launching post-computation for file: %s',
-                #         out_dict['clean_fn'])
-                if DEBUG_CB:
-                    launched_tasks = worker_params['kwargs']['launched_tasks']
-                    log.debug('Launching task %d', launched_tasks)
-                    del worker_params['kwargs']['launched_tasks']
-                else:
-                    log.debug('Launching task')
-                worker_func(*worker_params['args'], **worker_params['kwargs'])
-                if DEBUG_CB:
-                    log.debug('Completed task %d', launched_tasks)
+        # channel <- fabric
+        task_receiver = self._context.socket(zmq.PULL)
+        task_receiver.connect(self._task_ch)
+        # channel -> fabric
+        result_sender = self._context.socket(zmq.PUSH)
+        result_sender.connect(self._result_ch)
+        try:
+            while True:
+                task_key = tuple(task_receiver.recv_multipart())
+                task = self._tasks.get(task_key)
+                if task is None:
+                    continue # discarded
+                worker_func, args, kwargs = task[:3]
+                # run the callback in its own greenlet, so that `discard` can
+                # kill it without stopping the worker
+                callback_greenlet = gevent.spawn(worker_func, *args, **kwargs)
+                self._running[task_key] = callback_greenlet
+                callback_greenlet.join()
+                self._running.pop(task_key, None)
+                if callback_greenlet.successful():
+                    reply = (True, callback_greenlet.value)
+                elif isinstance(callback_greenlet.exception, gevent.GreenletExit):
+                    continue # discarded while running
                 else:
-                    log.debug('Completed task')
-                result_sender.send(ZMQ_RESULT_DONE)
-
-            # handle control commands from manager
-            if socks.get(control_receiver) == zmq.POLLIN:
-                control_message = control_receiver.recv()
-                if control_message == ZMQ_CONTROL_DONE:
-                    log.debug('Terminating worker number %d', wrk_num)
-                    break
-
-
-def result_manager(num_tasks):
-    """Function used internally by CallbackHandler to collect results of tasks"""
-
-    context = zmq.Context()
-
-    # channel <- completion_worker
-    result_receiver = context.socket(zmq.PULL)
-    result_receiver.bind(ZMQ_TASK_RESULT_CH)
-    # channel -> completion_worker (CONTROL)
-    control_sender = context.socket(zmq.PUB)
-    control_sender.bind(ZMQ_WORKER_CONTROL_CH)
-    # channel <- skip_completion_task
-    tcdec_receiver = context.socket(zmq.SUB)
-    tcdec_receiver.connect(ZMQ_TASK_COUNT_DEC_CH)
-    tcdec_receiver.setsockopt(zmq.SUBSCRIBE, "")
-
-    poller = zmq.Poller()
-    poller.register(result_receiver, zmq.POLLIN)
-    poller.register(tcdec_receiver, zmq.POLLIN)
-
-    while True:
-        socks = dict(poller.poll())
-
-        # handle results from workers
-        if socks.get(result_receiver) == zmq.POLLIN:
-            result_message = result_receiver.recv()
-            if result_message == ZMQ_RESULT_DONE:
-                num_tasks -= 1
-                log.debug('Completed post-computation, remaining tasks: %d', num_tasks)
-
-        # handle counter decrementing
-        if socks.get(tcdec_receiver) == zmq.POLLIN:
-            result_message = tcdec_receiver.recv()
-            if result_message == ZMQ_RESULT_SKIPPING:
-                num_tasks -= 1
-                log.debug('Skipped post-computation, remaining tasks: %d', num_tasks)
-
-        # break from loop when all tasks completed
-        if num_tasks == 0:
-            log.debug('All tasks done - terminating workers')
-            break
-
-    # terminate all workers when all tasks completed
-    control_sender.send(ZMQ_CONTROL_DONE)
+                    reply = (False, callback_greenlet.exception)
+                try:
+                    payload = pickle.dumps(reply)
+                except Exception as e:
+                    payload = pickle.dumps((False, TypeError('Unpicklable callback result: %s' % e)))
+                result_sender.send_multipart(list(task_key) + [payload])
+        finally:
+            task_receiver.close(linger=0)
+            result_sender.close(linger=0)
+
+    def _dispatch_results(self):
+        while True:
+            batch_id, task_id, payload = self._result_receiver.recv_multipart()
+            task = self._tasks.pop((batch_id, task_id), None)
+            if task is None:
+                continue # discarded while running
+            success, value = pickle.loads(payload)
+            if success:
+                task[3].set(value)
+            else:
+                task[3].set_exception(value)
+
+
+_callback_fabric = None
+_fabric_worker_count = DEFAULT_FABRIC_WORKER_COUNT
+
+def get_callback_fabric():
+    """Returns the CallbackFabric shared by all ZMQ callback handlers in the
+    process, starting it if required"""
+    global _callback_fabric
+    if _callback_fabric is None:
+        _callback_fabric = CallbackFabric(_fabric_worker_count)
+    return _callback_fabric
+
+def set_callback_fabric_worker_count(worker_count):
+    """Set the minimum number of workers of the CallbackFabric shared by all
+    ZMQ callback handlers in the process (-1 = # CPUs), growing it if it has
+    already been started. Workers are never stopped, so the count can't be
+    reduced once the fabric is running"""
+    global _fabric_worker_count
+    _fabric_worker_count = worker_count
+    if _callback_fabric is not None:
+        _callback_fabric.ensure_workers(worker_count)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""
+Module: content_store
+Created on: 18 Oct 2026
+"""
+
+import os
+import errno
+import shutil
+import logging
+from contextlib import contextmanager
+from gevent.lock import Semaphore
+
+log = logging.getLogger(__name__)
+
+class ContentStore(object):
+    """Content-addressed store for downloaded images, shared across queries
+
+    Initializer Args:
+        root_dir: the directory in which stored images are kept
+
+    Images are stored under the SHA-256 digest of their content, so that an
+    image returned for several queries or engines (or under different URLs) is
+    only processed once, with the per-query filenames linked to the stored
+    copies. Stored images are grouped by a namespace identifying the processing
+    settings, as the outputs of processing depend on these.
+    """
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.unique_count = 0
+        self.duplicate_count = 0
+        # digest -> [lock, number of users]
+        self._locks = dict()
+
+    @property
+    def stats(self):
+        total = self.unique_count + self.duplicate_count
+        return dict(unique=self.unique_count,
+                    duplicates=self.duplicate_count,
+                    dedup_ratio=(float(self.duplicate_count)/total if total else 0.0))
+
+    def path_for(self, digest, namespace):
+        """Returns the path of the stored original image with the given digest"""
+        store_dir = os.path.join(self.root_dir, namespace)
+        if not os.path.isdir(store_dir):
+            try:
+                os.makedirs(store_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        return os.path.join(store_dir, digest + '.orig')
+
+    @contextmanager
+    def lock(self, digest):
+        """Held while an image is added, so that concurrent downloads of the same
+        image wait for the first to be processed rather than repeating the work"""
+        if digest not in self._locks:
+            self._locks[digest] = [Semaphore(), 0]
+        lock_ifo = self._locks[digest]
+        lock_ifo[1] += 1
+        try:
+            with lock_ifo[0]:
+                yield
+        finally:
+            lock_ifo[1] -= 1
+            if lock_ifo[1] == 0:
+                del self._locks[digest]
+
+    def add(self, fn, store_fn):
+        """Move the downloaded file fn into the store as store_fn (fn is None if
+        the original image is not kept)"""
+        if fn is not None:
+            shutil.move(fn, store_fn)
+        self.unique_count += 1
+
+    def discard(self, store_fn):
+        """Undo `add` for an image which could not be processed, removing
+        store_fn (None if the original image is not kept)"""
+        if store_fn is not None and os.path.exists(store_fn):
+            os.remove(store_fn)
+        self.unique_count -= 1
+
+    def add_duplicate(self, fn):
+        """Record that fn duplicates a stored image, removing it (fn is None if
+        the original image is not kept)"""
+        if fn is not None:
+            os.remove(fn)
+        self.duplicate_count += 1
+
+    def add_missing(self, fn, store_fn):
+        """Record that fn duplicates a stored image, some of whose outputs are
+        missing (e.g. as its original was not kept), moving fn into the store as
+        store_fn if that is missing (fn is None if the original is not kept)"""
+        if fn is not None:
+            if not os.path.exists(store_fn):
+                shutil.move(fn, store_fn)
+            elif os.path.samefile(fn, store_fn):
+                return # output of an earlier run for the same URL
+        self.duplicate_count += 1
+
+    def link(self, store_fn, fn):
+        """Make the stored file store_fn available as fn, using a hard link
+        where possible and falling back to a symbolic link"""
+        if os.path.lexists(fn):
+            if os.path.exists(fn) and os.path.samefile(store_fn, fn):
+                return
+            os.remove(fn)
+        try:
+            os.link(store_fn, fn)
+        except OSError:
+            os.symlink(os.path.abspath(store_fn), fn)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+"""
+Module: download_scheduler
+Created on: 18 Oct 2026
+"""
+
+import logging
+from collections import OrderedDict, deque, defaultdict
+from gevent.event import Event
+
+log = logging.getLogger(__name__)
+
+class DownloadScheduler(object):
+    """Class limiting the number of concurrent downloads, both in total and to
+    any single host
+
+    Initializer Args:
+        [max_concurrent]: maximum number of downloads in progress at once
+            (-1 = unlimited)
+        [max_per_host]: maximum number of downloads in progress at once from
+            any single host (-1 = unlimited)
+
+    Each download greenlet should wrap its transfer in `with scheduler.slot(host):`.
+    When a download slot becomes free it is granted to waiting hosts in turn
+    (round-robin), so a single slow host with many queued URLs cannot starve
+    the downloads from other hosts.
+    """
+
+    def __init__(self, max_concurrent=-1, max_per_host=-1):
+        self.max_concurrent = max_concurrent
+        self.max_per_host = max_per_host
+
+        self._active_total = 0
+        self._active = defaultdict(int)
+        # host -> queue of events for waiting greenlets, in round-robin order
+        self._waiting = OrderedDict()
+
+    def slot(self, host):
+        return _DownloadSlot(self, host)
+
+    def acquire(self, host):
+        # any waiting greenlets which could run have already been granted slots,
+        # so only queue behind others from the same host or when at capacity
+        if host not in self._waiting and self._has_capacity(host):
+            self._grant(host)
+            return
+
+        granted = Event()
+        self._waiting.setdefault(host, deque()).append(granted)
+        try:
+            granted.wait()
+        except BaseException:
+            # greenlet was killed while waiting (e.g. timeout) - give up the
+            # slot if it was granted in the meantime, otherwise leave the queue
+            if granted.is_set():
+                self.release(host)
+            else:
+                self._remove_waiter(host, granted)
+            raise
+
+    def release(self, host):
+        self._active_total -= 1
+        self._active[host] -= 1
+        if self._active[host] == 0:
+            del self._active[host]
+        self._dispatch()
+
+    def _has_capacity(self, host):
+        if self.max_concurrent > 0 and self._active_total >= self.max_concurrent:
+            return False
+        if self.max_per_host > 0 and self._active.get(host, 0) >= self.max_per_host:
+            return False
+        return True
+
+    def _grant(self, host):
+        self._active_total += 1
+        self._active[host] += 1
+
+    def _dispatch(self):
+        # grant free slots to waiting hosts in round-robin order, moving each
+        # host to the back of the queue once it has been served
+        granted_any = True
+        while granted_any and self._waiting:
+            granted_any = False
+            for host in list(self._waiting.keys()):
+                if not self._has_capacity(host):
+                    continue
+                waiters = self._waiting[host]
+                self._grant(host)
+                waiters.popleft().set()
+                if waiters:
+                    self._waiting.move_to_end(host)
+                else:
+                    del self._waiting[host]
+                granted_any = True
+                break
+
+    def _remove_waiter(self, host, granted):
+        waiters = self._waiting.get(host)
+        if waiters is None:
+            return
+        waiters.remove(granted)
+        if not waiters:
+            del self._waiting[host]
+
+
+class _DownloadSlot(object):
+
+    def __init__(self, scheduler, host):
+        self.scheduler = scheduler
+        self.host = host
+
+    def __enter__(self):
+        self.scheduler.acquire(self.host)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.scheduler.release(self.host)
+
+
+_download_schedulers = dict()
+
+def get_download_scheduler(max_concurrent=-1, max_per_host=-1):
+    """Returns the DownloadScheduler with the given limits shared by all
+    downloaders in the process, so that the limits apply across all batches
+    of downloads in progress at once"""
+    scheduler_key = (max_concurrent, max_per_host)
+    if scheduler_key not in _download_schedulers:
+        _download_schedulers[scheduler_key] = DownloadScheduler(max_concurrent,
+                                                                max_per_host)
+    return _download_schedulers[scheduler_key]
@@ -11,25 +11,42 @@ import gevent
 from gevent.timeout import Timeout
 
 from gevent import monkey; monkey.patch_socket()
-import urllib.error
-import urllib.request
-from http.client import BadStatusLine
 
-#import requests
+import requests
+from requests.adapters import HTTPAdapter
 import os
+import io
 import urllib.parse
 import time
+import tempfile
+import hashlib
+import copy
+from contextlib import closing
 
 from .image_processor import *
-import imutils
+from . import imutils
 
 import logging
 
-from .callback_handler import CallbackHandler
+from .callback_backends import DEFAULT_CALLBACK_BACKEND, get_callback_backend
+from .callback_handler import DEFAULT_IDLE_TIMEOUT
+from .download_scheduler import get_download_scheduler
+from .near_duplicates import NearDuplicateIndex, dhash_file
+from .worker_pool import get_process_pool
 
 #logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
+# size of the chunks in which downloaded images are written to disk
+DOWNLOAD_CHUNK_SIZE = 64*1024
+# number of hosts for which keep-alive connections are retained
+DOWNLOAD_POOL_HOSTS = 100
+# maximum number of bytes from the start of a download searched for the image
+# header, to allow images to be filtered by size before the download completes
+HEADER_SNIFF_BYTES = 256*1024
+# content types allowed (in addition to image/*) when checking Content-Type
+GENERIC_CONTENT_TYPES = ('application/octet-stream', 'binary/octet-stream')
+
 class ImageGetter(ImageProcessor):
     """Class for downloading cleaned-up images from the web, given a set of URLs
 
@@ -39,31 +56,118 @@ class ImageGetter(ImageProcessor):
     the dictionary returned from the image search.
 
     Cleaned-up versions of the image, along with thumbnails, will be output.
+
+    At most `max_downloads` images are downloaded at once, with no more than
+    `max_downloads_per_host` of these from any single host (-1 = unlimited).
+    The limits are shared by all ImageGetters in the process created with the
+    same limits, so they also hold across concurrent batches of downloads.
+
+    If a ContentStore is given as `content_store`, images with identical content
+    are only processed once, with the output filenames for each URL linked to
+    the copies held in the store.
+
+    If `improc_workers` is non-zero, downloaded images are processed (decoded,
+    resized and re-encoded) in a pool of that many worker processes shared by
+    all ImageGetters (-1 = # CPUs), rather than in the downloading greenlet.
+
+    If `opts.filter['near_duplicate_threshold']` is set, only the first of a
+    set of near-duplicate images in a batch to finish processing is returned -
+    not necessarily the best ranked or the largest. The output files of the
+    others are left in `output_dir`.
+
+    If `keep_originals` is False, downloaded images are held in memory while
+    they are processed, and only the cleaned-up images and thumbnails are
+    written to `output_dir` (the 'orig_fn' of each output is then None).
+
+    Completion callbacks are run in greenlets by default. Set
+    `completion_backend` to the name of another callback backend (see
+    `callback_backends`) to run them elsewhere by default, e.g. 'process' to
+    use a long-lived pool of worker processes (the callback must then be
+    picklable). The backend can also be chosen for each call to `process_urls`.
+    The callback handler is created with `completion_timeout` and
+    `completion_idle_timeout` as its `timeout` and `idle_timeout` (see
+    `callback_handler.CallbackHandler`), which can also be set for each call.
+
+    The progress of the most recent call to `process_urls` (or
+    `iter_process_urls`) can be read from `stats` while it runs.
     """
 
-    def __init__(self, timeout=5.0, image_timeout=1.0, opts=ImageProcessorSettings()):
+    def __init__(self, timeout=5.0, image_timeout=1.0, opts=ImageProcessorSettings(),
+                 max_downloads=100, max_downloads_per_host=10, content_store=None,
+                 improc_workers=0, keep_originals=True,
+                 completion_backend=DEFAULT_CALLBACK_BACKEND,
+                 completion_timeout=-1, completion_idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        get_callback_backend(completion_backend) # check the backend exists
         self.opts = opts
+        self.completion_backend = completion_backend
+        self.completion_timeout = completion_timeout
+        self.completion_idle_timeout = completion_idle_timeout
+        self.keep_originals = keep_originals
+        self.content_store = content_store
+        self.improc_workers = improc_workers
         self.timeout = timeout
         self.image_timeout = image_timeout
         self.headers = {'User-Agent': 'Mozilla/5.0'}
         self.subprocs = []
+        self._download_scheduler = get_download_scheduler(max_downloads,
+                                                          max_downloads_per_host)
+        self._near_duplicate_index = None
+        self._reset_stats()
+        # connections to each image host are reused across the URLs in a batch,
+        # with up to one connection kept for each concurrent download from a host
+        pool_maxsize = max_downloads_per_host if max_downloads_per_host > 0 else 10
+        self._session = requests.Session()
+        self._session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=DOWNLOAD_POOL_HOSTS,
+                              pool_maxsize=pool_maxsize)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    @property
+    def stats(self):
+        return dict(downloaded=self.downloaded_count,
+                    processed=self.processed_count,
+                    failed=self.failed_count)
+
+    def _reset_stats(self):
+        # images downloaded and processed, images for which the completion
+        # callback has also been run, and images which could not be downloaded
+        self.downloaded_count = 0
+        self.processed_count = 0
+        self.failed_count = 0
 
     def process_url(self, urldata, output_dir, call_completion_func=False,
                     completion_extra_prms=None, start_time=0):
         error_occurred = False
         try:
             output_fn = os.path.join(output_dir, self._filename_from_urldata(urldata))
-            self._download_image(urldata['url'], output_fn)
-            clean_fn, thumb_fn = self.process_image(output_fn)
-        except urllib.error.URLError as e:
-            log.info('URL Error for %s (%s)', urldata['url'], str(e))
+            host = urllib.parse.urlparse(urldata['url']).netloc
+            with self._download_scheduler.slot(host):
+                digest, data = self._download_image(urldata['url'], output_fn)
+            image_hash = None
+            if digest is None and not self.keep_originals:
+                # outputs from an earlier download of the image are reused
+                clean_fn = self._clean_filename_from_filename(output_fn)
+                thumb_fns = self._thumb_filenames_from_filename(output_fn)
+            elif self.content_store is not None:
+                clean_fn, thumb_fns, image_hash = self._process_stored_image(output_fn,
+                                                                             digest, data)
+            else:
+                # an image which was downloaded was checked against the
+                # blacklist as it was received
+                clean_fn, thumb_fns, image_hash = self._dispatch_process_image(output_fn,
+                                                                               data, digest,
+                                                                               digest is not None)
+            if self._near_duplicate_index is not None:
+                if image_hash is None:
+                    # the image wasn't processed, so hash its existing thumbnail
+                    image_hash = self._dispatch_hash_image(thumb_fns[0])
+                self._filter_near_duplicate(urldata, image_hash)
+        except requests.exceptions.HTTPError as e:
+            log.info('HTTP Error for %s (%s)', urldata['url'], str(e))
             error_occurred = True
-        except urllib.error.HTTPError as e:
-            if e.code != 201:
-                log.info('HTTP Error for %s (%s)', urldata['url'], str(e))
-                error_occurred = True
-        except BadStatusLine as e:
-            log.info('Bad status line for %s (%s)', urldata['url'], str(e))
+        except requests.exceptions.RequestException as e:
+            log.info('Request Error for %s (%s)', urldata['url'], str(e))
             error_occurred = True
         except IOError as e:
             log.info('IO Error for: %s (%s)', urldata['url'], str(e))
@@ -73,10 +177,12 @@ class ImageGetter(ImageProcessor):
             error_occurred = True
 
         if not error_occurred:
+            self.downloaded_count += 1
             out_dict = urldata
-            out_dict['orig_fn'] = output_fn
+            out_dict['orig_fn'] = output_fn if self.keep_originals else None
             out_dict['clean_fn'] = clean_fn
-            out_dict['thumb_fn'] = thumb_fn
+            out_dict['thumb_fn'] = thumb_fns[0]
+            out_dict['thumb_fns'] = thumb_fns
             if start_time > 0:
                 out_dict['download_time'] = time.time() - start_time
 
@@ -88,8 +194,10 @@ class ImageGetter(ImageProcessor):
                     self._callback_handler.run_callback(out_dict, blocking=True)
 
             log.info('done with callback')
+            self.processed_count += 1
             return out_dict
         else:
+            self.failed_count += 1
             if call_completion_func:
                 # indicate to callback handler that a URL to be processed failed
                 self._callback_handler.skip()
@@ -97,19 +205,161 @@ class ImageGetter(ImageProcessor):
             return None
 
     def _download_image(self, url, output_fn):
-        if imutils.image_exists(output_fn):
-            log.info('Output filename exists for URL: %s', url)
-            return
+        """Download url to output_fn, returning a tuple (digest, data) of the
+        SHA-256 digest of the image and, if originals are not kept, the image
+        content (digest is None if the image was downloaded previously)"""
+        if self.keep_originals:
+            if imutils.image_exists(output_fn):
+                log.info('Output filename exists for URL: %s', url)
+                return None, None
+        elif all(imutils.image_exists(fn)
+                 for fn in ([self._clean_filename_from_filename(output_fn)] +
+                            self._thumb_filenames_from_filename(output_fn))):
+            log.info('Processed images exist for URL: %s', url)
+            return None, None
 
         log.info('Downloading URL: %s', url)
-        request = urllib.request.Request(url, headers=self.headers)
-        r = urllib.request.urlopen(request, timeout=self.image_timeout)
-
-        with open(output_fn, 'w') as f:
-            f.write(r.read())
+        with closing(self._session.get(url, stream=True,
+                                       timeout=self.image_timeout)) as resp:
+            resp.raise_for_status()
+            self._filter_response_headers(resp)
+            if self.keep_originals:
+                return self._stream_to_file(resp, output_fn), None
+            buf = io.BytesIO()
+            digest = self._stream_download(resp, buf)
+            return digest, buf.getvalue()
+
+    def _dispatch_process_image(self, fn, data=None, digest=None, blacklist_checked=False):
+        # run process_image either inline or in the shared worker process pool
+        if self.improc_workers:
+            opts = self.opts
+            if blacklist_checked and opts.filter['blacklist_hashes']:
+                # don't pickle the (possibly large) blacklist for every image
+                opts = copy.copy(opts)
+                opts.filter = dict(opts.filter, blacklist_hashes=set())
+            return get_process_pool(self.improc_workers).apply(process_image_file,
+                                                               (fn, opts, data, digest,
+                                                                blacklist_checked))
+        return self.process_image(fn, data, digest, blacklist_checked)
+
+    def _dispatch_hash_image(self, fn):
+        if self.improc_workers:
+            return get_process_pool(self.improc_workers).apply(dhash_file, (fn,))
+        return dhash_file(fn)
+
+    def _filter_near_duplicate(self, urldata, image_hash):
+        # compare perceptual hash of the thumbnail to the images already
+        # processed in the batch
+        duplicate_id = self._near_duplicate_index.find_or_add(image_hash,
+                                                              urldata['image_id'])
+        if duplicate_id is not None:
+            raise FilterException('Near duplicate of %s' % duplicate_id)
+
+    def _process_stored_image(self, fn, digest=None, data=None):
+        # process image via the content store, only processing images which
+        # have not previously been stored (the perceptual hash returned by
+        # process_image is then None). If data is given, the image is
+        # processed from memory and no original is stored
+        blacklist_checked = digest is not None
+        if digest is None:
+            digest = imutils.file_digest(fn)
+        store_fn = self.content_store.path_for(digest, self._settings_fingerprint())
+        store_clean_fn = self._clean_filename_from_filename(store_fn)
+        store_thumb_fns = self._thumb_filenames_from_filename(store_fn)
+        store_output_fns = [store_clean_fn] + store_thumb_fns
+        image_hash = None
+        if data is None:
+            store_output_fns.append(store_fn)
+
+        with self.content_store.lock(digest):
+            stored_count = len([store_output_fn for store_output_fn in store_output_fns
+                                if imutils.image_exists(store_output_fn)])
+            if stored_count == len(store_output_fns):
+                log.info('Image already stored: %s', fn)
+                if data is not None:
+                    self.content_store.add_duplicate(None)
+                elif not os.path.samefile(fn, store_fn):
+                    self.content_store.add_duplicate(fn)
+            elif stored_count > 0:
+                # only the missing outputs are added, so the image isn't
+                # counted as a new unique image
+                log.info('Adding missing outputs for stored image: %s', fn)
+                self.content_store.add_missing(fn if data is None else None, store_fn)
+                _, _, image_hash = self._dispatch_process_image(store_fn, data, digest,
+                                                                blacklist_checked)
+            else:
+                self.content_store.add(fn if data is None else None, store_fn)
+                try:
+                    _, _, image_hash = self._dispatch_process_image(store_fn, data, digest,
+                                                                    blacklist_checked)
+                except BaseException:
+                    self.content_store.discard(store_fn if data is None else None)
+                    raise
+
+        # link outputs for this URL to the stored copies
+        clean_fn = self._clean_filename_from_filename(fn)
+        thumb_fns = self._thumb_filenames_from_filename(fn)
+        if data is None:
+            self.content_store.link(store_fn, fn)
+        self.content_store.link(store_clean_fn, clean_fn)
+        for store_thumb_fn, thumb_fn in zip(store_thumb_fns, thumb_fns):
+            self.content_store.link(store_thumb_fn, thumb_fn)
+        return clean_fn, thumb_fns, image_hash
+
+    def _filter_response_headers(self, resp):
+        # reject images before reading the body where possible
+        content_length = resp.headers.get('Content-Length', '')
+        if (content_length.isdigit() and
+            int(content_length) > self.opts.filter['max_download_bytes']):
+            raise FilterException('Content-Length > max_download_bytes')
+        content_type = resp.headers.get('Content-Type', '').lower()
+        if (self.opts.filter['check_content_type'] and content_type and
+            not content_type.startswith(('image/',) + GENERIC_CONTENT_TYPES)):
+            raise FilterException('Content-Type not an image (%s)' % content_type)
+
+    def _stream_to_file(self, resp, output_fn):
+        # stream to a temporary file which is renamed once complete, so that a
+        # partially downloaded image is never left at output_fn
+        fd, tmp_fn = tempfile.mkstemp(prefix='.', suffix='.part',
+                                      dir=os.path.dirname(output_fn))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                digest = self._stream_download(resp, f)
+            os.rename(tmp_fn, output_fn)
+        except BaseException:
+            os.remove(tmp_fn)
+            raise
+        return digest
+
+    def _stream_download(self, resp, f):
+        # write the response body to file object f, returning its SHA-256
+        # digest and checking the size of the image as it is received
+        digest = hashlib.sha256()
+        nbytes = 0
+        header = bytearray()
+        for chunk in resp.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            nbytes += len(chunk)
+            if nbytes > self.opts.filter['max_download_bytes']:
+                raise FilterException('Downloaded bytes > max_download_bytes')
+            # abort as soon as the image header shows it will be filtered
+            if header is not None:
+                header.extend(chunk)
+                image_info = imutils.image_info_from_header(bytes(header))
+                if image_info:
+                    self._filter_image_size(*image_info)
+                if image_info or len(header) > HEADER_SNIFF_BYTES:
+                    header = None
+            digest.update(chunk)
+            f.write(chunk)
+        # reject blacklisted images before they are decoded or stored
+        if self._has_hash_blacklist():
+            self._filter_blacklisted_digest(digest.hexdigest())
+        return digest.hexdigest()
 
     def process_urls(self, urls, output_dir, completion_func=None,
-                     completion_worker_count=-1, completion_extra_prms=None):
+                     completion_worker_count=-1, completion_extra_prms=None,
+                     completion_backend=None, completion_timeout=None,
+                     completion_idle_timeout=None):
         """Process returned list of URL dicts returned from search client class
 
         Args:
@@ -121,52 +371,123 @@ class ImageGetter(ImageProcessor):
                     f(out_dict)
                 where out_dict is a dictionary of the same form as a single
                 entry in the return dict (i.e. containing 'orig_fn', 'clean_fn',
-                and 'thumb_fn' fields)
+                'thumb_fn' and 'thumb_fns' fields)
+            [completion_worker_count]: the number of workers used to run
+                completion_func (default: # CPUs)
+            [completion_extra_prms]: an optional second parameter passed to
+                completion_func
+            [completion_backend]: the name of the callback backend used to run
+                completion_func (default: as set on initialization)
+            [completion_timeout]: maximum time to wait for all callbacks to
+                complete (-1 = unlimited, default: as set on initialization)
+            [completion_idle_timeout]: maximum time to wait for the next
+                callback to complete (-1 = unlimited, default: as set on
+                initialization)
 
             Returns:
                 A list of dictionaries of the form:
                 [{'orig_fn':'/path/to/image/as/downloaded/directly/from/url',
                   'clean_fn':'/path/to/processed/and/validated/image',
-                  'thumb_fn':'/path/to/thumbnail'},
+                  'thumb_fn':'/path/to/thumbnail',
+                  'thumb_fns':['/path/to/thumbnail', ...]},
                   ...]
 
         """
+        jobs = self._launch_jobs(urls, output_dir, completion_func,
+                                 completion_worker_count, completion_extra_prms,
+                                 completion_backend, completion_timeout,
+                                 completion_idle_timeout)
+
+        # wait for all URL processor jobs to complete
+        gevent.joinall(jobs, timeout=self.timeout)
+        log.info('all process_url jobs joined!')
+
+        self._finish_jobs(jobs, completion_func)
+
+        # construct return list of filenames
+        results = []
+
+        for job in jobs:
+            if job.value:
+                results.append(job.value)
+
+        return results
+
+    def iter_process_urls(self, urls, output_dir, completion_func=None,
+                          completion_worker_count=-1, completion_extra_prms=None,
+                          completion_backend=None, completion_timeout=None,
+                          completion_idle_timeout=None):
+        """Generator version of `process_urls`, taking the same arguments
+
+        Yields the dictionary for each image (of the same form as a single entry
+        in the list returned by `process_urls`) as soon as it has been downloaded
+        and processed, in order of completion rather than in the order of `urls`.
+        Iteration stops once all images are done or `timeout` has elapsed.
+        """
+        jobs = self._launch_jobs(urls, output_dir, completion_func,
+                                 completion_worker_count, completion_extra_prms,
+                                 completion_backend, completion_timeout,
+                                 completion_idle_timeout)
 
+        try:
+            for job in gevent.iwait(jobs, timeout=self.timeout):
+                if job.value:
+                    yield job.value
+            log.info('all process_url jobs joined!')
+        finally:
+            # also reached if the caller stops iterating early
+            self._finish_jobs(jobs, completion_func)
+
+    def _launch_jobs(self, urls, output_dir, completion_func,
+                     completion_worker_count, completion_extra_prms,
+                     completion_backend, completion_timeout,
+                     completion_idle_timeout):
         # check input parameters
         if not urls:
             raise ValueError('At least one url must be specified for processing')
 
+        self._reset_stats()
+
+        # near-duplicates are detected within each batch
+        if self.opts.filter['near_duplicate_threshold'] >= 0:
+            self._near_duplicate_index = NearDuplicateIndex(self.opts.filter['near_duplicate_threshold'])
+        else:
+            self._near_duplicate_index = None
+
         # prepare workers for callback if using callback function
         # returned process will end once all callbacks have been completed
         if completion_func:
-            self._callback_handler = CallbackHandler(completion_func,
-                                                     len(urls),
-                                                     completion_worker_count)
+            handler_cls = get_callback_backend(completion_backend or
+                                               self.completion_backend)
+            if completion_timeout is None:
+                completion_timeout = self.completion_timeout
+            if completion_idle_timeout is None:
+                completion_idle_timeout = self.completion_idle_timeout
+            self._callback_handler = handler_cls(completion_func,
+                                                 len(urls),
+                                                 completion_worker_count,
+                                                 timeout=completion_timeout,
+                                                 idle_timeout=completion_idle_timeout)
 
         # launch main URL processor jobs
-        jobs = [gevent.spawn(self.process_url,
+        return [gevent.spawn(self.process_url,
                              urldata, output_dir,
                              call_completion_func=(completion_func is not None),
                              completion_extra_prms=completion_extra_prms,
                              start_time=time.time())
                 for urldata in urls]
 
-        # wait for all URL processor jobs to complete
-        gevent.joinall(jobs, timeout=self.timeout)
-        log.info('all process_url jobs joined!')
+    def _finish_jobs(self, jobs, completion_func):
+        # detect if timeout occurred by checking for any jobs which are still
+        # running, and stop them (their results would be discarded anyway)
+        timeout_occurred = False
+        for job in jobs:
+            if not job.ready():
+                job.kill(block=True)
+                timeout_occurred = True
 
         # if using callbacks, wait for all callbacks to complete before continuing
         if completion_func:
-            # detect if timeout occurred by iterating through jobs and using 'get', which
-            # will re-raise the Timeout exception for any jobs
-            timeout_occurred = False
-            for job in jobs:
-                try:
-                    job.get(block=False)
-                except (Timeout, IndexError):
-                    job.kill(block=True)
-                    timeout_occurred = True
-
             # only wait for callback handler if timeout didn't occur
             # (as timeout will cause uncompleted gevent jobs to be forcibly ended
             #  thus never returning to allow job manager to in turn return)
@@ -176,11 +497,7 @@ class ImageGetter(ImageProcessor):
                 log.info('Timeout occurred when processing jobs')
                 self._callback_handler.terminate()
 
-        # construct return list of filenames
-        results = []
-
-        for job in jobs:
-            if job.value:
-                results.append(job.value)
-
-        return results
+        # close the keep-alive connections of the batch, rather than leaving
+        # them open until the ImageGetter is garbage collected (new connections
+        # are opened if the ImageGetter is used again)
+        self._session.close()
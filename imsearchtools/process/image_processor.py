@@ -8,14 +8,21 @@ Created on: 19 Oct 2012
 """
 
 import os
+import io
 import urllib.parse
+import json
+import hashlib
 
 from PIL import Image as PILImage
 from .import imutils
+from .near_duplicates import dhash, dhash_file
 import logging
 
 log = logging.getLogger(__name__)
 
+# SHA-256 digest of the placeholder image returned by Flickr for removed photos
+FLICKR_PLACEHOLDER_DIGEST = '0f28f49410a89e24c95acfd345210cc6f2294814584ad7c60f698fee74e46aad'
+
 class FilterException(Exception):
     pass
 
@@ -29,6 +36,14 @@ class ImageProcessorSettings(object):
         conversion - settings related to the standardization and re-writing of
             downloaded images
         thumbnail - settings related to the generation of thumbnails for downloaded images
+
+    To generate thumbnails of several sizes in one pass, `thumbnail` can instead
+    be set to a list of dicts, one per thumbnail. Keys missing from these take
+    their default values e.g.:
+
+        opts.thumbnail = [dict(width=90, height=90),
+                          dict(width=256, height=256),
+                          dict(width=512, height=512, pad_to_size=False)]
     """
 
     def __init__(self):
@@ -37,7 +52,19 @@ class ImageProcessorSettings(object):
                            max_width = 10000,
                            max_height = 10000,
                            max_size_bytes = 2*4*1024*1024, #2 MP
-                           remove_flickr_placeholders = False)
+                           # size of the downloaded file (compressed images exceeding
+                           #  this would generally also exceed max_size_bytes)
+                           max_download_bytes = 2*4*1024*1024,
+                           # reject responses with a non-image Content-Type
+                           check_content_type = True,
+                           remove_flickr_placeholders = False,
+                           # SHA-256 hex digests of images to reject (e.g. the
+                           #  'image removed' placeholders of other hosts)
+                           blacklist_hashes = set(),
+                           # collapse images within this Hamming distance of the
+                           #  perceptual hash of an earlier image in the batch
+                           #  (-1 = disabled)
+                           near_duplicate_threshold = -1)
 
         self.conversion = dict(format = 'jpg',
                                suffix = '-clean',
@@ -52,6 +79,23 @@ class ImageProcessorSettings(object):
                               height = 90,
                               pad_to_size = True)
 
+    def load_hash_blacklist(self, fn):
+        """Add the SHA-256 hex digests listed in file fn (one per line, with
+        blank lines and lines starting with '#' ignored) to the blacklist"""
+        with open(fn) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    self.filter['blacklist_hashes'].add(line.lower())
+
+    def thumbnail_specs(self):
+        """Returns a list of complete thumbnail settings dicts, one per thumbnail"""
+        specs = self.thumbnail
+        if isinstance(specs, dict):
+            specs = [specs]
+        defaults = ImageProcessorSettings().thumbnail
+        return [dict(defaults, **spec) for spec in specs]
+
 
 class ImageProcessor(object):
     """Base class providing utility methods for cleaning up images downloaded
@@ -64,7 +108,7 @@ class ImageProcessor(object):
     # Create filenames
 
     def _filename_from_urldata(self, urldata):
-        extension = os.path.splitext(urlparse.urlparse(urldata['url']).path)[1]
+        extension = os.path.splitext(urllib.parse.urlparse(urldata['url']).path)[1]
         fn = urldata['image_id'] + extension
         return fn
 
@@ -76,62 +120,124 @@ class ImageProcessor(object):
             clean_fn = os.path.join(self.opts.conversion['subdir'], clean_fn)
         return clean_fn
 
-    def _thumb_filename_from_filename(self, fn):
+    def _thumb_filename_from_filename(self, fn, spec=None):
+        if spec is None:
+            spec = self.opts.thumbnail_specs()[0]
         name = os.path.splitext(fn)[0]
-        suffix = self.opts.thumbnail['suffix']
-        width, height = self.opts.thumbnail['width'], self.opts.thumbnail['height']
-        extension = self.opts.thumbnail['format'].lower()
+        suffix = spec['suffix']
+        width, height = spec['width'], spec['height']
+        extension = spec['format'].lower()
         thumb_fn = '%s%s-%dx%d.%s' % (name, suffix, width, height, extension)
-        if self.opts.thumbnail['subdir']:
-            thumb_fn = os.path.join(self.opts.thumbnail['subdir'], thumb_fn)
+        if spec['subdir']:
+            thumb_fn = os.path.join(spec['subdir'], thumb_fn)
         return thumb_fn
 
+    def _thumb_filenames_from_filename(self, fn):
+        return [self._thumb_filename_from_filename(fn, spec)
+                for spec in self.opts.thumbnail_specs()]
+
+    def _settings_fingerprint(self):
+        # identifies the settings which determine the outputs of process_image
+        # (images matching the blacklist are rejected before they are stored,
+        # so it needn't be included)
+        filter_settings = dict((k, v) for k, v in self.opts.filter.items()
+                               if k != 'blacklist_hashes')
+        settings = json.dumps([filter_settings, self.opts.conversion,
+                               self.opts.thumbnail_specs()],
+                              sort_keys=True)
+        return hashlib.sha1(settings.encode('utf-8')).hexdigest()[:16]
+
     # Process image and standardize it
-    def process_image(self, fn):
-        """Process a single image, saving a cleaned up version of the image + thumbnail
+    def process_image(self, fn, data=None, digest=None, blacklist_checked=False):
+        """Process a single image, saving a cleaned up version of the image + thumbnails
 
         Args:
             fn: the filename of the image to process
+            [data]: the content of the image, if it has not been written to fn
+                (output filenames are still derived from fn)
+            [digest]: the SHA-256 hex digest of the image, if already known
+            [blacklist_checked]: whether digest has already been checked
+                against the blacklist
 
         Returns:
-            A tuple (clean_fn, thumb_fn) containing the filenames of the saved
-            cleaned up image and thumbnail
+            A tuple (clean_fn, thumb_fns, image_hash) containing the filename of
+            the saved cleaned up image, a list of the filenames of the saved
+            thumbnails (in the order of `opts.thumbnail_specs()`) and, if
+            near-duplicate filtering is enabled, the perceptual hash of the first
+            thumbnail (otherwise None)
 
         """
-        im = imutils.LazyImage(fn)
-        self._filter_image(fn)
-
-        # write converted version
         clean_fn = self._clean_filename_from_filename(fn)
-        if not imutils.image_exists(clean_fn):
-            if self.opts.filter['remove_flickr_placeholders']:
-                self._filter_flickr_placeholder(fn)
-            convimg = imutils.downsize_by_max_dims(im.image,
-                                                   (self.opts.conversion['max_height'],
-                                                    self.opts.conversion['max_width']))
-            imutils.save_image(clean_fn, convimg)
-        else:
-            log.info('Converted image available: %s', clean_fn)
-
-        # write thumbnail
-        thumb_fn = self._thumb_filename_from_filename(fn)
-        if not imutils.image_exists(thumb_fn):
-            thumbnail = imutils.create_thumbnail(im.image,
-                                                 (self.opts.thumbnail['height'],
-                                                  self.opts.thumbnail['width']))
-            imutils.save_image(thumb_fn, thumbnail)
-        else:
-            log.info('Thumbnail image available: %s', thumb_fn)
-
-        return clean_fn, thumb_fn
-
-    def _filter_image(self, fn):
-        # This is faster than reading the full image into memory: the PIL open
-        # function is lazy and only reads the header until the data is requested
-        im = PILImage.open(fn)
-        w, h = im.size
+        clean_shape = (self.opts.conversion['max_height'],
+                       self.opts.conversion['max_width'])
+        thumb_specs = self.opts.thumbnail_specs()
+        thumb_fns = [self._thumb_filename_from_filename(fn, spec) for spec in thumb_specs]
+        image_hash = None
+
+        # the file is opened once: PIL only reads the header until the image
+        # data is requested, so filtering doesn't require a full decode
+        with PILImage.open(fn if data is None else io.BytesIO(data)) as im:
+            self._filter_image_size(im.size[0], im.size[1], im.mode)
+            if not blacklist_checked and self._has_hash_blacklist():
+                if digest is None:
+                    digest = (imutils.file_digest(fn) if data is None
+                              else hashlib.sha256(data).hexdigest())
+                self._filter_blacklisted_digest(digest)
+
+            # write converted version
+            convimg = None
+            if not imutils.image_exists(clean_fn):
+                convimg = imutils.downsize_by_max_dims(imutils.decode_image(im, clean_shape),
+                                                       clean_shape)
+                imutils.save_image(clean_fn, convimg)
+            else:
+                log.info('Converted image available: %s', clean_fn)
+
+            # write thumbnails, largest first, each resized from the previous
+            # one (or from the downsized converted image for the first)
+            missing = [(spec, thumb_fn) for spec, thumb_fn in zip(thumb_specs, thumb_fns)
+                       if not imutils.image_exists(thumb_fn)]
+            for thumb_fn in thumb_fns:
+                if imutils.image_exists(thumb_fn):
+                    log.info('Thumbnail image available: %s', thumb_fn)
+            if missing:
+                # order by the scale the image is reduced to for each thumbnail
+                missing.sort(key=lambda m: imutils.downsize_factor(im.size,
+                                                                   (m[0]['height'], m[0]['width'])),
+                             reverse=True)
+                if convimg is None:
+                    spec = missing[0][0]
+                    convimg = imutils.decode_image(im, (spec['height'], spec['width']))
+                resized = convimg
+                for spec, thumb_fn in missing:
+                    thumb_shape = (spec['height'], spec['width'])
+                    resized = imutils.downsize_by_max_dims(resized, thumb_shape)
+                    thumbnail = resized
+                    if spec['pad_to_size']:
+                        thumbnail = imutils.pad_to_shape(resized, thumb_shape)
+                    imutils.save_image(thumb_fn, thumbnail)
+                    if image_hash is None and thumb_fn == thumb_fns[0]:
+                        image_hash = self._image_hash(thumbnail)
+
+        # hash of the first thumbnail, if it was already available
+        if image_hash is None:
+            image_hash = self._image_hash_file(thumb_fns[0])
+
+        return clean_fn, thumb_fns, image_hash
+
+    def _image_hash(self, im):
+        if self.opts.filter['near_duplicate_threshold'] < 0:
+            return None
+        return dhash(im)
+
+    def _image_hash_file(self, fn):
+        if self.opts.filter['near_duplicate_threshold'] < 0:
+            return None
+        return dhash_file(fn)
+
+    def _filter_image_size(self, w, h, mode):
         # This is an in memory size *estimate*
-        nbytes = w * h * len(im.mode)
+        nbytes = w * h * len(mode)
 
         if w < self.opts.filter['min_width']:
             raise FilterException('w < min_width')
@@ -144,8 +250,23 @@ class ImageProcessor(object):
         if nbytes > self.opts.filter['max_size_bytes']:
             raise FilterException('nbytes > max_size_bytes')
 
-    def _filter_flickr_placeholder(self, fn):
-        import hashlib
-        with open(fn) as fid:
-            if hashlib.sha256(fid.read()).hexdigest() == '0f28f49410a89e24c95acfd345210cc6f2294814584ad7c60f698fee74e46aad':
-                raise FilterException('Flickr placeholder image filtered')
+    def _has_hash_blacklist(self):
+        return (self.opts.filter['remove_flickr_placeholders'] or
+                bool(self.opts.filter['blacklist_hashes']))
+
+    def _filter_blacklisted_digest(self, digest):
+        if digest in self.opts.filter['blacklist_hashes']:
+            raise FilterException('Blacklisted image filtered')
+        if (self.opts.filter['remove_flickr_placeholders'] and
+            digest == FLICKR_PLACEHOLDER_DIGEST):
+            raise FilterException('Flickr placeholder image filtered')
+
+
+def process_image_file(fn, opts, data=None, digest=None, blacklist_checked=False):
+    """Process a single image using settings opts, as ImageProcessor.process_image()
+
+    Intended for use in worker processes, so takes only picklable arguments.
+    """
+    processor = ImageProcessor()
+    processor.opts = opts
+    return processor.process_image(fn, data, digest, blacklist_checked)
@@ -9,6 +9,8 @@ Created on: 19 Oct 2012
 
 from PIL import Image as PILImage
 import math
+import io
+import hashlib
 
 def image_exists(fn):
     try:
@@ -17,17 +19,44 @@ def image_exists(fn):
         return False
     return True
 
-def load_image(fn):
-    im = PILImage.open(fn)
+def file_digest(fn, chunk_size=64*1024):
+    """Returns the SHA-256 hex digest of the contents of file fn"""
+    digest = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def decode_image(im, shape=None):
+    """Decode an opened (lazily loaded) PIL image as RGB
+
+    If the image will be downsized to fit within shape=(height, width), formats
+    supporting it (JPEG) are decoded at the smallest reduced scale which is still
+    at least as large as the downsized image, saving time and memory.
+    """
+    if shape is not None:
+        w, h = im.size
+        sf = downsize_factor(im.size, shape)
+        if sf < 1.0:
+            im.draft("RGB", (int(sf*w), int(sf*h)))
     if im.mode != "RGB":
         im = im.convert("RGB")
     return im
 
+def image_info_from_header(data):
+    """Returns the (width, height, mode) of an image given the first bytes of
+    the image file, or None if these do not yet contain the full image header"""
+    try:
+        im = PILImage.open(io.BytesIO(data))
+    except Exception:
+        return None
+    return im.size + (im.mode,)
+
 def save_image(fn, im):
     im.save(fn)
 
-def downsize_by_max_dims(im, shape=(10000,10000)):
-    w, h = im.size
+def downsize_factor(size, shape):
+    w, h = size
     sf = 1.0
     if h > shape[0]:
         sf = float(shape[0])/h
@@ -35,32 +64,21 @@ def downsize_by_max_dims(im, shape=(10000,10000)):
         sf2 = float(shape[1])/w
         if sf2 < sf:
             sf = sf2
+    return sf
+
+def downsize_by_max_dims(im, shape=(10000,10000)):
+    w, h = im.size
+    sf = downsize_factor(im.size, shape)
     if sf < 1.0:
-        resized = im.resize((int(sf*w), int(sf*h)), PILImage.ANTIALIAS)
+        resized = im.resize((int(sf*w), int(sf*h)), PILImage.LANCZOS)
         return resized
     else:
         return im
 
-def create_thumbnail(im, shape=(128,128), pad_to_size=True):
-    resized = downsize_by_max_dims(im, shape)
+def pad_to_shape(im, shape):
     nw, nh = im.size
-    resized = im.resize((nw, nh), PILImage.ANTIALIAS)
-    if pad_to_size:
-        thumbnail = PILImage.new('RGB', shape)
-        cx = int((shape[1] - nw) / 2.0)
-        cy = int((shape[0] - nh) / 2.0)
-        thumbnail.paste(resized, (cy,cx))
-        return thumbnail
-    else:
-        return resized
-
-class LazyImage(object):
-    def __init__(self, filename):
-        self.filename = filename
-        self._image = None
-
-    @property
-    def image(self):
-        if self._image is None:
-            self._image = load_image(self.filename)
-        return self._image
+    padded = PILImage.new('RGB', (shape[1], shape[0]))
+    cx = int((shape[1] - nw) / 2.0)
+    cy = int((shape[0] - nh) / 2.0)
+    padded.paste(im, (cx,cy))
+    return padded
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+"""
+Module: near_duplicates
+Created on: 18 Oct 2026
+"""
+
+import numpy as np
+from PIL import Image as PILImage
+
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE*HASH_SIZE
+
+def dhash(im, hash_size=HASH_SIZE):
+    """Returns the difference hash of a PIL image as an integer of hash_size**2
+    bits, each bit indicating whether a pixel of the downsampled greyscale
+    image is brighter than its neighbour to the right"""
+    small = im.convert('L').resize((hash_size + 1, hash_size), PILImage.BILINEAR)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def dhash_file(fn, hash_size=HASH_SIZE):
+    """Returns the difference hash of the image in file fn"""
+    with PILImage.open(fn) as im:
+        return dhash(im, hash_size)
+
+def hamming_distance(hash_a, hash_b):
+    return bin(hash_a ^ hash_b).count('1')
+
+
+class NearDuplicateIndex(object):
+    """Index of image hashes supporting lookup of near-duplicates
+
+    Initializer Args:
+        [threshold]: maximum Hamming distance between the hashes of two images
+            for them to be considered near-duplicates
+        [hash_bits]: number of bits in each hash
+
+    Hashes are split into threshold+1 disjoint bands, each indexed separately.
+    Any two hashes within the threshold must match exactly on at least one band,
+    so only the hashes sharing a band with the query need to be compared.
+    """
+
+    def __init__(self, threshold=4, hash_bits=HASH_BITS):
+        self.threshold = threshold
+        if threshold >= hash_bits:
+            # all hashes are within the threshold, so compare them all using a
+            # single empty band
+            self._bands = [(0, 0)]
+        else:
+            num_bands = threshold + 1
+            bounds = [band*hash_bits // num_bands for band in range(num_bands + 1)]
+            # (bit offset, mask) of each band
+            self._bands = [(start, (1 << (end - start)) - 1)
+                           for start, end in zip(bounds[:-1], bounds[1:])]
+        self._band_tables = [dict() for _ in self._bands]
+
+    def find(self, image_hash):
+        """Returns the item added with a hash within threshold of image_hash,
+        or None if there is none"""
+        for (offset, mask), table in zip(self._bands, self._band_tables):
+            for other_hash, item in table.get((image_hash >> offset) & mask, []):
+                if hamming_distance(image_hash, other_hash) <= self.threshold:
+                    return item
+        return None
+
+    def add(self, image_hash, item):
+        for (offset, mask), table in zip(self._bands, self._band_tables):
+            table.setdefault((image_hash >> offset) & mask, []).append((image_hash, item))
+
+    def find_or_add(self, image_hash, item):
+        """Returns the item of a near-duplicate of image_hash if there is one,
+        otherwise adds image_hash to the index and returns None"""
+        duplicate = self.find(image_hash)
+        if duplicate is None:
+            self.add(image_hash, item)
+        return duplicate
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+"""
+Module: worker_pool
+Created on: 18 Oct 2026
+"""
+
+import logging
+import multiprocessing
+from concurrent import futures
+from concurrent.futures import ProcessPoolExecutor
+from gevent.lock import BoundedSemaphore
+from gevent.threadpool import ThreadPool
+
+log = logging.getLogger(__name__)
+
+class ProcessWorkerPool(object):
+    """Pool of worker processes which can be used cooperatively from greenlets
+
+    Initializer Args:
+        [processes]: the number of worker processes (default: # CPUs)
+        [max_pending]: maximum number of tasks submitted to the pool at once
+            (default: twice the number of processes)
+
+    Tasks are run using `apply()`, which blocks only the calling greenlet until
+    the task completes in a worker process. Once `max_pending` tasks have been
+    submitted, further calls wait until a task completes, so callers are slowed
+    to the rate at which the workers can process tasks.
+
+    Functions and arguments must be picklable (e.g. module-level functions).
+    """
+
+    def __init__(self, processes=-1, max_pending=-1):
+        if processes == -1:
+            processes = multiprocessing.cpu_count()
+        if max_pending == -1:
+            max_pending = 2*processes
+        self.processes = processes
+        # multiprocessing.Pool can't be used here, as its task handler thread
+        # blocks on a queue which gevent has monkey-patched. Workers are started
+        # from a fork server so that they aren't children of this process, which
+        # gevent would otherwise try to reap from the executor's thread
+        self._executor = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context('forkserver'))
+        # each pending task is waited on from a thread, so the gevent hub is
+        # free to run other greenlets in the meantime
+        self._waiters = ThreadPool(max_pending)
+        self._pending = BoundedSemaphore(max_pending)
+
+    def apply(self, func, args=(), kwargs={}):
+        """Run func(*args, **kwargs) in a worker process, returning the result
+        or re-raising any exception raised by func"""
+        with self._pending:
+            future = self._executor.submit(func, *args, **kwargs)
+            try:
+                self._waiters.apply(futures.wait, ([future],))
+            except BaseException:
+                future.cancel()
+                raise
+            return future.result()
+
+    def start(self):
+        """Start all of the worker processes, returning once they are ready
+        (otherwise workers are only started as tasks are submitted)"""
+        started = [self._executor.submit(_worker_ready) for _ in range(self.processes)]
+        self._waiters.apply(futures.wait, (started,))
+
+    def terminate(self):
+        log.debug('Terminating worker processes...')
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._waiters.kill()
+
+
+def _worker_ready():
+    pass
+
+
+_process_pools = dict()
+
+def get_process_pool(processes=-1):
+    """Returns a long-lived ProcessWorkerPool with the given number of workers,
+    shared by all callers in the process"""
+    if processes not in _process_pools:
+        _process_pools[processes] = ProcessWorkerPool(processes)
+        _process_pools[processes].start()
+    return _process_pools[processes]
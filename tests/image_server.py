@@ -0,0 +1,59 @@
+import io
+import gevent
+import numpy as np
+from PIL import Image as PILImage
+from gevent.pywsgi import WSGIServer
+
+def make_image(width=120, height=80, seed=0, fmt='JPEG'):
+    """Returns the encoded bytes of a random image, distinct for each seed"""
+    rng = np.random.RandomState(seed)
+    # smooth random pattern, so that resized copies have similar hashes
+    small = rng.randint(0, 255, (4, 6, 3)).astype(np.uint8)
+    im = PILImage.fromarray(small).resize((width, height), PILImage.BILINEAR)
+    buf = io.BytesIO()
+    im.save(buf, fmt)
+    return buf.getvalue()
+
+
+class ImageServer(object):
+    """Local HTTP server returning fixed responses, recording the paths of
+    the requests it receives"""
+
+    def __init__(self):
+        self.responses = dict()
+        self.requests = []
+        self._server = WSGIServer(('127.0.0.1', 0), self._app, log=None)
+        self._server.start()
+        self.port = self._server.server_port
+
+    def add(self, path, body, content_type='image/jpeg', headers=None, delay=0.0):
+        response_headers = {'Content-Type': content_type,
+                            'Content-Length': str(len(body))}
+        # headers given replace the defaults, or remove them if None
+        response_headers.update(headers or dict())
+        self.responses[path] = (body, [(name, value) for name, value
+                                       in response_headers.items()
+                                       if value is not None], delay)
+        return self.url(path)
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.port, path)
+
+    def urldata(self, path, image_id=None):
+        if image_id is None:
+            image_id = path.strip('/').split('.')[0]
+        return dict(url=self.url(path), image_id=image_id)
+
+    def stop(self):
+        self._server.stop()
+
+    def _app(self, environ, start_response):
+        path = environ['PATH_INFO']
+        self.requests.append(path)
+        if path not in self.responses:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'not found']
+        body, headers, delay = self.responses[path]
+        gevent.sleep(delay)
+        start_response('200 OK', headers)
+        return [body]
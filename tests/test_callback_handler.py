@@ -0,0 +1,147 @@
+import os
+import time
+import gevent
+import pytest
+
+from imsearchtools import process
+from imsearchtools.process.callback_handler import CallbackHandler
+from imsearchtools.process.callback_backends import get_callback_backend
+from imsearchtools.process.callback_handler_zmq import CallbackFabric, \
+     get_callback_fabric, set_callback_fabric_worker_count
+
+def square_in_worker(value):
+    # module-level, so that it can be sent to the process backend's workers
+    if value is None:
+        raise ValueError('bad value')
+    return (value*value, os.getpid())
+
+
+class TestCallbackHandler(object):
+
+    def setup_method(self):
+        self._completed = []
+
+    def _callback(self, value, duration=0.0):
+        gevent.sleep(duration)
+        if value is None:
+            raise ValueError('bad value')
+        self._completed.append(value)
+
+    def test_join_returns_on_completion(self):
+        handler = CallbackHandler(self._callback, 3, worker_count=2)
+        for value in range(2):
+            handler.run_callback(value, 0.01)
+        handler.skip()
+        start = time.time()
+        handler.join()
+        assert time.time() - start < 0.05
+        assert sorted(self._completed) == [0, 1]
+
+    def test_failed_callback_counts_as_completed(self):
+        handler = CallbackHandler(self._callback, 2, worker_count=2)
+        handler.run_callback(None)
+        handler.run_callback(1)
+        handler.join()
+        assert handler.task_count == 0
+        assert self._completed == [1]
+
+    def test_idle_timeout(self):
+        handler = CallbackHandler(self._callback, 2, worker_count=2,
+                                  idle_timeout=0.05)
+        handler.run_callback(0)
+        handler.run_callback(1, 10.0)
+        start = time.time()
+        handler.join()
+        assert time.time() - start < 1.0
+        assert self._completed == [0]
+
+    def test_overall_timeout(self):
+        handler = CallbackHandler(self._callback, 10, worker_count=1,
+                                  timeout=0.1, idle_timeout=-1)
+        for value in range(10):
+            handler.run_callback(value, 0.04)
+        start = time.time()
+        handler.join()
+        assert time.time() - start < 0.5
+        assert 0 < len(self._completed) < 10
+
+    def test_thread_backend(self):
+        handler_cls = get_callback_backend('thread')
+        handler = handler_cls(self._callback, 3, worker_count=2)
+        results = [handler.run_callback(value) for value in [0, 1, None]]
+        handler.join()
+        assert sorted(self._completed) == [0, 1]
+        assert isinstance(results[2].exception, ValueError)
+
+    def test_exported_by_process_package(self):
+        assert process.CallbackHandler is CallbackHandler
+
+    def test_process_backend(self):
+        handler_cls = get_callback_backend('process')
+        handler = handler_cls(square_in_worker, 4, worker_count=2)
+        results = [handler.run_callback(value) for value in [2, 3, 4, None]]
+        handler.join()
+        assert [result.get()[0] for result in results[:3]] == [4, 9, 16]
+        assert all(result.get()[1] != os.getpid() for result in results[:3])
+        assert isinstance(results[3].exception, ValueError)
+        # the pool of worker processes is shared by later handlers
+        assert handler_cls(square_in_worker, 1, worker_count=2).process_pool is \
+               handler.process_pool
+
+    def test_unknown_backend(self):
+        with pytest.raises(ValueError):
+            get_callback_backend('carrier_pigeon')
+
+    def test_zmq_backend_concurrent_batches(self):
+        handler_cls = get_callback_backend('zmq')
+        handlers = [handler_cls(self._callback, 3, worker_count=2)
+                    for _ in range(2)]
+        results = [[handler.run_callback(value, 0.01) for value in values]
+                   for handler, values in zip(handlers, [[0, 1, None], [10, 11, 12]])]
+        gevent.joinall([gevent.spawn(handler.join) for handler in handlers])
+        assert sorted(self._completed) == [0, 1, 10, 11, 12]
+        assert [result.get() for result in results[1]] == [None]*3
+        assert isinstance(results[0][2].exception, ValueError)
+        assert handlers[0].fabric is handlers[1].fabric
+
+    def test_zmq_backend_timeout_stops_callback(self):
+        handler_cls = get_callback_backend('zmq')
+        handler = handler_cls(self._callback, 2, worker_count=2, timeout=0.1)
+        handler.run_callback(0)
+        handler.run_callback(1, 0.5)
+        handler.join()
+        assert not handler.fabric._running
+        gevent.sleep(0.6)
+        assert self._completed == [0]
+
+    def test_zmq_fabric_worker_count(self):
+        fabric = CallbackFabric(worker_count=2)
+        try:
+            assert len(fabric._workers) == 2
+            results = [fabric.submit(b'batch', self._callback, (value, 0.05), dict())[1]
+                       for value in range(4)]
+            start = time.time()
+            gevent.joinall(results)
+            assert time.time() - start >= 0.1
+            assert sorted(self._completed) == [0, 1, 2, 3]
+        finally:
+            fabric.terminate()
+
+    def test_zmq_fabric_grown_to_worker_count(self):
+        handler_cls = get_callback_backend('zmq')
+        handler = handler_cls(self._callback, 32, worker_count=32)
+        assert handler.fabric.worker_count >= 32
+        start = time.time()
+        for value in range(32):
+            handler.run_callback(value, 0.2)
+        handler.join()
+        assert time.time() - start < 0.4
+        assert len(self._completed) == 32
+
+    def test_zmq_fabric_worker_count_only_grows(self):
+        fabric = get_callback_fabric()
+        worker_count = fabric.worker_count
+        set_callback_fabric_worker_count(worker_count + 1)
+        assert len(fabric._workers) == worker_count + 1
+        set_callback_fabric_worker_count(1)
+        assert fabric.worker_count == worker_count + 1
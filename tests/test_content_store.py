@@ -0,0 +1,78 @@
+import os
+import tempfile
+
+from imsearchtools.process import ImageGetter, ImageProcessorSettings, ContentStore
+
+from .image_server import ImageServer, make_image
+
+class TestContentStore(object):
+
+    def setup_method(self):
+        self._server = ImageServer()
+        self._outdir = tempfile.mkdtemp()
+        self._store = ContentStore(os.path.join(self._outdir, '.store'))
+        self._opts = ImageProcessorSettings()
+
+    def teardown_method(self):
+        self._server.stop()
+
+    def _process(self, paths, **kwargs):
+        getter = ImageGetter(opts=self._opts, content_store=self._store, timeout=10.0,
+                             **kwargs)
+        return getter.process_urls([self._server.urldata(path) for path in paths],
+                                   self._outdir)
+
+    def _stored_files(self):
+        return [fn for _, _, fns in os.walk(self._store.root_dir) for fn in fns]
+
+    def test_same_image_processed_once(self):
+        image = make_image()
+        self._server.add('/a.jpg', image)
+        self._server.add('/b.jpg', image)
+        results = sorted(self._process(['/a.jpg', '/b.jpg']), key=lambda r: r['image_id'])
+        assert len(results) == 2
+        for field in ['orig_fn', 'clean_fn', 'thumb_fn']:
+            assert os.path.samefile(results[0][field], results[1][field])
+        # one original, clean image and thumbnail in the store
+        assert len(self._stored_files()) == 3
+        assert self._store.stats == dict(unique=1, duplicates=1, dedup_ratio=0.5)
+
+    def test_rerun_reuses_outputs(self):
+        self._server.add('/a.jpg', make_image())
+        self._process(['/a.jpg'])
+        results = self._process(['/a.jpg'])
+        assert len(results) == 1
+        assert os.path.exists(results[0]['clean_fn'])
+        assert self._store.stats['unique'] == 1
+        assert self._store.stats['duplicates'] == 0
+
+    def test_original_added_to_stored_image(self):
+        self._server.add('/a.jpg', make_image())
+        self._server.add('/b.jpg', make_image())
+        self._process(['/a.jpg', '/b.jpg'], keep_originals=False)
+        results = self._process(['/a.jpg', '/b.jpg'])
+        assert len(results) == 2
+        assert os.path.samefile(results[0]['orig_fn'], results[1]['orig_fn'])
+        assert len(self._stored_files()) == 3
+        assert self._store.stats['unique'] == 1
+
+    def test_symlink_when_hard_link_fails(self, monkeypatch):
+        def no_link(src, dst):
+            raise OSError('cross-device link')
+        monkeypatch.setattr(os, 'link', no_link)
+        self._server.add('/a.jpg', make_image())
+        result = self._process(['/a.jpg'])[0]
+        assert os.path.islink(result['clean_fn'])
+        assert os.path.isabs(os.readlink(result['clean_fn']))
+        assert os.path.exists(result['clean_fn'])
+
+    def test_filtered_image_removed_from_store(self):
+        self._server.add('/a.jpg', make_image())
+        self._process(['/a.jpg'])
+        # the downloaded original is processed again, as the settings differ
+        self._opts = ImageProcessorSettings()
+        self._opts.filter['min_width'] = 1000
+        assert self._process(['/a.jpg']) == []
+        assert len(self._server.requests) == 1
+        assert len(self._stored_files()) == 3
+        assert self._store.stats['unique'] == 1
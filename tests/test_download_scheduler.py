@@ -0,0 +1,62 @@
+import gevent
+
+from imsearchtools.process.download_scheduler import DownloadScheduler
+from imsearchtools.process import ImageGetter
+
+class TestDownloadScheduler(object):
+
+    def setup_method(self):
+        self._scheduler = DownloadScheduler(max_concurrent=4, max_per_host=2)
+        self._active = dict()
+        self._peak_total = 0
+        self._peak_per_host = dict()
+        self._started = []
+
+    def _download(self, host, duration):
+        with self._scheduler.slot(host):
+            self._started.append(host)
+            self._active[host] = self._active.get(host, 0) + 1
+            self._peak_total = max(self._peak_total, sum(self._active.values()))
+            self._peak_per_host[host] = max(self._peak_per_host.get(host, 0),
+                                            self._active[host])
+            gevent.sleep(duration)
+            self._active[host] -= 1
+
+    def test_limits_respected(self):
+        jobs = [gevent.spawn(self._download, host, 0.01)
+                for host in ['a']*6 + ['b']*6 + ['c']*6]
+        gevent.joinall(jobs)
+        assert len(self._started) == 18
+        assert self._peak_total == 4
+        assert max(self._peak_per_host.values()) == 2
+
+    def test_slow_host_does_not_starve_others(self):
+        jobs = [gevent.spawn(self._download, 'slow', 0.1) for _ in range(10)]
+        jobs += [gevent.spawn(self._download, 'fast', 0.01) for _ in range(4)]
+        gevent.joinall(jobs)
+        # all downloads from the fast host start before the slow host's backlog
+        assert self._started.index('fast') == 2
+        assert self._started[:6].count('fast') == 4
+
+    def test_killed_waiters_release_slots(self):
+        jobs = [gevent.spawn(self._download, 'a', 0.05) for _ in range(5)]
+        gevent.sleep(0.01)
+        gevent.killall(jobs[2:])
+        gevent.joinall(jobs)
+        assert self._scheduler._active_total == 0
+        assert not self._scheduler._waiting
+
+    def test_limits_shared_between_getters(self):
+        getters = [ImageGetter(max_downloads=4, max_downloads_per_host=2)
+                   for _ in range(2)]
+        self._scheduler = getters[0]._download_scheduler
+        # downloads by one getter use up the per-host limit of the other
+        for _ in range(2):
+            getters[1]._download_scheduler.acquire('a')
+        job = gevent.spawn(self._download, 'a', 0.01)
+        gevent.sleep(0.02)
+        assert self._started == []
+        for _ in range(2):
+            getters[1]._download_scheduler.release('a')
+        job.join()
+        assert self._started == ['a']
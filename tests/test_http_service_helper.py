@@ -0,0 +1,103 @@
+import os
+import pickle
+import tempfile
+import zmq
+
+from imsearchtools import http_service_helper
+
+class TestPrepareDownload(object):
+
+    def setup_method(self):
+        self._outdir = tempfile.mkdtemp()
+
+    def teardown_method(self):
+        http_service_helper._hash_blacklist.clear()
+
+    def _process_args(self, postproc_extra_prms, imgetter_params=None,
+                      zmq_context=None):
+        _, _, process_args = http_service_helper._prepare_download('visor_faces',
+                                                                   postproc_extra_prms,
+                                                                   self._outdir,
+                                                                   imgetter_params,
+                                                                   zmq_context)
+        return process_args
+
+    def test_workers_sized_for_batches(self):
+        process_args = self._process_args(dict(batch_size=16))
+        assert process_args['completion_worker_count'] >= 32
+
+    def test_workers_sized_for_batches_on_zmq_backend(self):
+        process_args = self._process_args(dict(batch_size=16),
+                                          dict(postproc_backend='zmq'))
+        assert process_args['completion_worker_count'] >= 32
+
+    def test_default_workers_without_batching(self):
+        assert 'completion_worker_count' not in self._process_args(dict())
+        process_args = self._process_args(dict(batch_size=16),
+                                          dict(postproc_backend='process'))
+        assert 'completion_worker_count' not in process_args
+
+    def test_zmq_context_not_sent_to_worker_processes(self):
+        context = zmq.Context()
+        try:
+            process_args = self._process_args(dict(featdir='/tmp'), zmq_context=context)
+            assert process_args['completion_extra_prms']['zmq_context'] is context
+            process_args = self._process_args(dict(featdir='/tmp'),
+                                              dict(postproc_backend='process'),
+                                              zmq_context=context)
+            assert process_args['completion_backend'] == 'process'
+            pickle.dumps(process_args['completion_extra_prms'])
+        finally:
+            context.term()
+
+    def test_postproc_timeouts(self):
+        imgetter, _, _ = http_service_helper._prepare_download(None, None, self._outdir,
+                                                               dict(postproc_timeout=10.0,
+                                                                    postproc_idle_timeout=-1.0),
+                                                               None)
+        assert imgetter.completion_timeout == 10.0
+        assert imgetter.completion_idle_timeout == -1.0
+
+    def test_hash_blacklist_applied(self):
+        blacklist_fn = os.path.join(self._outdir, 'blacklist.txt')
+        with open(blacklist_fn, 'w') as f:
+            f.write('# placeholders\n' + 'AB'*32 + '\n')
+        http_service_helper.load_hash_blacklist(blacklist_fn)
+        for imgetter_params in [None, dict(resize_width=100)]:
+            imgetter, _, _ = http_service_helper._prepare_download(None, None, self._outdir,
+                                                                   imgetter_params, None)
+            assert imgetter.opts.filter['blacklist_hashes'] == set(['ab'*32])
+
+
+class TestGetSearcher(object):
+
+    def test_searcher_shared_across_timeouts(self):
+        searcher = http_service_helper.get_searcher('google_web')
+        assert http_service_helper.get_searcher('google_web') is searcher
+        assert http_service_helper.get_searcher('multi').searchers['google_web'] is searcher
+
+
+class TestSetupResultCache(object):
+
+    def teardown_method(self):
+        http_service_helper.image_query.set_result_cache(None)
+
+    def test_memory_cache(self):
+        cache = http_service_helper.setup_result_cache()
+        assert http_service_helper.get_searcher('google_web').result_cache is cache
+        assert cache.ttl == http_service_helper.RESULT_CACHE_TTL
+
+    def test_persistent_cache(self, monkeypatch):
+        db_fn = os.path.join(tempfile.mkdtemp(), 'cache.db')
+        monkeypatch.setattr(http_service_helper, 'RESULT_CACHE_DB_FN', db_fn)
+        cache = http_service_helper.setup_result_cache()
+        results = [dict(url='http://example.com/a.jpg')]
+        cache.set(('engine', 'q'), results)
+        # the results are read back from disk by a new cache
+        store = http_service_helper.image_query.SqliteCacheStore(db_fn)
+        assert http_service_helper.image_query.ResultCache(store=store).get(('engine', 'q')) == results
+
+    def test_disabled(self, monkeypatch):
+        monkeypatch.setattr(http_service_helper, 'RESULT_CACHE_ENABLED', False)
+        assert http_service_helper.setup_result_cache() is None
+        assert http_service_helper.get_searcher('google_web').result_cache is None
@@ -0,0 +1,275 @@
+import os
+import hashlib
+import time
+import tempfile
+import gevent
+from flask import json
+from PIL import Image as PILImage
+
+import imsearch_http_service
+from imsearchtools.process import ImageGetter, ImageProcessorSettings, image_getter
+
+from .image_server import ImageServer, make_image
+
+class ImageGetterTest(object):
+
+    def setup_method(self):
+        self._server = ImageServer()
+        self._outdir = tempfile.mkdtemp()
+        self._opts = ImageProcessorSettings()
+
+    def teardown_method(self):
+        self._server.stop()
+
+    def _process(self, paths, **kwargs):
+        getter = ImageGetter(opts=self._opts, timeout=10.0, **kwargs)
+        return getter.process_urls([self._server.urldata(path) for path in paths],
+                                   self._outdir)
+
+    def _output_files(self):
+        return sorted(os.listdir(self._outdir))
+
+
+class TestDownload(ImageGetterTest):
+
+    def test_original_written(self):
+        image = make_image()
+        self._server.add('/a.jpg', image)
+        result = self._process(['/a.jpg'])[0]
+        with open(result['orig_fn'], 'rb') as f:
+            assert f.read() == image
+        assert self._output_files() == ['a-clean.jpg', 'a-thumb-90x90.jpg', 'a.jpg']
+
+    def test_truncated_download_not_kept(self):
+        image = make_image()
+        self._server.add('/a.jpg', image[:len(image)//2],
+                         headers={'Content-Length': str(len(image))})
+        assert self._process(['/a.jpg']) == []
+        assert self._output_files() == []
+
+    def test_connections_closed_after_batch(self):
+        self._server.add('/a.jpg', make_image())
+        self._server.add('/b.jpg', make_image(seed=1))
+        getter = ImageGetter(opts=self._opts, timeout=10.0)
+        for path in ['/a.jpg', '/b.jpg']:
+            assert len(getter.process_urls([self._server.urldata(path)], self._outdir)) == 1
+            assert len(getter._session.get_adapter(self._server.url(path)).poolmanager.pools) == 0
+
+    def test_existing_original_not_downloaded(self):
+        self._server.add('/a.jpg', make_image())
+        self._process(['/a.jpg'])
+        results = self._process(['/a.jpg'])
+        assert len(results) == 1
+        assert len(self._server.requests) == 1
+
+
+class TestDownloadFilters(ImageGetterTest):
+
+    def test_content_length_too_large(self):
+        self._opts.filter['max_download_bytes'] = 1000
+        self._server.add('/a.jpg', make_image(400, 300))
+        assert self._process(['/a.jpg']) == []
+        assert self._output_files() == []
+
+    def test_download_too_large_without_content_length(self):
+        self._opts.filter['max_download_bytes'] = 1000
+        self._server.add('/a.jpg', make_image(400, 300), headers={'Content-Length': None})
+        assert self._process(['/a.jpg']) == []
+        assert self._output_files() == []
+
+    def test_content_type_not_image(self):
+        self._server.add('/a.jpg', make_image(), content_type='text/html')
+        self._server.add('/b.jpg', make_image(), content_type='application/octet-stream')
+        results = self._process(['/a.jpg', '/b.jpg'])
+        assert [result['image_id'] for result in results] == ['b']
+
+    def test_content_type_not_checked(self):
+        self._opts.filter['check_content_type'] = False
+        self._server.add('/a.jpg', make_image(), content_type='text/html')
+        assert len(self._process(['/a.jpg'])) == 1
+
+    def test_size_filtered_from_header(self):
+        self._opts.filter['max_width'] = 100
+        self._server.add('/a.png', make_image(fmt='PNG'), content_type='image/png')
+        assert self._process(['/a.png']) == []
+        assert self._output_files() == []
+
+
+class TestProcessPool(ImageGetterTest):
+
+    def test_images_processed_in_pool(self):
+        for seed in range(3):
+            self._server.add('/%d.jpg' % seed, make_image(seed=seed))
+        results = self._process(['/%d.jpg' % seed for seed in range(3)],
+                                improc_workers=2)
+        assert len(results) == 3
+        for result in results:
+            assert os.path.exists(result['clean_fn'])
+            assert os.path.exists(result['thumb_fn'])
+
+    def test_near_duplicates_filtered_in_pool(self):
+        self._opts.filter['near_duplicate_threshold'] = 4
+        self._server.add('/a.jpg', make_image(120, 80))
+        self._server.add('/b.jpg', make_image(240, 160))
+        assert len(self._process(['/a.jpg', '/b.jpg'], improc_workers=2)) == 1
+
+
+class InlinePool(object):
+    """Runs tasks given to the process pool inline, recording their arguments"""
+
+    def __init__(self):
+        self.calls = []
+
+    def apply(self, func, args):
+        self.calls.append(args)
+        return func(*args)
+
+
+class TestProcessPoolArgs(ImageGetterTest):
+
+    def test_checked_blacklist_not_sent(self, monkeypatch):
+        pool = InlinePool()
+        monkeypatch.setattr(image_getter, 'get_process_pool', lambda worker_count: pool)
+        blacklisted = make_image(seed=1)
+        self._opts.filter['blacklist_hashes'].add(hashlib.sha256(blacklisted).hexdigest())
+        self._server.add('/a.jpg', make_image())
+        self._server.add('/b.jpg', blacklisted)
+        results = self._process(['/a.jpg', '/b.jpg'], improc_workers=2)
+        assert [result['image_id'] for result in results] == ['a']
+        assert len(pool.calls) == 1
+        opts, blacklist_checked = pool.calls[0][1], pool.calls[0][4]
+        assert blacklist_checked
+        assert opts.filter['blacklist_hashes'] == set()
+        assert len(self._opts.filter['blacklist_hashes']) == 1
+
+
+class TestThumbnails(ImageGetterTest):
+
+    def test_multiple_sizes(self):
+        self._opts.thumbnail = [dict(width=32, height=32),
+                                dict(width=100, height=50, pad_to_size=False),
+                                dict(width=60, height=60, suffix='-small')]
+        self._server.add('/a.jpg', make_image(200, 100))
+        result = self._process(['/a.jpg'])[0]
+        assert result['thumb_fn'] == result['thumb_fns'][0]
+        sizes = [PILImage.open(thumb_fn).size for thumb_fn in result['thumb_fns']]
+        assert sizes == [(32, 32), (100, 50), (60, 60)]
+        assert result['thumb_fns'][2].endswith('a-small-60x60.jpg')
+
+    def test_missing_size_added_on_rerun(self):
+        self._server.add('/a.jpg', make_image())
+        self._process(['/a.jpg'])
+        self._opts.thumbnail = [dict(width=90, height=90), dict(width=40, height=40)]
+        result = self._process(['/a.jpg'])[0]
+        assert all(os.path.exists(thumb_fn) for thumb_fn in result['thumb_fns'])
+        assert len(self._server.requests) == 1
+
+
+class TestInMemory(ImageGetterTest):
+
+    def test_original_not_written(self):
+        self._server.add('/a.jpg', make_image())
+        result = self._process(['/a.jpg'], keep_originals=False)[0]
+        assert result['orig_fn'] is None
+        assert os.path.exists(result['clean_fn'])
+        assert self._output_files() == ['a-clean.jpg', 'a-thumb-90x90.jpg']
+
+    def test_rerun_reuses_outputs(self):
+        self._server.add('/a.jpg', make_image())
+        self._process(['/a.jpg'], keep_originals=False)
+        results = self._process(['/a.jpg'], keep_originals=False)
+        assert len(results) == 1
+        assert len(self._server.requests) == 1
+
+    def test_filtered_image_not_written(self):
+        self._opts.filter['max_size_bytes'] = 100
+        self._server.add('/a.jpg', make_image())
+        assert self._process(['/a.jpg'], keep_originals=False) == []
+        assert self._output_files() == []
+
+
+class TestBlacklist(ImageGetterTest):
+
+    def test_blacklisted_image_rejected(self):
+        image = make_image()
+        self._opts.filter['blacklist_hashes'].add(hashlib.sha256(image).hexdigest())
+        self._server.add('/a.jpg', image)
+        self._server.add('/b.jpg', make_image(seed=1))
+        results = self._process(['/a.jpg', '/b.jpg'])
+        assert [result['image_id'] for result in results] == ['b']
+        assert 'a.jpg' not in self._output_files()
+
+    def test_blacklisted_image_rejected_in_memory(self):
+        image = make_image()
+        self._opts.filter['blacklist_hashes'].add(hashlib.sha256(image).hexdigest())
+        self._server.add('/a.jpg', image)
+        assert self._process(['/a.jpg'], keep_originals=False) == []
+        assert self._output_files() == []
+
+
+class TestCompletionTimeouts(ImageGetterTest):
+
+    def _handler(self, **kwargs):
+        self._server.add('/a.jpg', make_image())
+        getter = ImageGetter(opts=self._opts, timeout=10.0, completion_timeout=20.0,
+                             completion_idle_timeout=-1)
+        completed = []
+        getter.process_urls([self._server.urldata('/a.jpg')], self._outdir,
+                            completion_func=completed.append, **kwargs)
+        assert len(completed) == 1
+        return getter._callback_handler
+
+    def test_timeouts_set_on_getter(self):
+        handler = self._handler()
+        assert (handler.timeout, handler.idle_timeout) == (20.0, -1)
+
+    def test_timeouts_set_per_call(self):
+        handler = self._handler(completion_timeout=5.0, completion_idle_timeout=0.5)
+        assert (handler.timeout, handler.idle_timeout) == (5.0, 0.5)
+
+
+class TestIterProcessUrls(ImageGetterTest):
+
+    def _iter(self, paths, timeout=10.0):
+        getter = ImageGetter(opts=self._opts, timeout=timeout, image_timeout=5.0)
+        return getter.iter_process_urls([self._server.urldata(path) for path in paths],
+                                        self._outdir)
+
+    def test_yields_in_completion_order(self):
+        self._server.add('/a.jpg', make_image(), delay=0.2)
+        self._server.add('/b.jpg', make_image(seed=1))
+        assert [result['image_id'] for result in self._iter(['/a.jpg', '/b.jpg'])] == ['b', 'a']
+
+    def test_stops_at_timeout(self):
+        self._server.add('/a.jpg', make_image(), delay=1.0)
+        self._server.add('/b.jpg', make_image(seed=1))
+        start = time.time()
+        assert [result['image_id'] for result in
+                self._iter(['/a.jpg', '/b.jpg'], timeout=0.3)] == ['b']
+        assert time.time() - start < 0.6
+
+    def test_jobs_killed_when_stopped_early(self):
+        self._server.add('/a.jpg', make_image(), delay=0.3)
+        self._server.add('/b.jpg', make_image(seed=1))
+        results = self._iter(['/a.jpg', '/b.jpg'])
+        assert next(results)['image_id'] == 'b'
+        start = time.time()
+        results.close()
+        assert time.time() - start < 0.1
+        gevent.sleep(0.5)
+        assert 'a.jpg' not in self._output_files()
+
+
+class TestDownloadStream(ImageGetterTest):
+
+    def test_results_streamed(self, monkeypatch):
+        monkeypatch.chdir(self._outdir)
+        self._server.add('/a.jpg', make_image(), delay=0.2)
+        self._server.add('/b.jpg', make_image(seed=1))
+        client = imsearch_http_service.app.test_client()
+        resp = client.post('/download_stream',
+                           json=[self._server.urldata('/a.jpg'), self._server.urldata('/b.jpg')])
+        assert resp.mimetype == 'application/x-ndjson'
+        results = [json.loads(line) for line in resp.data.decode('utf-8').splitlines()]
+        assert [result['image_id'] for result in results] == ['b', 'a']
+        assert results[0]['clean_fn'] == 'http://localhost/static/b-clean.jpg'
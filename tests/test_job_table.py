@@ -0,0 +1,92 @@
+import time
+import tempfile
+from flask import json
+
+import imsearch_http_service
+from imsearchtools import http_service_helper
+from imsearchtools.http_service_helper import JobTable, PipelineJob
+
+from .image_server import ImageServer, make_image
+
+class TestJobTable(object):
+
+    def setup_method(self):
+        self._jobs = [PipelineJob('query %d' % i) for i in range(4)]
+
+    def test_running_jobs_are_kept(self):
+        table = JobTable(retention=0.01, max_jobs=1)
+        for job in self._jobs:
+            table.add(job)
+        time.sleep(0.02)
+        assert all(table.get(job.job_id) is job for job in self._jobs)
+
+    def test_finished_jobs_expire(self):
+        table = JobTable(retention=0.05)
+        for job in self._jobs:
+            table.add(job)
+        table.finish(self._jobs[0])
+        assert table.get(self._jobs[0].job_id) is self._jobs[0]
+        time.sleep(0.1)
+        assert table.get(self._jobs[0].job_id) is None
+        assert len(table) == 3
+
+    def test_oldest_finished_jobs_dropped(self):
+        table = JobTable(retention=-1, max_jobs=2)
+        for job in self._jobs:
+            table.add(job)
+        for job in self._jobs[:3]:
+            table.finish(job)
+        assert table.get(self._jobs[0].job_id) is None
+        assert table.get(self._jobs[1].job_id) is self._jobs[1]
+        assert table.get(self._jobs[3].job_id) is self._jobs[3]
+
+
+class TestPipelineJob(object):
+
+    def setup_method(self):
+        self._server = ImageServer()
+        self._outdir = tempfile.mkdtemp()
+        self._statuses = []
+
+    def teardown_method(self):
+        self._server.stop()
+
+    def _run(self, monkeypatch, query_results):
+        def imsearch_query(query, engine, query_params, query_timeout=-1.0):
+            self._statuses.append(job.status)
+            if isinstance(query_results, Exception):
+                raise query_results
+            return query_results
+        monkeypatch.setattr(http_service_helper, 'imsearch_query', imsearch_query)
+        job = PipelineJob('q')
+        http_service_helper._job_table.add(job)
+        http_service_helper._run_pipeline_job(job, None, 'google_web', dict(), -1.0,
+                                              None, None, self._outdir, None, None)
+        return job
+
+    def test_images_downloaded(self, monkeypatch):
+        self._server.add('/a.jpg', make_image())
+        job = self._run(monkeypatch, [self._server.urldata('/a.jpg'),
+                                      self._server.urldata('/missing.jpg')])
+        assert self._statuses == ['querying']
+        job_dict = job.to_dict()
+        assert job_dict['status'] == 'done'
+        assert job_dict['queried'] == 2
+        assert (job_dict['downloaded'], job_dict['processed'], job_dict['failed']) == (1, 1, 1)
+        assert [dfile['image_id'] for dfile in job_dict['dfiles_list']] == ['a']
+        # the ImageGetter isn't kept once the job has finished
+        assert job._imgetter is None
+
+    def test_failed_query(self, monkeypatch):
+        job = self._run(monkeypatch, ValueError('engine unavailable'))
+        assert job.status == 'failed'
+        assert job.error == 'engine unavailable'
+        assert job.finish_time is not None
+
+    def test_job_status_route(self, monkeypatch):
+        job = self._run(monkeypatch, [])
+        client = imsearch_http_service.app.test_client()
+        resp = client.get('/jobs/%s' % job.job_id)
+        assert resp.status_code == 200
+        assert json.loads(resp.data)['status'] == 'done'
+        assert client.get('/jobs/unknown').status_code == 404
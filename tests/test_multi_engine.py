@@ -0,0 +1,53 @@
+import time
+import gevent
+import pytest
+
+from imsearchtools.engines.multi_engine import MultiEngineSearch
+from imsearchtools.engines.search_client import SearchClient, QueryException
+
+class FakeSearch(SearchClient):
+
+    def __init__(self, urls, delay=0.0, sizes=('small', 'medium', 'large')):
+        self.urls = urls
+        self.delay = delay
+        self._supported_sizes_map = dict((size, size) for size in sizes)
+        self._supported_styles_map = {'photo': 'photo'}
+
+    def query(self, query, size='medium', num_results=100):
+        gevent.sleep(self.delay)
+        if not self.urls:
+            raise QueryException("No image URLs could be retrieved")
+        return [{'url': url, 'image_id': url.upper()} for url in self.urls[:num_results]]
+
+
+class TestMultiEngineSearch(object):
+
+    def test_rank_fusion(self):
+        searcher = MultiEngineSearch([('a', FakeSearch(['x', 'y', 'z'])),
+                                      ('b', FakeSearch(['z', 'w'])),
+                                      ('c', FakeSearch([]))])
+        results = searcher.query('q')
+        assert [result['url'] for result in results] == ['z', 'x', 'y', 'w']
+        assert results[0]['engines'] == ['a', 'b']
+
+    def test_quorum(self):
+        searcher = MultiEngineSearch([('fast', FakeSearch(['x'])),
+                                      ('slow', FakeSearch(['y'], delay=1.0))],
+                                     quorum=1)
+        start = time.time()
+        results = searcher.query('q')
+        assert time.time() - start < 0.5
+        assert [result['url'] for result in results] == ['x']
+
+    def test_timeout(self):
+        searcher = MultiEngineSearch([('fast', FakeSearch(['x'], delay=0.01)),
+                                      ('slow', FakeSearch(['y'], delay=1.0))],
+                                     timeout=0.1)
+        assert [result['url'] for result in searcher.query('q')] == ['x']
+
+    def test_unsupported_size_skips_engine(self):
+        searcher = MultiEngineSearch([('a', FakeSearch(['x'], sizes=('small',))),
+                                      ('b', FakeSearch(['y']))])
+        assert [result['url'] for result in searcher.query('q', size='medium')] == ['y']
+        with pytest.raises(ValueError):
+            searcher.query('q', size='huge')
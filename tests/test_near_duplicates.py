@@ -0,0 +1,49 @@
+import numpy as np
+from PIL import Image as PILImage
+
+from imsearchtools.process.near_duplicates import NearDuplicateIndex, dhash, \
+     hamming_distance, HASH_BITS
+
+class TestNearDuplicateIndex(object):
+
+    def setup_method(self):
+        self._base = 0x0123456789abcdef
+
+    def _flip(self, image_hash, bits):
+        for bit in bits:
+            image_hash ^= 1 << bit
+        return image_hash
+
+    def test_within_threshold_found_in_any_band(self):
+        index = NearDuplicateIndex(threshold=4)
+        index.add(self._base, 'a')
+        # differing bits spread across all but one of the five bands
+        near = self._flip(self._base, [0, 13, 26, 39])
+        assert hamming_distance(self._base, near) == 4
+        assert index.find(near) == 'a'
+
+    def test_beyond_threshold_not_found(self):
+        index = NearDuplicateIndex(threshold=4)
+        index.add(self._base, 'a')
+        assert index.find(self._flip(self._base, [0, 13, 26, 39, 52])) is None
+
+    def test_threshold_zero_matches_exactly(self):
+        index = NearDuplicateIndex(threshold=0)
+        assert index.find_or_add(self._base, 'a') is None
+        assert index.find_or_add(self._base, 'b') == 'a'
+        assert index.find_or_add(self._flip(self._base, [5]), 'c') is None
+
+    def test_threshold_at_least_number_of_bits(self):
+        # all hashes are then near-duplicates of each other
+        index = NearDuplicateIndex(threshold=HASH_BITS)
+        index.add(0, 'a')
+        assert index.find((1 << HASH_BITS) - 1) == 'a'
+
+
+class TestDHash(object):
+
+    def test_resized_image_is_near_duplicate(self):
+        gradient = np.tile(np.sin(np.arange(256)/20.0)*100 + 128, (192, 1))
+        im = PILImage.fromarray(gradient.astype(np.uint8)).convert('RGB')
+        small = im.resize((64, 48), PILImage.LANCZOS)
+        assert hamming_distance(dhash(im), dhash(small)) <= 4
@@ -0,0 +1,82 @@
+import os
+import tempfile
+import time
+
+from imsearchtools.engines.result_cache import ResultCache, SqliteCacheStore
+from imsearchtools.engines.search_client import SearchClient
+from imsearchtools.engines.throttle import set_engine_throttle
+
+class FakeSearch(SearchClient):
+
+    def __init__(self):
+        self.timeout = 5.0
+        self.async_query = False
+        self._results_per_req = 10
+        self.requested_offsets = []
+
+    def _fetch_results_from_offset(self, query, result_offset,
+                                   aux_params={}, headers={},
+                                   num_results=-1, timeout=None):
+        self.requested_offsets.append(result_offset)
+        count = min(self._results_per_req, num_results - result_offset)
+        return [{'url': 'http://example.com/%s/%d.jpg' % (query, result_offset + i)}
+                for i in range(count)]
+
+    def query(self, query, num_results=20):
+        return self._fetch_results(query, num_results, aux_params={'size': 'm'})
+
+
+class TestResultCache(object):
+
+    def setup_method(self):
+        set_engine_throttle(FakeSearch, None)
+        self._searcher = FakeSearch()
+        self._searcher.result_cache = ResultCache(max_entries=4)
+
+    def test_repeated_query_hits_cache(self):
+        res = self._searcher.query('car')
+        res_cached = self._searcher.query('car')
+        assert res == res_cached
+        assert self._searcher.requested_offsets == [0, 10]
+        assert self._searcher.result_cache.stats['hits'] == 2
+        assert self._searcher.result_cache.stats['misses'] == 2
+
+    def test_larger_query_fetches_only_missing_pages(self):
+        res = self._searcher.query('car', num_results=15)
+        assert len(res) == 15
+        res_more = self._searcher.query('car', num_results=30)
+        assert res_more[:15] == res
+        assert len(res_more) == 30
+        assert self._searcher.requested_offsets == [0, 10, 20]
+
+    def test_smaller_query_sliced_from_cache(self):
+        res = self._searcher.query('car', num_results=30)
+        res_fewer = self._searcher.query('car', num_results=5)
+        assert res_fewer == res[:5]
+        assert self._searcher.requested_offsets == [0, 10, 20]
+
+    def test_cached_results_are_copies(self):
+        self._searcher.query('car')[0]['orig_fn'] = '/tmp/car.jpg'
+        assert 'orig_fn' not in self._searcher.query('car')[0]
+
+    def test_lru_eviction(self):
+        for q in ['car', 'bus', 'car', 'tram']:
+            self._searcher.query(q)
+        cache = self._searcher.result_cache
+        assert cache.stats['evictions'] == 2
+        assert cache.get(('FakeSearch', 'bus', (('size', 'm'),), 0)) is None
+        assert cache.get(('FakeSearch', 'car', (('size', 'm'),), 0)) is not None
+
+    def test_ttl_expiry(self):
+        cache = ResultCache(ttl=0.01)
+        cache.set('key', [{'url': 'a'}])
+        time.sleep(0.02)
+        assert cache.get('key') is None
+        assert cache.stats['expirations'] == 1
+
+    def test_sqlite_store_persists(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'cache.db')
+            ResultCache(store=SqliteCacheStore(path)).set('key', [{'url': 'a'}])
+            cache = ResultCache(store=SqliteCacheStore(path))
+            assert cache.get('key') == [{'url': 'a'}]
@@ -0,0 +1,89 @@
+import time
+import gevent
+
+from imsearchtools.engines.search_client import SearchClient
+from imsearchtools.engines.throttle import set_engine_throttle
+from imsearchtools.engines.latency import LatencyTracker, get_latency_tracker, \
+     DEFAULT_WINDOW
+
+class SlowPageSearch(SearchClient):
+
+    def __init__(self, timeout=5.0):
+        self.timeout = timeout
+        self.async_query = True
+        self._results_per_req = 10
+        self.slow_offsets = set()
+        self.request_timeouts = []
+
+    def _fetch_results_from_offset(self, query, result_offset,
+                                   aux_params={}, headers={},
+                                   num_results=-1, timeout=None):
+        self.request_timeouts.append(timeout)
+        if result_offset in self.slow_offsets:
+            # only the first request for the page is slow
+            self.slow_offsets.discard(result_offset)
+            gevent.sleep(1.0)
+        else:
+            gevent.sleep(0.01)
+        count = min(self._results_per_req, num_results - result_offset)
+        return [{'url': 'http://example.com/%d.jpg' % (result_offset + i)}
+                for i in range(count)]
+
+    def query(self, query, num_results=30):
+        return self._fetch_results(query, num_results)
+
+
+class TestSearchClient(object):
+
+    def setup_method(self):
+        set_engine_throttle(SlowPageSearch, None)
+        # pages are hedged after 0.1s, well clear of the normal page latency
+        # (replacing the latencies recorded by earlier tests)
+        tracker = get_latency_tracker(SlowPageSearch)
+        for _ in range(DEFAULT_WINDOW):
+            tracker.record(0.1)
+
+    def test_slow_page_is_hedged(self):
+        searcher = SlowPageSearch()
+        searcher.slow_offsets.add(10)
+        start = time.time()
+        results = searcher.query('q')
+        assert time.time() - start < 0.5
+        assert len(results) == 30
+        assert len(searcher.request_timeouts) == 4
+
+    def test_no_hedging(self):
+        searcher = SlowPageSearch(timeout=0.2)
+        searcher.hedge_percentile = -1
+        searcher.slow_offsets.add(10)
+        results = searcher.query('q')
+        assert len(results) == 20
+        assert len(searcher.request_timeouts) == 3
+
+    def test_requests_given_remaining_time(self):
+        searcher = SlowPageSearch(timeout=2.0)
+        searcher.query('q')
+        assert all(0.0 < timeout <= 2.0 for timeout in searcher.request_timeouts)
+
+    def test_timeout_given_per_query(self):
+        searcher = SlowPageSearch(timeout=5.0)
+        searcher.hedge_percentile = -1
+        searcher.slow_offsets.add(10)
+        start = time.time()
+        results = searcher._fetch_results('q', 30, timeout=0.2)
+        assert time.time() - start < 0.5
+        assert len(results) == 20
+
+
+class TestLatencyTracker(object):
+
+    def test_percentile(self):
+        tracker = LatencyTracker(window=100, min_samples=5)
+        for latency in range(4):
+            tracker.record(float(latency))
+        assert tracker.percentile(50) is None
+        for latency in range(4, 101):
+            tracker.record(float(latency))
+        # only the most recent 100 latencies are kept
+        assert tracker.percentile(0) == 1.0
+        assert tracker.percentile(95) == 95.0
@@ -0,0 +1,75 @@
+import time
+import gevent
+
+from imsearchtools.engines.throttle import TokenBucket, EngineThrottle
+
+class TestTokenBucket(object):
+
+    def test_burst_then_paced(self):
+        bucket = TokenBucket(rate=20.0, burst=2)
+        start = time.time()
+        times = []
+        for _ in range(6):
+            bucket.acquire()
+            times.append(time.time() - start)
+        # the burst is immediate, then one token is added every 50ms
+        assert times[1] < 0.02
+        assert 0.18 < times[5] < 0.3
+
+    def test_tokens_refill_while_idle(self):
+        bucket = TokenBucket(rate=20.0, burst=2)
+        bucket.acquire()
+        bucket.acquire()
+        gevent.sleep(0.1)
+        start = time.time()
+        bucket.acquire()
+        bucket.acquire()
+        assert time.time() - start < 0.02
+
+
+class TestEngineThrottle(object):
+
+    def setup_method(self):
+        self._in_flight = 0
+        self._max_in_flight = 0
+
+    def _request(self, throttle, duration):
+        with throttle:
+            self._in_flight += 1
+            self._max_in_flight = max(self._max_in_flight, self._in_flight)
+            gevent.sleep(duration)
+            self._in_flight -= 1
+
+    def test_max_in_flight(self):
+        throttle = EngineThrottle(requests_per_sec=-1, max_in_flight=2)
+        start = time.time()
+        gevent.joinall([gevent.spawn(self._request, throttle, 0.05) for _ in range(6)],
+                       raise_error=True)
+        assert self._max_in_flight == 2
+        assert time.time() - start >= 0.15
+
+    def test_unlimited(self):
+        throttle = EngineThrottle(requests_per_sec=-1, max_in_flight=-1)
+        gevent.joinall([gevent.spawn(self._request, throttle, 0.01) for _ in range(20)],
+                       raise_error=True)
+        assert self._max_in_flight == 20
+
+    def test_slot_released_when_killed_waiting_for_rate(self):
+        throttle = EngineThrottle(requests_per_sec=1.0, burst=1, max_in_flight=1)
+        self._request(throttle, 0.0)
+        # holds the slot while waiting (about 1s) for the next token
+        waiting = gevent.spawn(self._request, throttle, 0.0)
+        gevent.sleep(0.01)
+        assert throttle._in_flight.counter == 0
+        waiting.kill()
+        assert throttle._in_flight.counter == 1
+
+    def test_slot_not_released_when_killed_waiting_for_slot(self):
+        throttle = EngineThrottle(requests_per_sec=-1, max_in_flight=1)
+        running = gevent.spawn(self._request, throttle, 0.05)
+        gevent.sleep(0.01)
+        waiting = gevent.spawn(self._request, throttle, 0.0)
+        gevent.sleep(0.01)
+        waiting.kill()
+        running.join()
+        assert throttle._in_flight.counter == 1
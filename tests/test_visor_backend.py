@@ -0,0 +1,261 @@
+import json
+import time
+import socket
+import gevent
+import pytest
+import zmq
+import zmq.green
+from gevent.server import StreamServer
+
+from imsearchtools.process.callback_backends import get_callback_backend
+from imsearchtools.postproc_modules._visor_backend import FramedSocketReader, \
+     BackendConnectionPool, RequestBatcher, ReturnChannel, get_return_channel, \
+     frame_message, FRAMING_LENGTH
+
+class FakeBackend(object):
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.batches = []
+
+    def request(self, func_in, timeout=None):
+        self.batches.append(func_in)
+        gevent.sleep(0.01)
+        if self.fail:
+            raise socket.error('backend unavailable')
+        return json.dumps([dict(impath=image_request['impath'], func=func_in['func'])
+                           for image_request in func_in['batch']]).encode('utf-8')
+
+
+class FakeBackendServer(object):
+    """Replies to each request with its 'id', unless the action given for the
+    request (by its position in all requests received) says otherwise"""
+
+    def __init__(self, actions=None):
+        self.actions = actions or dict()
+        self.requests = []
+        self.connections = 0
+        self._server = StreamServer(('127.0.0.1', 0), self._handle)
+        self._server.start()
+        self.port = self._server.server_port
+
+    def stop(self):
+        self._server.stop()
+
+    def _handle(self, sock, address):
+        self.connections += 1
+        reader = FramedSocketReader(sock)
+        while True:
+            try:
+                request = json.loads(reader.read_message())
+            except EOFError:
+                return
+            self.requests.append(request)
+            action = self.actions.get(len(self.requests), 'reply')
+            if action == 'close':
+                sock.close()
+                return
+            elif action == 'partial':
+                sock.sendall(b'{"id"')
+                sock.close()
+                return
+            elif action == 'hang':
+                gevent.sleep(10.0)
+            elif action == 'reply_close':
+                sock.sendall(frame_message(json.dumps(request).encode('utf-8')))
+                sock.close()
+                return
+            else:
+                sock.sendall(frame_message(json.dumps(request).encode('utf-8')))
+
+
+class TestFramedSocketReader(object):
+
+    def setup_method(self):
+        self._sock, self._peer = socket.socketpair()
+
+    def teardown_method(self):
+        self._sock.close()
+        self._peer.close()
+
+    def test_terminator_split_across_reads(self):
+        reader = FramedSocketReader(self._sock, recv_size=4)
+        self._peer.sendall(b'{"a": 1}$')
+        self._peer.sendall(b'$$next$$$')
+        assert reader.read_message(1.0) == b'{"a": 1}'
+        assert reader.read_message(1.0) == b'next'
+        assert reader.buffered == 0
+
+    def test_large_message(self):
+        reader = FramedSocketReader(self._sock, recv_size=16)
+        msg = b'x'*100000
+        self._peer.sendall(frame_message(msg))
+        assert reader.read_message(1.0) == msg
+
+    def test_length_prefixed(self):
+        reader = FramedSocketReader(self._sock, framing=FRAMING_LENGTH, recv_size=4)
+        self._peer.sendall(frame_message(b'a$$$b', FRAMING_LENGTH) +
+                           frame_message(b'', FRAMING_LENGTH))
+        assert reader.read_message(1.0) == b'a$$$b'
+        assert reader.read_message(1.0) == b''
+
+    def test_timeout(self):
+        reader = FramedSocketReader(self._sock)
+        self._peer.sendall(b'partial')
+        with pytest.raises(socket.timeout):
+            reader.read_message(0.05)
+
+    def test_connection_closed(self):
+        reader = FramedSocketReader(self._sock)
+        self._peer.sendall(b'partial')
+        self._peer.close()
+        with pytest.raises(EOFError):
+            reader.read_message(1.0)
+
+
+class TestBackendConnectionPool(object):
+
+    def setup_method(self):
+        self._server = None
+
+    def teardown_method(self):
+        self._server.stop()
+
+    def _pool(self, actions=None, max_idle=8):
+        self._server = FakeBackendServer(actions)
+        return BackendConnectionPool('127.0.0.1', self._server.port, max_idle)
+
+    def test_connection_reused(self):
+        pool = self._pool()
+        for request_id in range(3):
+            assert json.loads(pool.request(dict(id=request_id))) == dict(id=request_id)
+        assert self._server.connections == 1
+
+    def test_idle_connections_capped(self):
+        pool = self._pool(max_idle=2)
+        jobs = [gevent.spawn(pool.request, dict(id=request_id)) for request_id in range(4)]
+        gevent.joinall(jobs, raise_error=True)
+        assert self._server.connections == 4
+        assert len(pool._idle) == 2
+
+    def test_closed_idle_connection_dropped(self):
+        pool = self._pool({1: 'reply_close'})
+        pool.request(dict(id=1))
+        gevent.sleep(0.01)
+        pool.request(dict(id=2))
+        assert self._server.connections == 2
+        assert len(self._server.requests) == 2
+
+    def test_reconnect_when_closed_before_reply(self):
+        pool = self._pool({2: 'close'})
+        pool.request(dict(id=1))
+        assert json.loads(pool.request(dict(id=2))) == dict(id=2)
+        assert self._server.connections == 2
+
+    def test_no_retry_after_partial_reply(self):
+        pool = self._pool({2: 'partial'})
+        pool.request(dict(id=1))
+        with pytest.raises(EOFError):
+            pool.request(dict(id=2))
+        assert len(self._server.requests) == 2
+
+    def test_no_retry_on_timeout(self):
+        pool = self._pool({2: 'hang'})
+        pool.request(dict(id=1))
+        with pytest.raises(socket.timeout):
+            pool.request(dict(id=2), timeout=0.1)
+        assert len(self._server.requests) == 2
+        assert self._server.connections == 1
+
+
+class TestRequestBatcher(object):
+
+    def setup_method(self):
+        self._backend = FakeBackend()
+
+    def _request_all(self, batcher, impaths):
+        jobs = [gevent.spawn(batcher.request, 'f', 'q', dict(impath=impath))
+                for impath in impaths]
+        gevent.joinall(jobs)
+        return jobs
+
+    def test_full_batches_sent_without_delay(self):
+        batcher = RequestBatcher(self._backend, 4, batch_delay_ms=1000)
+        start = time.time()
+        jobs = self._request_all(batcher, ['im%d' % i for i in range(8)])
+        assert time.time() - start < 0.5
+        assert [len(batch['batch']) for batch in self._backend.batches] == [4, 4]
+        assert [job.value['impath'] for job in jobs] == ['im%d' % i for i in range(8)]
+
+    def test_partial_batch_sent_after_delay(self):
+        batcher = RequestBatcher(self._backend, 4, batch_delay_ms=50)
+        start = time.time()
+        jobs = self._request_all(batcher, ['im0', 'im1', 'im2', 'im3', 'im4'])
+        assert time.time() - start >= 0.05
+        assert [len(batch['batch']) for batch in self._backend.batches] == [4, 1]
+        assert jobs[4].value['impath'] == 'im4'
+
+    def test_batched_per_func(self):
+        batcher = RequestBatcher(self._backend, 2, batch_delay_ms=10)
+        jobs = [gevent.spawn(batcher.request, func, 'q', dict(impath=func))
+                for func in ['f', 'g']]
+        gevent.joinall(jobs)
+        assert len(self._backend.batches) == 2
+        assert [job.value['func'] for job in jobs] == ['f', 'g']
+
+    def test_batches_fill_on_zmq_backend(self):
+        # as sized by http_service_helper._prepare_download for batch_size=16
+        batcher = RequestBatcher(self._backend, 16, batch_delay_ms=1000)
+        handler = get_callback_backend('zmq')(batcher.request, 32, worker_count=32)
+        start = time.time()
+        for i in range(32):
+            handler.run_callback('f', 'q', dict(impath='im%d' % i))
+        handler.join()
+        assert time.time() - start < 0.5
+        assert [len(batch['batch']) for batch in self._backend.batches] == [16, 16]
+
+    def test_error_raised_for_each_image(self):
+        batcher = RequestBatcher(FakeBackend(fail=True), 2, batch_delay_ms=10)
+        jobs = self._request_all(batcher, ['im0', 'im1', 'im2'])
+        assert all(isinstance(job.exception, socket.error) for job in jobs)
+
+
+class TestReturnChannel(object):
+
+    def setup_method(self):
+        # the plain (not gevent-compatible) context created by the service
+        self._context = zmq.Context()
+        self._channel = 'inproc://test_return_ch'
+        green_context = zmq.green.Context.shadow(self._context.underlying)
+        self._router = green_context.socket(zmq.ROUTER)
+        self._router.bind(self._channel)
+        self._replier = gevent.spawn(self._reply)
+
+    def teardown_method(self):
+        self._replier.kill()
+        self._router.close(linger=0)
+
+    def _reply(self):
+        # reply to each request after a delay, replying to several at once
+        while True:
+            msg = self._router.recv_multipart()
+            gevent.spawn_later(0.1, self._router.send_multipart, msg[:-1] + [b'ok'])
+
+    def test_requests_do_not_block(self):
+        channel = ReturnChannel(self._channel, self._context)
+        ticks = []
+        ticker = gevent.spawn(lambda: [ticks.append(gevent.sleep(0.01)) for _ in range(10)])
+        start = time.time()
+        jobs = [gevent.spawn(channel.send, b'im%d' % i) for i in range(4)]
+        gevent.joinall(jobs, raise_error=True)
+        # the requests are in flight at once, without blocking other greenlets
+        assert time.time() - start < 0.3
+        assert [job.value for job in jobs] == [b'ok']*4
+        assert len(ticks) >= 5
+        ticker.kill()
+        assert len(channel._idle) == 4
+
+    def test_cached_per_context(self):
+        channel = get_return_channel(self._channel, self._context)
+        assert get_return_channel(self._channel, self._context) is channel
+        assert get_return_channel(self._channel) is not channel